@@ -1,16 +1,20 @@
+import os
 import asyncio
-from aiogram import Bot
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
-from app.data.dbContext import get_users_by_time, insert_daily_reports, get_todays_dengies, insert_daily_category_reports, insert_monthly_category_reports, insert_yearly_category_reports
+from app.data.storage import get_users_by_time, refresh_zone_offsets, get_todays_dengies_for_users, get_daily_digests, maintain_dengies_partitions, run_daily_rollups, purge_outbox, get_statement_stats
 from apscheduler.triggers.cron import CronTrigger
+from app.data.metrics import format_query_stats, format_statement_stats
+from app.data.cache import get_cache_stats, format_cache_stats
+import app.auto.outbox as outbox
+from app.cmn.zones import quarter_tick
 # from concurrent.futures import ThreadPoolExecutor
 # from pathlib import Path
 # import os, io, hashlib, math
 # from playwright.async_api import async_playwright
 
 
-from app.cmn.transtalor import get_text, smart_sleep
+from app.cmn.transtalor import get_text
 import logging
 # from aiogram.types import FSInputFile
 # from typing import List, Tuple
@@ -21,9 +25,20 @@ from datetime import datetime
 # import plotly.graph_objects as go
 
 
+# Local times (hour, minute) of the scheduled work; minutes must be a multiple of 15,
+# the scheduler tick. The rollups and digest run shortly after local midnight, so the
+# digest covers the whole day that just ended (DIGEST_DAYS_AGO).
+REMINDER_TIME = (21, 0)
+DAILY_REPORT_TIME = (0, 15)
+DIGEST_DAYS_AGO = 1
+# Due users whose rows are fetched with one query
+REMINDER_CHUNK_SIZE = int(os.getenv('REMINDER_CHUNK_SIZE', 1000))
+DIGEST_CHUNK_SIZE = int(os.getenv('DIGEST_CHUNK_SIZE', 1000))
+# Latest entries listed in the daily digest, 0 for category totals only
+DIGEST_MAX_ENTRIES = int(os.getenv('DIGEST_MAX_ENTRIES', 20))
 
 
-async def schedule_hourly_task(bot: Bot):
+async def schedule_hourly_task():
     """
     Schedule the `automatik`
     """
@@ -34,15 +49,21 @@ async def schedule_hourly_task(bot: Bot):
     #     # logging.info(f"the fun returns: {next_min}")
     #     return next_min
     # next_min_ = next_minute()
-    trigger = CronTrigger(minute=0)
+    # Every 15 minutes, so zones with a :30 or :45 offset are served too
+    trigger = CronTrigger(minute="0,15,30,45")
     # trigger = IntervalTrigger(minutes=0)
     
     # Define a wrapper to ensure sequential execution
     async def sequential_task():
+        # The tick this run belongs to, also the run id of its outbox messages
+        run = quarter_tick()
+        # Offsets first, so the lookups below already see a DST change
+        await refresh_zone_offsets()
+
         # First part sending reminders
-        await sending_reminder(bot)
+        await sending_reminder(run)
         
-        users = await get_users_by_time(0, 1)
+        users = await get_users_by_time(*DAILY_REPORT_TIME)
 
         if not users:
             # No users to process
@@ -54,11 +75,28 @@ async def schedule_hourly_task(bot: Bot):
             await update_daily_report(only_user_ids)
 
             # Send full list (user_id + language) to statistik
-            await sending_statistik_daily(bot, users)
+            await sending_statistik_daily(users, run)
+
+        if run.minute == 0:
+            logging.info("Storage query stats:\n" + format_query_stats())
+            statement_stats = get_statement_stats()
+            if statement_stats:
+                logging.info("Prepared statements:\n" + format_statement_stats(statement_stats))
+            if get_cache_stats():
+                logging.info("Caches:\n" + format_cache_stats())
         
     
-    # Schedule the sequential task
-    scheduler.add_job(sequential_task, trigger=trigger)
+    # Schedule the sequential task. A run that starts late still belongs to its tick
+    # (see zones.quarter_tick), so allow most of the interval instead of skipping it.
+    scheduler.add_job(sequential_task, trigger=trigger, misfire_grace_time=600, coalesce=True)
+    # Keep dengies partitions ahead of time; also runs once right after startup
+    scheduler.add_job(
+        maintain_dengies_partitions,
+        trigger=CronTrigger(hour=3, minute=30),
+        next_run_time=datetime.now()
+    )
+    # Delivered and failed outbox messages are kept for a while, then deleted
+    scheduler.add_job(purge_outbox, trigger=CronTrigger(hour=3, minute=45))
     
     scheduler.start()
     logging.info("Scheduler started for daily tasks: Reminder and updating the database.")
@@ -67,55 +105,57 @@ async def schedule_hourly_task(bot: Bot):
     await asyncio.Event().wait()
 
 
-async def sending_reminder(bot: Bot):
-    reminder_user_ids = await get_users_by_time(21, 0)
+async def sending_reminder(run: datetime):
+    reminder_user_ids = await get_users_by_time(*REMINDER_TIME)
     
     if not reminder_user_ids:
         logging.info("No users found at this time.")
         return
 
-    for user_id, lng_code in reminder_user_ids:
-        rows = await get_todays_dengies(user_id)
-
-        if not rows:
-            # No expenses today — send just reminder text
-            await smart_sleep(
-                bot.send_message,
-                chat_id=user_id,
-                text=await get_text(lng_code, "reminder"),
-                parse_mode='HTML'
-            )
+    # Today's rows of REMINDER_CHUNK_SIZE users per query; the messages of a chunk
+    # are queued before the next one is read, the outbox sender delivers them
+    for start in range(0, len(reminder_user_ids), REMINDER_CHUNK_SIZE):
+        chunk = reminder_user_ids[start:start + REMINDER_CHUNK_SIZE]
+        rows_by_user = await get_todays_dengies_for_users([user_id for user_id, _ in chunk])
+        if rows_by_user is None:
+            logging.error(f"Reminder skipped for {len(chunk)} users")
             continue
 
-        # Build formatted message
-        message_lines = []
-        for amount, category_name, comment_text, created_time in rows:
-            # Format like "HH:MM - Category (Amount - Comment)"
-            # Assuming created_date is not returned — if needed, we can add it to the query
-            # For now, we just show category + amount (+ comment if exists)
-            if comment_text:
-                line = f"{created_time} - {category_name} ({amount:.2f} - {comment_text})"
-            else:
-                line = f"{created_time} - {category_name} ({amount:.2f})"
-            message_lines.append(line)
-
-        # Join all lines
-        
+        messages = [
+            (user_id, await render_reminder(lng_code, rows_by_user.get(user_id, [])))
+            for user_id, lng_code in chunk
+        ]
+        await outbox.enqueue("reminder", run, messages)
+
+
+async def render_reminder(lng_code: str, rows: list[tuple]) -> list[str]:
+    if not rows:
+        # No expenses today — send just reminder text
+        return [await get_text(lng_code, "reminder")]
+
+    # Build formatted message
+    message_lines = []
+    for amount, category_name, comment_text, created_time, _currency_is in rows:
+        # Format like "HH:MM - Category (Amount - Comment)"
+        # Assuming created_date is not returned — if needed, we can add it to the query
+        # For now, we just show category + amount (+ comment if exists)
+        if comment_text:
+            line = f"{created_time} - {category_name} ({amount:.2f} - {comment_text})"
+        else:
+            line = f"{created_time} - {category_name} ({amount:.2f})"
+        message_lines.append(line)
 
-        # Build your message as before
-        message_text = "\n".join(message_lines)
+    # Join all lines
+    
+
+    # Build your message as before
+    message_text = "\n".join(message_lines)
 
-        # Combine with the reminder header
-        full_message = f"{await get_text(lng_code, 'reminder')}\n\n{message_text}"
+    # Combine with the reminder header
+    full_message = f"{await get_text(lng_code, 'reminder')}\n\n{message_text}"
 
-        # Split into chunks if too long
-        for chunk in chunk_message(full_message):
-            await smart_sleep(
-                bot.send_message,
-                chat_id=user_id,
-                text=chunk,
-                parse_mode='HTML'
-            )
+    # Split into chunks if too long
+    return chunk_message(full_message)
 
 
 def chunk_message(text: str, max_length: int = 4096):
@@ -142,80 +182,83 @@ async def update_daily_report(user_ids: list[int]):
     if not user_ids:
         logging.info("No users found for data updating.")
         return
-    # For every day total
-    await insert_daily_reports(user_ids)
-
+    # Everything entered since the users' last rollup, into the day, month and year
+    # it was entered for
+    await run_daily_rollups(user_ids)
 
-    # For every day
-    await insert_daily_category_reports(user_ids)
-    # For every month
-    await insert_monthly_category_reports(user_ids)
+async def sending_statistik_daily(user_ids: list[tuple[int, str]], run: datetime):
+    """
+    The digest of the day that just ended is built from the daily rollups written just
+    before by update_daily_report, so its cost grows with the categories used, not the
+    entries. Only the latest DIGEST_MAX_ENTRIES entries per user are read from dengies,
+    for the listing.
+    The messages are queued in the outbox per chunk of users.
+    """
+    without_expenses = 0
+    for start in range(0, len(user_ids), DIGEST_CHUNK_SIZE):
+        chunk = user_ids[start:start + DIGEST_CHUNK_SIZE]
+        digests = await get_daily_digests([user_id for user_id, _ in chunk], DIGEST_DAYS_AGO)
+        if digests is None:
+            logging.error(f"Daily digest skipped for {len(chunk)} users")
+            continue
+        without_expenses += len(chunk) - len(digests)
+
+        entries = {}
+        if DIGEST_MAX_ENTRIES > 0 and digests:
+            # Without the listing the digest still has the totals
+            entries = await get_todays_dengies_for_users(list(digests), DIGEST_MAX_ENTRIES, DIGEST_DAYS_AGO) or {}
+
+        messages = [
+            (user_id, await render_statistik_daily(lang_code, digests[user_id], entries.get(user_id, [])))
+            for user_id, lang_code in chunk
+            if user_id in digests
+        ]
+        await outbox.enqueue("daily_digest", run, messages)
+
+    logging.info(f"{without_expenses} users do not have expenses for the day")
+
+
+async def render_statistik_daily(lang_code: str, digest: dict, rows: list[tuple]) -> list[str]:
+    # Header text based on user's language
+    header = await get_text(lang_code, "yesterdaysDate")
+    currency_is = digest["currency"]
+
+    # -------------------------------------------------------------------
+    # Build individual lines, the latest DIGEST_MAX_ENTRIES of them
+    # -------------------------------------------------------------------
+    lines = []
+    for amount, category_name, comment_text, created_time, _currency_is in rows:
+        # Format line
+        if comment_text:
+            line = f"⏰ {created_time} — {currency_is} {amount} — {category_name} ({comment_text})"
+        else:
+            line = f"⏰ {created_time} — {currency_is} {amount} — {category_name}"
 
-    await insert_yearly_category_reports(user_ids)
+        lines.append(line)
 
-async def sending_statistik_daily(bot: Bot, user_ids: list[int]):
-    for user_id, lang_code in user_ids:
+    if rows and digest["entries"] > len(rows):
+        lines.append(f"… +{digest['entries'] - len(rows)}")
 
-        # Header text based on user's language
-        header = await get_text(lang_code, "todaysDate")
+    # -------------------------------------------------------------------
+    # Build category totals section
+    # -------------------------------------------------------------------
+    cat_lines = []
+    for category, amt in digest["categories"]:
+        cat_lines.append(f"• {category}: {currency_is} {amt}")
 
-        rows = await get_todays_dengies(user_id)
+    category_summary = "\n".join(cat_lines)
 
-        if not rows:
-            logging.info(f"{user_id} does not have expenses for today")
-            continue
+    # -------------------------------------------------------------------
+    # Final message text
+    # -------------------------------------------------------------------
+    message = (
+        f"{header}\n\n"
+        + ("\n".join(lines) + "\n\n" if lines else "")
+        + f"<b>{await get_text(lang_code, 'totalWord')}</b> {currency_is} {digest['total']}\n"
+        + f"<b>{await get_text(lang_code, 'totalCat')}</b>\n{category_summary}"
+    )
 
-        # -------------------------------------------------------------------
-        # Build individual lines
-        # -------------------------------------------------------------------
-        lines = []
-        total_amount = 0
-        category_totals = {}  # {category_name: sum}
-
-        for amount, category_name, comment_text, created_time, currency_is in rows:
-
-            # Sum total
-            total_amount += amount
-
-            # Sum by category
-            if category_name not in category_totals:
-                category_totals[category_name] = 0
-            category_totals[category_name] += amount
-
-            # Format line
-            if comment_text:
-                line = f"⏰ {created_time} — {currency_is} {amount} — {category_name} ({comment_text})"
-            else:
-                line = f"⏰ {created_time} — {currency_is} {amount} — {category_name}"
-
-            lines.append(line)
-
-        # -------------------------------------------------------------------
-        # Build category totals section
-        # -------------------------------------------------------------------
-        cat_lines = []
-        for category, amt in category_totals.items():
-            cat_lines.append(f"• {category}: {currency_is} {amt}")
-
-        category_summary = "\n".join(cat_lines)
-
-        # -------------------------------------------------------------------
-        # Final message text
-        # -------------------------------------------------------------------
-        message = (
-            f"{header}\n\n"
-            + "\n".join(lines)
-            + f"\n\n<b>{await get_text(lang_code, 'totalWord')}</b> {currency_is} {total_amount}\n"
-            + f"<b>{await get_text(lang_code, 'totalCat')}</b>\n{category_summary}"
-        )
-
-        for chunk in chunk_message(message):
-            await smart_sleep(
-                bot.send_message,
-                chat_id=user_id,
-                text=chunk,
-                parse_mode='HTML'
-            )
+    return chunk_message(message)
 
 
 
@@ -0,0 +1,193 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramRetryAfter
+
+from app.cmn.quota import TokenBucket
+
+
+# Telegram allows a bot about 30 messages per second overall and about one per
+# second in a single private chat; going over is answered with a flood wait.
+FANOUT_CONCURRENCY = int(os.getenv('FANOUT_CONCURRENCY', 20))
+FANOUT_RATE = float(os.getenv('FANOUT_RATE', 28))
+FANOUT_BURST = float(os.getenv('FANOUT_BURST', 5))
+FANOUT_CHAT_INTERVAL = float(os.getenv('FANOUT_CHAT_INTERVAL', 1.0))
+# A chat is given up after this many flood waits, or one longer than FANOUT_MAX_WAIT seconds
+FANOUT_MAX_RETRIES = int(os.getenv('FANOUT_MAX_RETRIES', 3))
+FANOUT_MAX_WAIT = float(os.getenv('FANOUT_MAX_WAIT', 120))
+
+# (chat_id, language) -> the messages to send, None or [] for nothing
+Render = Callable[[int, str], Awaitable[list[str] | None]]
+
+
+class Delivery:
+    """The messages for one chat and how far their delivery got."""
+
+    __slots__ = ("chat_id", "lang_code", "texts", "sent", "flood_waits", "next_at", "key", "outcome", "error", "retry_after")
+
+    def __init__(self, chat_id: int, lang_code: str | None = None, texts: list[str] | None = None, sent: int = 0, key=None):
+        self.chat_id = chat_id
+        self.lang_code = lang_code
+        # None until rendered
+        self.texts = texts
+        self.sent = sent
+        self.flood_waits = 0
+        self.next_at = 0.0
+        # Caller's id of the delivery, e.g. the outbox row
+        self.key = key
+        # delivered | skipped | failed | deferred, once finished
+        self.outcome: str | None = None
+        self.error: str | None = None
+        self.retry_after = 0
+
+
+class FanoutReport:
+    """Per-run counters, logged when the run completes."""
+
+    __slots__ = ("name", "chats", "delivered", "skipped", "failed", "deferred", "messages", "flood_waits", "elapsed")
+
+    def __init__(self, name: str, chats: int):
+        self.name = name
+        self.chats = chats
+        self.delivered = 0
+        self.skipped = 0
+        self.failed = 0
+        self.deferred = 0
+        self.messages = 0
+        self.flood_waits = 0
+        self.elapsed = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.messages / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"Fan-out {self.name}: {self.delivered}/{self.chats} chats delivered, "
+            f"{self.skipped} skipped, {self.failed} failed, {self.deferred} deferred, {self.messages} messages "
+            f"in {self.elapsed:.1f}s ({self.rate:.1f} msg/s), {self.flood_waits} flood waits"
+        )
+
+
+async def deliver_all(
+    name: str,
+    bot: Bot,
+    deliveries: list[Delivery],
+    render: Render | None = None,
+    defer_flood_waits: bool = False,
+    **send_kwargs
+) -> FanoutReport:
+    """
+    Sends the texts of every delivery, rendered with render(chat_id, lang_code) unless
+    it already has them, with up to FANOUT_CONCURRENCY chats in flight. All sends share
+    one FANOUT_RATE token bucket, messages to the same chat are FANOUT_CHAT_INTERVAL
+    apart and in order. A flood wait only puts its chat back in the queue for later,
+    the other chats keep going. With defer_flood_waits a flood-waited chat is finished as "deferred" with its
+    retry_after instead of being retried here, for callers that retry it themselves.
+    Every delivery has its outcome set when this returns.
+    """
+    report = FanoutReport(name, len(deliveries))
+    started = time.monotonic()
+    if not deliveries:
+        return report
+
+    queue: asyncio.Queue[Delivery] = asyncio.Queue()
+    for delivery in deliveries:
+        queue.put_nowait(delivery)
+
+    bucket = TokenBucket(FANOUT_BURST, FANOUT_RATE)
+    bucket_lock = asyncio.Lock()
+    loop = asyncio.get_running_loop()
+    pending = len(deliveries)
+    finished = asyncio.Event()
+
+    def done(delivery: Delivery, outcome: str, error: str | None = None):
+        nonlocal pending
+        delivery.outcome = outcome
+        delivery.error = error
+        setattr(report, outcome, getattr(report, outcome) + 1)
+        pending -= 1
+        if pending == 0:
+            finished.set()
+
+    async def acquire():
+        # One waiter at a time, so tokens go out in FIFO order
+        async with bucket_lock:
+            while not bucket.take():
+                await asyncio.sleep((1 - bucket.tokens) / bucket.rate)
+
+    async def deliver(delivery: Delivery):
+        if delivery.texts is None:
+            try:
+                delivery.texts = await render(delivery.chat_id, delivery.lang_code) or []
+            except Exception as e:
+                logging.error(f"Fan-out {name}: rendering for {delivery.chat_id} failed: {e}")
+                done(delivery, "failed", f"render: {e}")
+                return
+            if not delivery.texts:
+                done(delivery, "skipped")
+                return
+
+        while delivery.sent < len(delivery.texts):
+            wait = delivery.next_at - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await acquire()
+
+            try:
+                await bot.send_message(chat_id=delivery.chat_id, text=delivery.texts[delivery.sent], **send_kwargs)
+            except TelegramRetryAfter as e:
+                report.flood_waits += 1
+                delivery.flood_waits += 1
+                delivery.retry_after = e.retry_after
+                if defer_flood_waits:
+                    done(delivery, "deferred", f"flood wait of {e.retry_after}s")
+                    return
+                if delivery.flood_waits > FANOUT_MAX_RETRIES or e.retry_after > FANOUT_MAX_WAIT:
+                    logging.warning(f"Fan-out {name}: giving up on {delivery.chat_id} after a flood wait of {e.retry_after}s")
+                    done(delivery, "failed", f"flood wait of {e.retry_after}s")
+                    return
+                # Requeue this chat once the wait is over and free the worker for the others
+                delivery.next_at = time.monotonic() + e.retry_after
+                loop.call_later(e.retry_after, queue.put_nowait, delivery)
+                return
+            except TelegramForbiddenError:
+                # Blocked the bot or deleted the account
+                logging.info(f"Fan-out {name}: {delivery.chat_id} is unreachable")
+                done(delivery, "failed", "unreachable")
+                return
+            except TelegramAPIError as e:
+                logging.error(f"Fan-out {name}: Telegram API error for {delivery.chat_id}: {e}")
+                done(delivery, "failed", str(e))
+                return
+            except Exception as e:
+                logging.error(f"Fan-out {name}: unexpected error for {delivery.chat_id}: {e}")
+                done(delivery, "failed", str(e))
+                return
+
+            delivery.sent += 1
+            report.messages += 1
+            delivery.next_at = time.monotonic() + FANOUT_CHAT_INTERVAL
+
+        done(delivery, "delivered")
+
+    async def worker():
+        while True:
+            delivery = await queue.get()
+            await deliver(delivery)
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(FANOUT_CONCURRENCY, len(deliveries)))]
+    try:
+        await finished.wait()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    report.elapsed = time.monotonic() - started
+    logging.info(str(report))
+    return report
@@ -0,0 +1,80 @@
+import os
+import asyncio
+import logging
+from contextlib import suppress
+from datetime import datetime
+
+from aiogram import Bot
+
+import app.data.storage as db
+from app.auto.fanout import Delivery, deliver_all
+
+
+# Scheduler jobs render their messages and enqueue them in the outbox table; the
+# sender loop below claims due messages in batches and delivers them through the
+# fan-out (rate limit, per-chat pacing), so a restart resumes where it stopped.
+# Every bot instance with OUTBOX_SENDER=1 runs a sender; instances share the work
+# through the claims, but each has its own FANOUT_RATE, so divide it between them.
+OUTBOX_SENDER = os.getenv('OUTBOX_SENDER', '1') == '1'
+OUTBOX_BATCH = int(os.getenv('OUTBOX_BATCH', 500))
+# A claimed batch must be finished within the lease, or it is claimed again
+OUTBOX_LEASE = float(os.getenv('OUTBOX_LEASE', 300))
+OUTBOX_POLL = float(os.getenv('OUTBOX_POLL', 5))
+
+# Set by enqueue, so a sender in this process does not wait for the next poll
+_wakeup = asyncio.Event()
+
+
+async def enqueue(job: str, run: datetime, messages: list[tuple[int, list[str]]]) -> int | None:
+    """
+    Queues (chat_id, texts) messages of one run of a job. The dedup key is job, run and
+    chat, so enqueueing the same run again (a retry, a second scheduler) adds nothing.
+    Returns how many messages were added, None on errors.
+    """
+    added = await db.enqueue_messages(
+        [(f"{job}:{run:%Y%m%d%H%M}:{chat_id}", chat_id, texts) for chat_id, texts in messages if texts]
+    )
+    if added:
+        _wakeup.set()
+    logging.info(f"Enqueued {added} of {len(messages)} {job} messages")
+    return added
+
+
+def _result(delivery: Delivery) -> tuple[int, str, int, str | None, float | None]:
+    if delivery.outcome == "delivered":
+        return delivery.key, "sent", delivery.sent, None, None
+    if delivery.outcome in ("failed", "skipped"):
+        return delivery.key, "failed", delivery.sent, delivery.error, None
+    # Deferred by a flood wait, or interrupted by a shutdown: due again later
+    return delivery.key, "pending", delivery.sent, delivery.error, float(delivery.retry_after)
+
+
+async def _send_batch(bot: Bot, rows: list[tuple[int, int, list[str], int]]):
+    deliveries = [
+        Delivery(chat_id, texts=texts, sent=sent_parts, key=message_id)
+        for message_id, chat_id, texts, sent_parts in rows
+    ]
+    try:
+        await deliver_all("outbox", bot, deliveries, defer_flood_waits=True, parse_mode='HTML')
+    finally:
+        # Also on shutdown, so the parts already sent are not sent again
+        await asyncio.shield(db.finish_outbox([_result(delivery) for delivery in deliveries]))
+
+
+async def run_sender(bot: Bot):
+    """Delivers the outbox until cancelled."""
+    logging.info("Outbox sender started")
+    while True:
+        _wakeup.clear()
+        try:
+            rows = await db.claim_outbox(OUTBOX_BATCH, OUTBOX_LEASE)
+            if rows:
+                await _send_batch(bot, rows)
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Outbox sender error: {e}")
+
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(_wakeup.wait(), OUTBOX_POLL)
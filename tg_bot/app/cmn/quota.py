@@ -0,0 +1,91 @@
+import os
+import time
+import logging
+from datetime import datetime, timedelta, date
+
+import app.data.storage as db
+from app.data.cache import TTLCache
+
+
+# Entries (expenses and incomes) a user can save per local day
+DAILY_ENTRY_LIMIT = int(os.getenv('DAILY_ENTRY_LIMIT', 50))
+# Short bursts: QUOTA_BURST requests at once, then one every 1 / QUOTA_REFILL_PER_SEC seconds
+QUOTA_BURST = float(os.getenv('QUOTA_BURST', 5))
+QUOTA_REFILL_PER_SEC = float(os.getenv('QUOTA_REFILL_PER_SEC', 0.5))
+QUOTA_CACHE_SIZE = int(os.getenv('QUOTA_CACHE_SIZE', 50_000))
+
+# tg_user_id -> [local_day, entries_count, time_utc]
+_day_counts = TTLCache("quota_day_counts", QUOTA_CACHE_SIZE, ttl=2 * 24 * 3600)
+# tg_user_id -> TokenBucket, an idle bucket is full again long before it expires
+_buckets = TTLCache("quota_buckets", QUOTA_CACHE_SIZE, ttl=600)
+
+
+class TokenBucket:
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def _local_day(time_utc: timedelta) -> date:
+    return (datetime.utcnow() + time_utc).date()
+
+
+def allow_burst(tg_user_id: int) -> bool:
+    bucket = _buckets.get(tg_user_id)
+    if bucket is None:
+        bucket = TokenBucket(QUOTA_BURST, QUOTA_REFILL_PER_SEC)
+        _buckets.set(tg_user_id, bucket)
+    return bucket.take()
+
+
+async def entries_today(tg_user_id: int) -> int | None:
+    """
+    How many entries the user saved today (local time). Served from memory,
+    the database is only asked once per user and local day.
+    Returns None if the user is not registered.
+    """
+    entry = _day_counts.get(tg_user_id)
+    if entry is not None and entry[0] == _local_day(entry[2]):
+        return entry[1]
+
+    user = await db.get_user_identity(tg_user_id)
+    if user is None:
+        return None
+
+    version = _day_counts.version
+    count = await db.get_todays_expense_count(tg_user_id)
+    _day_counts.set(tg_user_id, [_local_day(user["time_utc"]), count, user["time_utc"]], version)
+    logging.info(f"Seeded daily quota of {tg_user_id}: {count}/{DAILY_ENTRY_LIMIT}")
+    return count
+
+
+def is_over_limit(count: int | None) -> bool:
+    return count is not None and count >= DAILY_ENTRY_LIMIT
+
+
+def record_entry(tg_user_id: int):
+    """Call after an entry was saved. Also drops a seed that is still being loaded."""
+    def increment(entry):
+        if entry[0] == _local_day(entry[2]):
+            entry[1] += 1
+        return entry
+
+    _day_counts.update(tg_user_id, increment)
+
+
+def forget(tg_user_id: int):
+    """Drop the counter, e.g. after the user changed their time zone."""
+    _day_counts.pop(tg_user_id)
@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
+
+
+# Users are stored with an IANA time zone (users.time_zone); users.time_utc is the
+# zone's current offset, refreshed by the scheduler, see refresh_zone_offsets.
+MIN_OFFSET = timedelta(hours=-12)
+MAX_OFFSET = timedelta(hours=14)
+# The scheduler ticks every 15 minutes and every offset in use is a multiple of it
+TICK = timedelta(minutes=15)
+DAY = timedelta(days=1)
+
+# A zone for each offset that is not a whole hour, tried in this order.
+# Whole hours map to the fixed Etc/GMT zones: an offset alone does not tell which
+# country, and so which daylight saving rules, the user is in. Guessing one would
+# move the reminders of users whose region does not switch; users whose region
+# does are told to send their zone name instead (see is_fixed_offset).
+FRACTIONAL_ZONES = (
+    "Asia/Kolkata",         # +5:30
+    "Asia/Kathmandu",       # +5:45
+    "Asia/Tehran",          # +3:30
+    "Asia/Kabul",           # +4:30
+    "Asia/Yangon",          # +6:30
+    "Australia/Eucla",      # +8:45
+    "Australia/Darwin",     # +9:30
+    "Australia/Adelaide",   # +9:30 / +10:30
+    "Australia/Lord_Howe",  # +10:30 / +11
+    "Pacific/Chatham",      # +12:45 / +13:45
+    "America/St_Johns",     # -3:30 / -2:30
+    "Pacific/Marquesas",    # -9:30
+)
+
+
+@lru_cache(maxsize=1)
+def _zone_names() -> dict[str, str]:
+    return {name.lower(): name for name in available_timezones()}
+
+
+def resolve_zone(text: str) -> str | None:
+    """The IANA zone named by text ("asia/tashkent", "Asia/Tashkent"), or None."""
+    return _zone_names().get(text.strip().replace(" ", "_").lower())
+
+
+def current_offset(time_zone: str, at: datetime | None = None) -> timedelta:
+    """UTC offset of the zone at `at` (a UTC datetime, naive or aware), now by default."""
+    if at is None:
+        at = datetime.now(timezone.utc)
+    elif at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    try:
+        return at.astimezone(ZoneInfo(time_zone)).utcoffset()
+    except (ZoneInfoNotFoundError, ValueError):
+        return timedelta(0)
+
+
+def round_offset(offset: timedelta) -> timedelta:
+    """The offset between a typed local clock and UTC, rounded to the nearest 15 minutes."""
+    return round(offset / TICK) * TICK
+
+
+def zone_for_offset(offset: timedelta, at: datetime | None = None) -> str | None:
+    """A zone whose current offset is `offset`, or None if no zone uses it."""
+    if not MIN_OFFSET <= offset <= MAX_OFFSET:
+        return None
+    if offset % timedelta(hours=1) == timedelta(0):
+        hours = offset // timedelta(hours=1)
+        # POSIX sign convention: Etc/GMT-5 is UTC+5
+        return "Etc/UTC" if hours == 0 else f"Etc/GMT{-hours:+d}"
+    for time_zone in FRACTIONAL_ZONES:
+        if current_offset(time_zone, at) == offset:
+            return time_zone
+    return None
+
+
+def is_fixed_offset(time_zone: str) -> bool:
+    """True for the Etc zones, whose offset never changes (no daylight saving time)."""
+    return time_zone.startswith("Etc/")
+
+
+def quarter_tick(now: datetime | None = None) -> datetime:
+    """The 15-minute boundary the scheduler run belongs to (naive UTC), even if it started late."""
+    now = now or datetime.utcnow()
+    return now.replace(minute=now.minute - now.minute % 15, second=0, microsecond=0)
+
+
+def due_offsets(target_hour: int, target_minute: int, now: datetime | None = None) -> list[timedelta]:
+    """
+    UTC offsets whose local time is target_hour:target_minute at the current tick.
+    Offsets span 26 hours, so near the date line two offsets can be due at once.
+    """
+    tick = quarter_tick(now)
+    base = tick.replace(hour=target_hour, minute=target_minute) - tick
+    return [offset for offset in (base - DAY, base, base + DAY) if MIN_OFFSET <= offset <= MAX_OFFSET]
@@ -0,0 +1,107 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+_caches: dict[str, "TTLCache"] = {}
+
+
+class TTLCache:
+    """
+    In-process LRU cache whose entries also expire after `ttl` seconds.
+
+    Loaders should read `version` before going to the database and pass it
+    to `set`, so a value fetched before an invalidation is not stored after it.
+    """
+
+    def __init__(self, name: str, maxsize: int = 10_000, ttl: float = 300.0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        _caches[name] = self
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Like get, but without touching LRU order or the hit/miss counters."""
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return default
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, version: int | None = None) -> None:
+        if version is not None and version != self.version:
+            # Invalidated while the value was being loaded
+            return
+
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def update(self, key: Hashable, func) -> None:
+        """
+        Write-through: replace a cached value with func(value) instead of dropping it.
+        Does nothing if the key is not cached.
+        """
+        self.version += 1
+        value = self.peek(key)
+        if value is not None:
+            self.set(key, func(value))
+
+    def pop(self, key: Hashable) -> None:
+        self.version += 1
+        self.invalidations += 1
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self.version += 1
+        self.invalidations += 1
+        self._data.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+def get_cache_stats() -> dict[str, dict[str, int]]:
+    return {name: cache.stats() for name, cache in _caches.items()}
+
+
+def format_cache_stats() -> str:
+    """Text table of get_cache_stats() with the hit ratio of every cache."""
+    lines = [f"{'cache':<20} {'size':>8} {'hits':>10} {'misses':>10} {'hit %':>6} {'evictions':>10} {'invalidations':>14}"]
+    for name, s in sorted(get_cache_stats().items()):
+        lookups = s["hits"] + s["misses"]
+        ratio = 100 * s["hits"] / lookups if lookups else 0.0
+        lines.append(
+            f"{name:<20} {s['size']:>8} {s['hits']:>10} {s['misses']:>10} {ratio:>6.1f} "
+            f"{s['evictions']:>10} {s['invalidations']:>14}"
+        )
+    return "\n".join(lines)
@@ -1,10 +1,19 @@
 import psycopg
 from psycopg import sql, Error, AsyncConnection
+from psycopg_pool import AsyncConnectionPool
+import asyncio
 import logging
+import time
 import app.cmn.transtalor as translator
-from typing import Optional, Tuple, List, Dict
-from datetime import datetime, timedelta, timezone
+import app.cmn.zones as zones
+from contextlib import asynccontextmanager, suppress
+from typing import Optional, Tuple, List, Dict, AsyncIterator
+from weakref import WeakKeyDictionary
+from datetime import date, datetime, timedelta, timezone
 from psycopg.rows import dict_row
+from app.data.cache import TTLCache
+from app.data.metrics import instrumented, InstrumentedCursor
+from app.data.suggestions import AmountStats, RecentValues, RANKINGS, RECENT
 import os
 
 
@@ -15,271 +24,524 @@ THISHOST = os.getenv('HOST')
 THISPORT = os.getenv('PORT')
 THISDBNAME = os.getenv('DB_NAME')
 
-async def get_db_connection():
-    # logging.info(f"Connected to PostgreSQL database at {THISHOST}:{THISPORT}/{THISDBNAME} as user {THISUSER}")
-
-    conn = await psycopg.AsyncConnection.connect(
-        user=THISUSER,
-        password=THISPASSWORD,
-        host=THISHOST,
-        port=THISPORT,
-        dbname=THISDBNAME
+# Workloads get their own sub-pool so the hourly rollups in automatik.py
+# can never take the connections interactive handlers are waiting for.
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+# Ledger exports read for a long time, their pool size caps how many run at once
+EXPORT = "export"
+
+POOL_SIZES = {
+    INTERACTIVE: (int(os.getenv('DB_POOL_MIN', 2)), int(os.getenv('DB_POOL_MAX', 10))),
+    BACKGROUND: (int(os.getenv('DB_BG_POOL_MIN', 1)), int(os.getenv('DB_BG_POOL_MAX', 3))),
+    EXPORT: (1, int(os.getenv('DB_EXPORT_POOL_MAX', 2))),
+}
+POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))      # seconds to wait for a free connection
+POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE', 300))   # idle connections above min_size are closed
+POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', 3600))  # connections are recycled after this
+# PgBouncer in transaction mode cannot keep server-side prepared statements
+PGBOUNCER_MODE = os.getenv('DB_PGBOUNCER', '0') == '1'
+
+# Optional streaming replica for read-only queries, see get_read_connection.
+# It is only used while it is at most DB_REPLICA_MAX_LAG seconds behind the primary.
+REPLICA = "replica"
+REPLICA_DSN = os.getenv('DB_REPLICA_DSN')
+REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', 5))
+REPLICA_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', 5))
+REPLICA_POOL_SIZE = (int(os.getenv('DB_REPLICA_POOL_MIN', 1)), int(os.getenv('DB_REPLICA_POOL_MAX', 10)))
+
+_pools: dict[str, AsyncConnectionPool] = {}
+_pools_lock: asyncio.Lock | None = None
+
+
+def _connection_kwargs(replica: bool = False) -> dict:
+    # client_encoding goes into the startup packet, no extra SET round trip
+    kwargs = {"client_encoding": "UTF8", "cursor_factory": InstrumentedCursor}
+    if not replica:
+        # The replica takes everything from DB_REPLICA_DSN
+        kwargs.update({
+            "user": THISUSER,
+            "password": THISPASSWORD,
+            "host": THISHOST,
+            "port": THISPORT,
+            "dbname": THISDBNAME,
+        })
+    if PGBOUNCER_MODE:
+        # Also disable psycopg's automatic preparation of repeated queries
+        kwargs["prepare_threshold"] = None
+    return kwargs
+
+
+def _get_pools_lock() -> asyncio.Lock:
+    global _pools_lock
+    if _pools_lock is None:
+        _pools_lock = asyncio.Lock()
+    return _pools_lock
+
+
+async def _open_pool(workload: str):
+    """Open the workload's pool; the caller holds the pools lock."""
+    replica = workload == REPLICA
+    min_size, max_size = REPLICA_POOL_SIZE if replica else POOL_SIZES[workload]
+    pool = AsyncConnectionPool(
+        conninfo=REPLICA_DSN if replica else "",
+        kwargs=_connection_kwargs(replica),
+        min_size=min_size,
+        max_size=max_size,
+        timeout=POOL_TIMEOUT,
+        max_idle=POOL_MAX_IDLE,
+        max_lifetime=POOL_MAX_LIFETIME,
+        check=AsyncConnectionPool.check_connection,
+        name=f"tg_bot-{workload}",
+        open=False,
     )
+    try:
+        await pool.open(wait=True, timeout=POOL_TIMEOUT)
+    except Exception:
+        await pool.close()
+        raise
+    _pools[workload] = pool
+    target = "replica" if replica else f"{THISHOST}:{THISPORT}/{THISDBNAME}"
+    logging.info(f"Opened {workload} pool to {target} (min={min_size}, max={max_size})")
 
-    
-    # Set client encoding to UTF-8
-    async with conn.cursor() as cursor:
-        await cursor.execute("SET client_encoding TO 'UTF8'")
-    
-    return conn
 
+async def open_pools():
+    """
+    Open one pool per workload and wait until min_size connections are ready,
+    so the first requests after startup do not pay for the handshakes.
+    An unreachable replica does not stop startup, reads then go to the primary.
+    """
+    async with _get_pools_lock():
+        for workload in POOL_SIZES:
+            if workload not in _pools:
+                await _open_pool(workload)
+
+    await _replica_usable()
+
+
+async def close_pools():
+    for workload in list(_pools):
+        pool = _pools.pop(workload)
+        await pool.close()
+        logging.info(f"Closed {workload} pool")
+
+
+@asynccontextmanager
+async def get_db_connection(workload: str = INTERACTIVE) -> AsyncIterator[AsyncConnection]:
+    """
+    Borrow a connection from the workload's pool.
+    The transaction is committed when the block exits normally and rolled back on error.
+    """
+    if workload not in _pools:
+        await open_pools()
+
+    async with _pools[workload].connection() as conn:
+        yield conn
+
+
+async def get_direct_connection(autocommit: bool = False) -> AsyncConnection:
+    """
+    A connection outside the pools, for migrations and other one-off admin work.
+    The caller is responsible for closing it.
+    """
+    return await psycopg.AsyncConnection.connect(**_connection_kwargs(), autocommit=autocommit)
+
+
+def get_pool_stats() -> dict[str, dict]:
+    return {workload: pool.get_stats() for workload, pool in _pools.items()}
+
+
+_replica_state = {"usable": False, "lag": None, "checked_at": None}
+
+
+async def _replica_usable() -> bool:
+    """
+    Whether reads may go to the replica. Replication lag is measured at most
+    once per REPLICA_CHECK_INTERVAL; a replica that is down or lagging is
+    retried on the next check.
+    """
+    if not REPLICA_DSN:
+        return False
 
+    now = time.monotonic()
+    checked_at = _replica_state["checked_at"]
+    if checked_at is not None and now - checked_at < REPLICA_CHECK_INTERVAL:
+        return _replica_state["usable"]
+    _replica_state["checked_at"] = now
 
-async def get_todays_dengies(user_id: int):
-    connection = None
+    lag = None
     try:
-        connection = await get_db_connection()
-        async with connection.cursor() as cursor:
-            await cursor.execute(
+        if REPLICA not in _pools:
+            async with _get_pools_lock():
+                if REPLICA not in _pools:
+                    await _open_pool(REPLICA)
+
+        async with _pools[REPLICA].connection() as conn:
+            # An idle primary sends no new transactions, so an up-to-date replica counts as no lag
+            cursor = await conn.execute(
+                """
+                SELECT CASE
+                    WHEN NOT pg_is_in_recovery() THEN 0
+                    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+                END;
                 """
-                    SELECT 
-                        d.amount,
-                        c.title AS category_name,
-                        d.comment_text,
-                        to_char(d.created_date, 'HH24:MI') AS created_time,
-                        u.currency_is               -- ⬅ added currency
-                    FROM dengies d
-                    JOIN categories c ON d.category_id = c.id
-                    JOIN users u ON d.user_id = u.id
-                    WHERE 
-                        u.tg_user_id = %s
-                        AND c.is_ex = TRUE
-                        AND date_trunc('day', d.created_date) = 
-                            date_trunc('day', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc)
-                    ORDER BY d.created_date DESC;
-                """,
-                (user_id,)
             )
+            row = await cursor.fetchone()
+            lag = float(row[0]) if row and row[0] is not None else None
 
-            rows = await cursor.fetchall()
-            logging.info(f"Fetched {len(rows)} records for user_id={user_id}")
-            return rows  # now each row has 5 values
+    except Exception as e:
+        logging.warning(f"Replica is not reachable: {e}")
 
-    except (Exception, Error) as error:
-        logging.error("Error while fetching today's dengies: %s", error)
-        return []
+    usable = lag is not None and lag <= REPLICA_MAX_LAG
+    if usable != _replica_state["usable"]:
+        logging.info(f"Replica {'enabled' if usable else 'disabled'} for reads (lag: {lag})")
+    _replica_state["usable"] = usable
+    _replica_state["lag"] = lag
+    return usable
 
-    finally:
-        if connection is not None:
-            await connection.close()
 
+def get_replica_status() -> dict:
+    return {"configured": bool(REPLICA_DSN), "usable": _replica_state["usable"], "lag": _replica_state["lag"]}
 
-async def insert_daily_category_reports(tg_user_ids: list[int]):
+
+@asynccontextmanager
+async def get_read_connection(workload: str = INTERACTIVE) -> AsyncIterator[AsyncConnection]:
     """
-    Aggregate today's expenses per category for each user (using tg_user_id)
-    and insert into daily_category_reports.
-    month_id is NULL.
-    created_date is set to (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc
+    Borrow a connection for read-only queries: from the replica while it is
+    reachable and no more than REPLICA_MAX_LAG seconds behind, otherwise from
+    the workload's primary pool. The transaction is always rolled back, so
+    nothing written here is committed on either.
+
+    Reads that must see a write made just before (in the same request or
+    scheduler job) use get_db_connection instead: the replica may not have
+    replayed it yet.
     """
-    connection = None
-    try:
-        connection = await get_db_connection()
-        async with connection.cursor() as cursor:
-            
-            for tg_user_id in tg_user_ids:
-                # Aggregate total amount per category for today for this tg_user_id
-                await cursor.execute(
-                    """
-                    SELECT 
-                        d.category_id,
-                        SUM(d.amount) AS total_amount,
-                        u.id AS user_id,
-                        u.time_utc
-                    FROM dengies d
-                    JOIN users u ON d.user_id = u.id
-                    WHERE 
-                        u.tg_user_id = %s
-                        AND date_trunc('day', d.created_date) = 
-                            date_trunc('day', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc)
-                    GROUP BY d.category_id, u.id, u.time_utc;
-                    """,
-                    (tg_user_id,)
-                )
-                
-                aggregated_rows = await cursor.fetchall()
-                
-                # Insert aggregated totals into daily_category_reports
-                for category_id, total_amount, user_id, time_utc in aggregated_rows:
-                    await cursor.execute(
-                        """
-                        INSERT INTO daily_category_reports (
-                            user_id, category_id, month_id, total_amount, created_date
-                        )
-                        VALUES (%s, %s, NULL, %s, date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + %s);
-                        """,
-                        (user_id, category_id, total_amount, time_utc)
-                    )
-            
-            await connection.commit()
-            logging.info("Daily category reports inserted successfully for tg_user_ids.")
+    if await _replica_usable():
+        pool = _pools[REPLICA]
+        try:
+            conn = await pool.getconn()
+        except Exception as e:
+            logging.warning(f"No replica connection, reading from the primary: {e}")
+            _replica_state["usable"] = False
+        else:
+            try:
+                yield conn
+            finally:
+                # A broken connection is discarded by putconn anyway
+                with suppress(Exception):
+                    await conn.rollback()
+                await pool.putconn(conn)
+            return
+
+    async with get_db_connection(workload) as conn:
+        try:
+            yield conn
+        finally:
+            with suppress(Exception):
+                await conn.rollback()
+
+
+# Pipeline mode: statements run on the connection are queued and sent together,
+# the client only waits for the server when a result is fetched or the block ends.
+# Later statements still see the effects of earlier ones, so a dependent step can
+# be written as SQL conditioned on the earlier one instead of a round trip.
+@asynccontextmanager
+async def get_pipeline_connection(workload: str = INTERACTIVE) -> AsyncIterator[AsyncConnection]:
+    """
+    Like get_db_connection, in pipeline mode. Use one cursor per statement whose
+    result is needed; if a statement fails, the rest of the batch is skipped and
+    the whole transaction is rolled back.
+    """
+    async with get_db_connection(workload) as conn:
+        async with conn.pipeline():
+            yield conn
 
-    except (Exception, Error) as e:
-        logging.error("Error inserting daily category reports: %s", e)
-        if connection:
-            await connection.rollback()
-    
-    finally:
-        if connection is not None:
-            await connection.close()
+
+# Hot statements are registered by name and prepared server-side once per
+# pooled connection, see execute_prepared.
+PREPARED_STATEMENTS: dict[str, str] = {}
+_statement_calls: dict[str, int] = {}
+_statement_prepares: dict[str, int] = {}
+_prepared_on: "WeakKeyDictionary[AsyncConnection, set[str]]" = WeakKeyDictionary()
 
 
+def register_statement(name: str, query: str) -> str:
+    PREPARED_STATEMENTS[name] = query
+    _statement_calls.setdefault(name, 0)
+    _statement_prepares.setdefault(name, 0)
+    return name
 
-async def insert_daily_reports(tg_user_ids: list[int]):
+
+async def execute_prepared(cursor, name: str, params=None):
     """
-    Aggregate today's expenses and incomes for each user and insert
-    into the daily_reports table.
-    
-    created_date is set to: date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc
+    Execute a registered statement. The first call on a connection prepares it,
+    later calls on the same connection only bind and execute.
     """
-    connection = None
-    try:
-        connection = await get_db_connection()
-        async with connection.cursor() as cursor:
-
-            for tg_user_id in tg_user_ids:
-
-                # Aggregate today's totals grouped by expense/income type
-                await cursor.execute(
-                    """
-                    SELECT
-                        u.id AS user_id,
-                        u.time_utc,
-                        SUM(d.amount) AS total_amount,
-                        CASE 
-                            WHEN c.is_ex THEN TRUE
-                            ELSE FALSE
-                        END AS is_ex
-                    FROM dengies d
-                    JOIN users u ON d.user_id = u.id
-                    JOIN categories c ON c.id = d.category_id
-                    WHERE u.tg_user_id = %s
-                        AND date_trunc('day', d.created_date) =
-                            date_trunc('day', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc)
-                    GROUP BY u.id, u.time_utc, is_ex;
-                    """,
-                    (tg_user_id,)
-                )
+    query = PREPARED_STATEMENTS[name]
+    _statement_calls[name] += 1
 
-                aggregated_rows = await cursor.fetchall()
+    if PGBOUNCER_MODE:
+        return await cursor.execute(query, params, prepare=False)
 
-                # Insert aggregated totals into daily_reports
-                for user_id, time_utc, total_amount, is_ex in aggregated_rows:
-                    await cursor.execute(
-                        """
-                        INSERT INTO daily_reports (
-                            user_id, total_amount, is_ex, created_date
-                        )
-                        VALUES (%s, %s, %s, date_trunc('second', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + %s));
-                        """,
-                        (user_id, total_amount, is_ex, time_utc)
-                    )
+    seen = _prepared_on.setdefault(cursor.connection, set())
+    if name not in seen:
+        seen.add(name)
+        _statement_prepares[name] += 1
+    return await cursor.execute(query, params, prepare=True)
 
-            await connection.commit()
-            logging.info("Daily reports inserted successfully for tg_user_ids.")
 
-    except Exception as e:
-        logging.error(f"Error inserting daily reports: {e}")
-        if connection:
-            await connection.rollback()
+def get_statement_stats() -> dict[str, dict[str, int]]:
+    """
+    Per-statement counters: calls vs. how many times it had to be prepared.
+    calls - prepares is the number of parse/plan cycles saved.
+    """
+    return {
+        name: {"calls": _statement_calls[name], "prepares": _statement_prepares[name]}
+        for name in PREPARED_STATEMENTS
+    }
+
 
-    finally:
-        if connection is not None:
-            await connection.close()
 
+# Identity record of a user, cached so hot queries can use users.id directly
+# instead of resolving tg_user_id in every statement. The bot only writes is_premium's
+# default (insert_or_update_user); a change made outside it shows once the entry expires.
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10_000))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 300))
 
+_user_cache = TTLCache("user_identity", USER_CACHE_SIZE, USER_CACHE_TTL)
 
-async def minus_user_balance(user_id: int, amount: float) -> float | None:
+register_statement(
+    "user_identity",
     """
-    Atomically subtracts the given amount from the user's balance if sufficient funds exist.
-    Returns the new balance, or None if insufficient funds or user not found.
+    SELECT id, time_utc, language_is, is_premium, currency_is
+    FROM users
+    WHERE tg_user_id = %s
+    LIMIT 1;
     """
-    conn = None
-    try:
-        conn = await get_db_connection()
-        async with conn.cursor() as cur:
-            # Perform subtraction only if enough balance exists
-            await cur.execute(
-                """
-                UPDATE users
-                SET balans = balans - %s
-                WHERE tg_user_id = %s AND balans >= %s
-                RETURNING balans;
-                """,
-                (amount, user_id, amount)
-            )
+)
 
-            result = await cur.fetchone()
-            await conn.commit()
 
-            if result:
-                # Successfully updated and returned new balance
-                return result[0]
-            else:
-                # Either user not found or insufficient funds
-                logging.warning(
-                    f"Insufficient funds or user not found: user_id={user_id}, amount={amount}"
-                )
-                return None
+@instrumented
+async def get_user_identity(tg_user_id: int) -> dict | None:
+    """
+    Returns {id, time_utc, language_is, is_premium, currency_is} for a Telegram user,
+    or None if the user is not registered. The returned dict is shared, do not modify it.
+    """
+    user = _user_cache.get(tg_user_id)
+    if user is not None:
+        return user
+
+    version = _user_cache.version
+    try:
+        async with get_db_connection() as conn, conn.cursor(row_factory=dict_row) as cur:
+            await execute_prepared(cur, "user_identity", (tg_user_id,))
+            user = await cur.fetchone()
 
     except Exception as e:
-        logging.error(f"Failed to minus balance for user_id={user_id}: {e}")
+        logging.error(f"Error fetching identity for tg_user_id {tg_user_id}: {e}")
         return None
 
-    finally:
-        if conn:
-            await conn.close()
+    if user is not None:
+        _user_cache.set(tg_user_id, user, version)
+    return user
+
 
+# Active categories per (tg_user_id, is_ex) together with max_count.
+# Category writes below update the cached list in place.
+CATEGORY_CACHE_SIZE = int(os.getenv('CATEGORY_CACHE_SIZE', 20_000))
+CATEGORY_CACHE_TTL = float(os.getenv('CATEGORY_CACHE_TTL', 3600))
+
+_category_cache = TTLCache("categories", CATEGORY_CACHE_SIZE, CATEGORY_CACHE_TTL)
+
+
+def invalidate_user(tg_user_id: int):
+    _user_cache.pop(tg_user_id)
+    # max_count depends on is_premium
+    _category_cache.pop((tg_user_id, True))
+    _category_cache.pop((tg_user_id, False))
+
+
+def _cache_add_category(tg_user_id: int, is_ex: bool, category_id: int, title: str):
+    _category_cache.update(
+        (tg_user_id, is_ex),
+        lambda cached: (cached[0] + [(category_id, title)], cached[1])
+    )
 
 
-async def get_category_name(cat_id: int) -> str | None:
-    connection = None
+def _cache_remove_category(tg_user_id: int, is_ex: bool, category_id: int):
+    _category_cache.update(
+        (tg_user_id, is_ex),
+        lambda cached: ([row for row in cached[0] if row[0] != category_id], cached[1])
+    )
+
+
+
+register_statement(
+    "todays_dengies_for_users",
+    """
+    SELECT
+        u.tg_user_id,
+        d.amount,
+        d.category_name,
+        d.comment_text,
+        d.created_time,
+        u.currency_is
+    FROM users u
+    CROSS JOIN LATERAL (
+        SELECT
+            d.amount,
+            c.title AS category_name,
+            d.comment_text,
+            to_char(d.created_date, 'HH24:MI') AS created_time,
+            d.created_date
+        FROM dengies d
+        JOIN categories c ON d.category_id = c.id
+        WHERE
+            d.user_id = u.id
+            AND c.is_ex = TRUE
+            AND d.created_date >= date_trunc('day', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc) - make_interval(days => %(days_ago)s::int)
+            AND d.created_date < date_trunc('day', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc) - make_interval(days => %(days_ago)s::int - 1)
+        ORDER BY d.created_date DESC
+        LIMIT %(per_user_limit)s
+    ) d
+    WHERE u.tg_user_id = ANY(%(tg_user_ids)s)
+    ORDER BY u.tg_user_id, d.created_date DESC;
+    """
+)
+
+
+@instrumented
+async def get_todays_dengies_for_users(tg_user_ids: list[int], per_user_limit: int | None = None, days_ago: int = 0) -> dict[int, list[tuple]] | None:
+    """
+    Today's expenses of many users in one query: {tg_user_id: rows} of (amount,
+    category_name, comment_text, created_time, currency_is), latest first, for the
+    users that have any. With per_user_limit only that many of the latest rows per
+    user; with days_ago the rows of that many local days before today.
+    Pass the users in chunks.
+    Read from the primary, like every scheduler read that follows its writes.
+    Returns None on errors.
+    """
     try:
-        connection = await get_db_connection()
-        async with connection.cursor() as cursor:
-            await cursor.execute(
-                "SELECT title FROM categories WHERE id = %s LIMIT 1;", (cat_id,)
+        async with get_db_connection(BACKGROUND) as connection, connection.cursor() as cursor:
+            await execute_prepared(
+                cursor,
+                "todays_dengies_for_users",
+                {"tg_user_ids": tg_user_ids, "per_user_limit": per_user_limit, "days_ago": days_ago}
             )
-            result = await cursor.fetchone()
-            if result:
-                return result[0]  # language_is
-            return None
+
+            rows_by_user: dict[int, list[tuple]] = {}
+            async for row in cursor:
+                rows_by_user.setdefault(row[0], []).append(row[1:])
 
     except (Exception, Error) as error:
-        logging.error("Error while fetching user language: %s", error)
+        logging.error("Error while fetching today's dengies of %s users: %s", len(tg_user_ids), error)
         return None
 
-    finally:
-        if connection is not None:
-            await connection.close()
+    logging.info(f"Fetched today's records of {len(rows_by_user)}/{len(tg_user_ids)} users")
+    return rows_by_user
+
+
+register_statement(
+    "daily_digests",
+    """
+    SELECT
+        u.tg_user_id,
+        u.currency_is,
+        dr.total_amount,
+        COALESCE(t.entries_count, 0),
+        c.title,
+        dcr.total_amount
+    FROM users u
+    CROSS JOIN LATERAL (
+        SELECT ((CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc)::date - %(days_ago)s::int AS day
+    ) digest
+    JOIN daily_reports dr
+        ON dr.user_id = u.id
+        AND dr.period_start = digest.day
+        AND dr.is_ex = TRUE
+    JOIN daily_category_reports dcr
+        ON dcr.user_id = u.id
+        AND dcr.period_start = digest.day
+    JOIN categories c ON c.id = dcr.category_id AND c.is_ex = TRUE
+    LEFT JOIN user_day_totals t
+        ON t.user_id = u.id
+        AND t.local_day = digest.day
+        AND t.is_ex = TRUE
+    WHERE u.tg_user_id = ANY(%(tg_user_ids)s)
+    ORDER BY u.tg_user_id, dcr.total_amount DESC, c.title;
+    """
+)
 
 
+@instrumented
+async def get_daily_digests(tg_user_ids: list[int], days_ago: int = 0) -> dict[int, dict] | None:
+    """
+    The expense summary of each user's local day, today or days_ago days before it,
+    from the daily rollups (daily_reports, daily_category_reports) and the day's entry
+    count, in one query:
+    {tg_user_id: {currency, total, entries, categories: [(title, amount)]}},
+    largest category first. Users without expenses that day are left out.
+    Run after the day's rollups; read from the primary, the replica may not have
+    replayed them yet. Returns None on errors.
+    """
+    try:
+        async with get_db_connection(BACKGROUND) as connection, connection.cursor() as cursor:
+            await execute_prepared(cursor, "daily_digests", {"tg_user_ids": tg_user_ids, "days_ago": days_ago})
+
+            digests: dict[int, dict] = {}
+            async for tg_user_id, currency, total, entries, title, amount in cursor:
+                digest = digests.get(tg_user_id)
+                if digest is None:
+                    digest = digests[tg_user_id] = {
+                        "currency": currency,
+                        "total": total,
+                        "entries": entries,
+                        "categories": [],
+                    }
+                digest["categories"].append((title, amount))
+
+    except (Exception, Error) as error:
+        logging.error("Error while fetching daily digests of %s users: %s", len(tg_user_ids), error)
+        return None
+
+    return digests
+
+ROLLUP_CHUNK_SIZE = int(os.getenv('ROLLUP_CHUNK_SIZE', 1000))
+
+
+def _chunks(items: list, size: int = ROLLUP_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+
+register_statement(
+    "todays_expense_count",
+    """
+    SELECT COALESCE(SUM(entries_count), 0)
+    FROM user_day_totals
+    WHERE user_id = %(user_id)s
+      AND local_day = ((CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + %(time_utc)s::interval)::date;
+    """
+)
+
+
+@instrumented
 async def get_todays_expense_count(tg_user_id: int):
     """
     Returns how many expenses the user made today according to their local time (created_date is already in local time).
     """
-    connection = None
+    user = await get_user_identity(tg_user_id)
+    if user is None:
+        return 0
+
     try:
-        connection = await get_db_connection()
-        async with connection.cursor() as cursor:
-            await cursor.execute(
-                """
-                    SELECT COUNT(*)
-                    FROM dengies d
-                    JOIN users u ON d.user_id = u.id
-                    WHERE u.tg_user_id = %s
-                    AND d.created_date::date = (CURRENT_TIMESTAMP AT TIME ZONE 'UTC' + u.time_utc::interval)::date;
-                """,
-                (tg_user_id,)
+        async with get_db_connection() as connection, connection.cursor() as cursor:
+            await execute_prepared(
+                cursor,
+                "todays_expense_count",
+                {"user_id": user["id"], "time_utc": user["time_utc"]}
             )
             result = await cursor.fetchone()
             return result[0] if result else 0
@@ -288,11 +550,39 @@ async def get_todays_expense_count(tg_user_id: int):
         logging.error(f"Error fetching today's expense count for {tg_user_id}: {e}")
         return 0
 
-    finally:
-        if connection is not None:
-            await connection.close()
 
 
+register_statement(
+    "infos_get_user",
+    """
+    SELECT 
+        u.balans,
+        u.currency_is,
+        u.language_is AS lang_code,
+        u.is_premium,
+        TO_CHAR(u.premium_date, 'YYYY-MM-DD') AS premium_date,
+
+        -- Month-to-date totals (local month), today's entries included
+        COALESCE(m.monthly_expenses, 0) AS monthly_expenses,
+        COALESCE(m.monthly_income, 0) AS monthly_income
+
+    FROM users u
+    LEFT JOIN LATERAL (
+        SELECT
+            SUM(t.total_amount) FILTER (WHERE t.is_ex) AS monthly_expenses,
+            SUM(t.total_amount) FILTER (WHERE NOT t.is_ex) AS monthly_income
+        FROM user_day_totals t
+        WHERE t.user_id = u.id
+          AND t.local_day >= DATE_TRUNC('month', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc)::date
+          AND t.local_day < (DATE_TRUNC('month', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc) + INTERVAL '1 month')::date
+    ) m ON TRUE
+    WHERE u.tg_user_id = %s
+    LIMIT 1;
+    """
+)
+
+
+@instrumented
 async def infos_get_user(tg_user_id: int):
     """
     Returns user information including:
@@ -304,54 +594,12 @@ async def infos_get_user(tg_user_id: int):
     - monthly_expenses
     - monthly_income (using user's local time via time_utc)
     """
-    connection = None
     try:
-        connection = await get_db_connection()
-        async with connection.cursor() as cursor:
+        async with get_read_connection() as connection, connection.cursor() as cursor:
 
-            await cursor.execute(
-                """
-                    SELECT 
-                        u.balans,
-                        u.currency_is,
-                        u.language_is AS lang_code,
-                        u.is_premium,
-                        TO_CHAR(u.premium_date, 'YYYY-MM-DD') AS premium_date,
-
-                        -- Monthly expenses (local month)
-                        COALESCE((
-                            SELECT SUM(dr.total_amount)
-                            FROM daily_reports dr
-                            WHERE dr.user_id = u.id
-                              AND dr.is_ex = TRUE
-                              AND DATE_TRUNC(
-                                    'month',
-                                    dr.created_date
-                                  ) = DATE_TRUNC(
-                                    'month',
-                                    (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc::interval
-                                  )
-                        ), 0) AS monthly_expenses,
-
-                        -- Monthly income (local month)
-                        COALESCE((
-                            SELECT SUM(dr.total_amount)
-                            FROM daily_reports dr
-                            WHERE dr.user_id = u.id
-                              AND dr.is_ex = FALSE
-                              AND DATE_TRUNC(
-                                    'month',
-                                    dr.created_date
-                                  ) = DATE_TRUNC(
-                                    'month',
-                                    (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc::interval
-                                  )
-                        ), 0) AS monthly_income
-
-                    FROM users u
-                    WHERE u.tg_user_id = %s
-                    LIMIT 1;
-                """,
+            await execute_prepared(
+                cursor,
+                "infos_get_user",
                 (tg_user_id,)
             )
 
@@ -373,47 +621,30 @@ async def infos_get_user(tg_user_id: int):
         logging.error(f"Error fetching user data for tg_user_id {tg_user_id}: {e}")
         return None
 
-    finally:
-        if connection is not None:
-            await connection.close()
 
-async def get_users_by_time(target_hour: int, target_minute: int) -> list[tuple[int, str]] | None:
+register_statement(
+    "users_by_offsets",
     """
-    Return a list of (tg_user_id, language_is) of users whose local time
-    matches the target hour and minute by calculating the required time_utc.
+    SELECT u.tg_user_id, u.language_is
+    FROM zone_offsets z
+    JOIN users u ON u.time_zone = z.time_zone
+    WHERE z.utc_offset = ANY(%s::interval[]);
     """
-    connection = None
-    try:
-        now_utc = datetime.utcnow()
-
-        # Build target datetime today
-        target_time = now_utc.replace(hour=target_hour, minute=target_minute, second=0, microsecond=0)
-
-        # Shift to next day if target time is earlier than now
-        if target_time < now_utc:
-            target_time += timedelta(days=1)
-
-        # Compute required offset
-        offset: timedelta = target_time - now_utc
-
-        # Round to nearest minute to avoid second mismatches
-        total_seconds = int(round(offset.total_seconds() / 60) * 60)
-
-        hours, remainder = divmod(total_seconds, 3600)
-        minutes, seconds = divmod(remainder, 60)
-
-        # Format as PostgreSQL INTERVAL string
-        interval_str = f"{hours:02d}:{minutes:02d}:{seconds:02d}"  # 'HH:MM:SS'
+)
 
-        logging.info(f"Computed time_utc interval: {interval_str}")
 
-        connection = await get_db_connection()
-        async with connection.cursor() as cursor:
-            await cursor.execute("""
-                SELECT tg_user_id, language_is
-                FROM users
-                WHERE time_utc = CAST(%s AS INTERVAL);
-            """, (interval_str,))
+@instrumented
+async def get_users_by_time(target_hour: int, target_minute: int) -> list[tuple[int, str]] | None:
+    """
+    Return a list of (tg_user_id, language_is) of users whose local time is
+    target_hour:target_minute at the current 15-minute scheduler tick.
+    The zones due are looked up by their current offset in zone_offsets, read from
+    the primary: refresh_zone_offsets has just written them in the same tick.
+    """
+    offsets = zones.due_offsets(target_hour, target_minute)
+    try:
+        async with get_db_connection(BACKGROUND) as connection, connection.cursor() as cursor:
+            await execute_prepared(cursor, "users_by_offsets", (offsets,))
 
             rows = await cursor.fetchall()
             if not rows:
@@ -426,76 +657,261 @@ async def get_users_by_time(target_hour: int, target_minute: int) -> list[tuple[
         logging.error("Error fetching users by time: %s", error)
         return None
 
-    finally:
-        if connection is not None:
-            await connection.close()
 
+register_statement(
+    "zone_offsets",
+    """
+    SELECT time_zone, utc_offset
+    FROM zone_offsets;
+    """
+)
+
+register_statement(
+    "update_zone_offsets",
+    """
+    WITH changed AS (
+        UPDATE zone_offsets z
+        SET utc_offset = v.utc_offset,
+            refreshed_at = date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+        FROM unnest(%s::text[], %s::interval[]) AS v(time_zone, utc_offset)
+        WHERE z.time_zone = v.time_zone
+        RETURNING z.time_zone, z.utc_offset
+    )
+    UPDATE users u
+    SET time_utc = changed.utc_offset
+    FROM changed
+    WHERE u.time_zone = changed.time_zone;
+    """
+)
 
 
-async def get_last_amounts(category_id: int, user_id: int) -> list[int]:
-    connection = None
+@instrumented
+async def refresh_zone_offsets() -> int | None:
+    """
+    Recomputes the current offset of every zone in zone_offsets and, for the zones
+    whose offset changed (DST), updates it together with users.time_utc.
+    Run before each scheduler tick. Returns the number of zones changed.
+    """
     try:
-        connection = await get_db_connection()
-        async with connection.cursor() as cursor:
-            await cursor.execute(
-                """
-                SELECT amount, id
-                FROM (
-                    SELECT DISTINCT ON (amount) amount, id
-                    FROM dengies
-                    WHERE category_id = %s
-                    AND user_id = (SELECT id FROM users WHERE tg_user_id = %s)
-                    ORDER BY amount, id
-                ) AS distinct_amounts
-                ORDER BY id DESC
-                LIMIT 5;
-                """,
-                (category_id, user_id)
-            )
+        async with get_db_connection(BACKGROUND) as connection, connection.cursor() as cursor:
+            await execute_prepared(cursor, "zone_offsets")
             rows = await cursor.fetchall()
-            return [row[0] for row in rows]
 
-    except (Exception, Error) as error:
-        logging.error("Error while fetching last amounts: %s", error)
+            now = datetime.now(timezone.utc)
+            changed = {}
+            for time_zone, utc_offset in rows:
+                offset = zones.current_offset(time_zone, now)
+                if offset != utc_offset:
+                    changed[time_zone] = offset
+            if not changed:
+                return 0
+
+            await execute_prepared(cursor, "update_zone_offsets", (list(changed), list(changed.values())))
+            await connection.commit()
+
+    except Exception as error:
+        logging.error("Error refreshing zone offsets: %s", error)
         return None
 
-    finally:
-        if connection:
-            await connection.close()
+    logging.info(f"Zone offsets changed: {changed}")
+    # time_utc of cached identities is stale now
+    _user_cache.clear()
+    return len(changed)
+
+
+
+
+# Amount keyboard suggestions per (tg_user_id, category_id). Seeded once from
+# the latest AMOUNT_SEED_ROWS entries, then kept up to date by the inserts below.
+AMOUNT_SUGGESTIONS = int(os.getenv('AMOUNT_SUGGESTIONS', 5))
+AMOUNT_TRACKED = int(os.getenv('AMOUNT_TRACKED', 20))
+AMOUNT_SEED_ROWS = int(os.getenv('AMOUNT_SEED_ROWS', 200))
+# recent | frequent | hourly (most used at the user's current local hour)
+AMOUNT_RANKING = os.getenv('AMOUNT_RANKING', RECENT)
+if AMOUNT_RANKING not in RANKINGS:
+    logging.warning(f"Unknown AMOUNT_RANKING={AMOUNT_RANKING!r}, using {RECENT!r}")
+    AMOUNT_RANKING = RECENT
+
+_amount_cache = TTLCache(
+    "amount_suggestions",
+    int(os.getenv('AMOUNT_CACHE_SIZE', 50_000)),
+    float(os.getenv('AMOUNT_CACHE_TTL', 24 * 3600))
+)
+
+
+def _local_hour(time_utc: timedelta) -> int:
+    return (datetime.utcnow() + time_utc).hour
+
+
+def _cache_add_amount(tg_user_id: int, category_id: int, amount: float, time_utc: timedelta):
+    hour = _local_hour(time_utc)
+    _amount_cache.update(
+        (tg_user_id, category_id),
+        lambda stats: stats.add(amount, hour)
+    )
+
+
+register_statement(
+    "last_amounts",
+    """
+    SELECT amount, EXTRACT(HOUR FROM created_date)::int
+    FROM dengies
+    WHERE user_id = %s
+      AND category_id = %s
+    ORDER BY created_date DESC
+    LIMIT %s;
+    """
+)
+
+
+@instrumented
+async def get_last_amounts(category_id: int, user_id: int) -> list:
+    """
+    Up to AMOUNT_SUGGESTIONS distinct amounts for the amount keyboard, ranked by AMOUNT_RANKING.
+    Only the first call per (user, category) reads dengies, and only its latest rows.
+    """
+    user = await get_user_identity(user_id)
+    if user is None:
+        return []
+
+    key = (user_id, category_id)
+    stats = _amount_cache.get(key)
+    if stats is None:
+        version = _amount_cache.version
+        try:
+            async with get_read_connection() as connection, connection.cursor() as cursor:
+                await execute_prepared(
+                    cursor,
+                    "last_amounts",
+                    (user["id"], category_id, AMOUNT_SEED_ROWS)
+                )
+                rows = await cursor.fetchall()
+
+        except (Exception, Error) as error:
+            logging.error("Error while fetching last amounts: %s", error)
+            return None
 
-async def insert_dengies(amount: float, category_id: int, user_id: int) -> int | None:
-    connection = None
+        stats = AmountStats(AMOUNT_TRACKED, AMOUNT_SUGGESTIONS)
+        # Oldest first, so the latest entry ends up most recent
+        for amount, hour in reversed(rows):
+            stats.add(amount, hour)
+        _amount_cache.set(key, stats, version)
+
+    return stats.top(AMOUNT_SUGGESTIONS, AMOUNT_RANKING, _local_hour(user["time_utc"]))
+
+
+
+register_statement(
+    "insert_dengies_with_balance",
+    """
+    WITH u AS (
+        UPDATE users
+        SET balans = balans + %(delta)s::numeric
+        WHERE id = %(user_id)s
+          AND balans + %(delta)s::numeric >= 0
+          AND balans + %(delta)s::numeric <= %(max_balance)s::numeric
+          AND EXISTS (
+              SELECT 1 FROM categories c
+              WHERE c.id = %(category_id)s AND c.user_id = users.id
+          )
+        RETURNING id, balans, time_utc
+    ), d AS (
+        INSERT INTO dengies (amount, created_date, category_id, user_id)
+        SELECT
+            %(amount)s,
+            date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc,
+            %(category_id)s,
+            u.id
+        FROM u
+        RETURNING id, amount, created_date, category_id, user_id
+    ), t AS (
+        -- Keep user_day_totals in step with dengies
+        INSERT INTO user_day_totals (user_id, local_day, is_ex, entries_count, total_amount)
+        SELECT d.user_id, d.created_date::date, c.is_ex, 1, d.amount
+        FROM d
+        JOIN categories c ON c.id = d.category_id
+        ON CONFLICT (user_id, local_day, is_ex) DO UPDATE
+        SET entries_count = user_day_totals.entries_count + 1,
+            total_amount = user_day_totals.total_amount + EXCLUDED.total_amount
+    )
+    SELECT u.balans, d.id, c.title, d.created_date::date
+    FROM u
+    CROSS JOIN d
+    JOIN categories c ON c.id = d.category_id;
+    """
+)
+
+
+@instrumented
+async def insert_dengies_with_balance(
+    tg_user_id: int,
+    category_id: int,
+    amount: float,
+    is_ex: bool,
+    max_balance: float = 9_999_999_999.99
+) -> tuple[float, int, str, date] | None:
+    """
+    Changes the user's balance, inserts the dengies row and returns
+    (new_balance, dengies_id, category_title, created_day) in one statement.
+    created_day is the row's local day, update_comment_text needs it.
+
+    Expenses need balans >= amount, incomes must not exceed max_balance.
+    The balance is only touched when the category belongs to the user, and
+    if the insert fails the whole statement (balance included) is rolled back.
+    user_day_totals is updated by the same statement.
+    Returns None if the balance check fails or the user/category is not found.
+    """
+    user = await get_user_identity(tg_user_id)
+    if user is None:
+        logging.warning(f"Cannot insert amount, user {tg_user_id} is not registered")
+        return None
+
+    delta = -amount if is_ex else amount
     try:
-        connection = await get_db_connection()
-        async with connection.cursor() as cursor:
-            await cursor.execute(
-                """
-                INSERT INTO dengies (amount, created_date, category_id, user_id)
-                SELECT
-                    %s AS amount,
-                    date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc AS created_date,
-                    %s AS category_id,
-                    u.id AS user_id
-                FROM users u
-                WHERE u.tg_user_id = %s
-                RETURNING id;
-                """,
-                (amount, category_id, user_id)
+        async with get_db_connection() as conn, conn.cursor() as cur:
+            await execute_prepared(
+                cur,
+                "insert_dengies_with_balance",
+                {
+                    "delta": delta,
+                    "amount": amount,
+                    "user_id": user["id"],
+                    "category_id": category_id,
+                    "max_balance": max_balance,
+                }
             )
-            inserted_id_row = await cursor.fetchone()
-            await connection.commit()
-            logging.info(f"Amount: {amount} is inserted to category: {category_id}")
-            return inserted_id_row[0] if inserted_id_row else None
+            result = await cur.fetchone()
+            await conn.commit()
 
-    except (Exception, Error) as error:
-        logging.error("Error while inserting expense: %s", error)
+            if result:
+                logging.info(f"Amount: {amount} is inserted to category: {category_id}")
+                _cache_add_amount(tg_user_id, category_id, amount, user["time_utc"])
+                return float(result[0]), result[1], result[2], result[3]
+
+            logging.warning(
+                f"Balance check failed or category not found: user_id={tg_user_id}, "
+                f"category_id={category_id}, amount={amount}, is_ex={is_ex}"
+            )
+            return None
+
+    except Exception as e:
+        logging.error(f"Failed to insert dengies with balance for user_id={tg_user_id}: {e}")
         return None
 
-    finally:
-        if connection is not None:
-            await connection.close()
+
+register_statement(
+    "active_categories_by_type",
+    """
+    SELECT c.id, c.title
+    FROM categories AS c
+    WHERE c.is_active = TRUE
+      AND c.is_ex = %s
+      AND c.user_id = %s;
+    """
+)
 
 
+@instrumented
 async def get_active_categories_by_type(
     tg_user_id: int, is_ex: bool
 ) -> tuple[list[tuple[int, str]], int] | None:
@@ -505,48 +921,42 @@ async def get_active_categories_by_type(
     - 20 for premium users
     - 8 for non-premium users
     """
-    conn: AsyncConnection | None = None
-    try:
-        conn = await get_db_connection()
-        async with conn.cursor() as cur:
-            # 1️⃣ Check if user is premium
-            await cur.execute(
-                "SELECT is_premium, id FROM users WHERE tg_user_id = %s LIMIT 1;",
-                (tg_user_id,)
-            )
-            user_row = await cur.fetchone()
-            if not user_row:
-                return [], 8  # default to 8 if user not found
+    cached = _category_cache.get((tg_user_id, is_ex))
+    if cached is not None:
+        rows, max_categories = cached
+        return list(rows), max_categories
+
+    version = _category_cache.version
+
+    # 1️⃣ Check if user is premium
+    user = await get_user_identity(tg_user_id)
+    if user is None:
+        return [], 8  # default to 8 if user not found
 
-            is_premium, user_id = user_row
-            max_categories = 20 if is_premium else 8
+    max_categories = 20 if user["is_premium"] else 8
 
+    try:
+        async with get_db_connection() as conn, conn.cursor() as cur:
             # 2️⃣ Fetch categories for this user
-            await cur.execute(
-                """
-                SELECT c.id, c.title
-                FROM categories AS c
-                WHERE c.is_active = TRUE
-                  AND c.is_ex = %s
-                  AND c.user_id = %s;
-                """,
-                (is_ex, user_id)
+            await execute_prepared(
+                cur,
+                "active_categories_by_type",
+                (is_ex, user["id"])
             )
             rows = await cur.fetchall()
             rows = rows or []
 
-            return rows, max_categories
+            _category_cache.set((tg_user_id, is_ex), (rows, max_categories), version)
+            return list(rows), max_categories
 
     except Exception as e:
         logging.error("Failed to fetch categories for user %s: %s", tg_user_id, e)
         return None
 
-    finally:
-        if conn:
-            await conn.close()
 
 
 
+@instrumented
 async def get_is_premium(user_id: int) -> bool | None:
     """
     Fetches the is_premium status for a given Telegram user ID.
@@ -554,121 +964,99 @@ async def get_is_premium(user_id: int) -> bool | None:
     :param user_id: Telegram user ID
     :return: True/False if user exists, None if error or user not found
     """
-    conn: AsyncConnection | None = None
-    try:
-        conn = await get_db_connection()
-        async with conn.cursor() as cursor:
-            await cursor.execute(
-                "SELECT is_premium FROM users WHERE tg_user_id = %s LIMIT 1;",
-                (user_id,)
-            )
-            result = await cursor.fetchone()
-            if result:
-                return result[0]  # bool
-            return None
+    user = await get_user_identity(user_id)
+    if user:
+        return user["is_premium"]  # bool
+    return None
 
-    except Exception as error:
-        logging.error("Error while fetching is_premium for user %s: %s", user_id, error)
-        return None
-
-    finally:
-        if conn:
-            await conn.close()
 
 
-async def is_exist_title(tg_user_id: int, title: str, is_ex: bool) -> bool | None:
+@instrumented
+async def add_category(tg_user_id: int, title: str, is_ex: bool) -> str | None:
     """
+    Looks the title up (case-insensitively), reactivates or creates the category,
+    pipelined into one round trip.
+
     Returns:
-        True  -> category exists and active
-        False -> category exists but was inactive (reactivated)
-        None  -> category does not exist
+        "exists"      -> an active category with this title already exists
+        "reactivated" -> an inactive one was reactivated
+        "created"     -> a new category was created
+        None          -> error or unknown user
     """
-    conn: AsyncConnection | None = None
+    title = title.strip()
+    user = await get_user_identity(tg_user_id)
+    if user is None:
+        return None
+
+    params = {"user_id": user["id"], "title": title, "is_ex": is_ex}
     try:
-        conn = await get_db_connection()
-        async with conn.cursor() as cur:
-            await cur.execute(
+        async with get_pipeline_connection() as conn, \
+                conn.cursor() as found_cur, conn.cursor() as reactivated_cur, conn.cursor() as created_cur:
+            await found_cur.execute(
                 """
-                SELECT id, is_active
+                SELECT is_active
                 FROM categories
-                WHERE user_id = (SELECT id FROM users WHERE tg_user_id = %s)
-                  AND LOWER(title) = LOWER(%s)
-                  AND is_ex = %s
+                WHERE user_id = %(user_id)s AND is_ex = %(is_ex)s AND LOWER(title) = LOWER(%(title)s)
+                ORDER BY is_active DESC
                 LIMIT 1;
                 """,
-                (tg_user_id, title, is_ex)
+                params
             )
-            row = await cur.fetchone()
-            if row:
-                category_id, is_active = row
-                if is_active:
-                    return True   # Already active
-                else:
-                    # Reactivate the category
-                    await cur.execute(
-                        "UPDATE categories SET is_active = TRUE WHERE id = %s",
-                        (category_id,)
-                    )
-                    await conn.commit()
-                    return False  # Reactivated
-            else:
-                return None  # Does not exist
-
-    finally:
-        if conn:
-            await conn.close()
-
-
-
-async def create_category(
-    tg_user_id: int,
-    title: str,
-    is_ex: bool = True
-) -> bool:
-    """
-    Creates a new category for a user.
-
-    :param tg_user_id: Telegram user ID
-    :param title: Category title
-    :param is_ex: True for expense category, False for income category
-    :return: True if created successfully, False otherwise
-    """
-    title = title.strip()
-    conn: AsyncConnection | None = None
-
-    try:
-        conn = await get_db_connection()
-        async with conn.cursor() as cur:
-            # Get user's internal ID
-            await cur.execute(
-                "SELECT id FROM users WHERE tg_user_id = %s LIMIT 1;",
-                (tg_user_id,)
+            await reactivated_cur.execute(
+                """
+                UPDATE categories
+                SET is_active = TRUE
+                WHERE id = (
+                    SELECT id FROM categories
+                    WHERE user_id = %(user_id)s AND is_ex = %(is_ex)s AND LOWER(title) = LOWER(%(title)s)
+                    ORDER BY id
+                    LIMIT 1
+                )
+                AND NOT is_active
+                AND NOT EXISTS (
+                    SELECT 1 FROM categories
+                    WHERE user_id = %(user_id)s AND is_ex = %(is_ex)s AND LOWER(title) = LOWER(%(title)s)
+                      AND is_active
+                )
+                RETURNING id, title;
+                """,
+                params
             )
-            user_row = await cur.fetchone()
-            user_id = user_row[0]
-
-            # Insert new category
-            await cur.execute(
+            await created_cur.execute(
                 """
                 INSERT INTO categories (title, is_ex, user_id)
-                VALUES (%s, %s, %s);
+                SELECT %(title)s, %(is_ex)s, %(user_id)s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM categories
+                    WHERE user_id = %(user_id)s AND is_ex = %(is_ex)s AND LOWER(title) = LOWER(%(title)s)
+                )
+                RETURNING id;
                 """,
-                (title, is_ex, user_id)
+                params
             )
+            found = await found_cur.fetchone()
+            reactivated = await reactivated_cur.fetchone()
+            created = await created_cur.fetchone()
             await conn.commit()
-            logging.info(f"Category '{title}' created for user {tg_user_id}")
-            return True
 
-    except Exception as e:
-        logging.error(f"Failed to create category '{title}' for user {tg_user_id}: {e}")
-        return False
+    except (Exception, Error) as e:
+        logging.error(f"Failed to add category '{title}' for user {tg_user_id}: {e}")
+        return None
 
-    finally:
-        if conn:
-            await conn.close()
+    if created:
+        _cache_add_category(tg_user_id, is_ex, created[0], title)
+        logging.info(f"Category '{title}' created for user {tg_user_id}")
+        return "created"
+    if reactivated:
+        _cache_add_category(tg_user_id, is_ex, reactivated[0], reactivated[1])
+        return "reactivated"
+    if found:
+        return "exists"
+    return None
 
 
 
+@instrumented
 async def deactivate_category(category_id: int) -> Optional[str]:
     """
     Deactivates a category by setting is_active to FALSE.
@@ -678,22 +1066,26 @@ async def deactivate_category(category_id: int) -> Optional[str]:
              'already_inactive' if it was already FALSE,
              None if an error occurred.
     """
-    conn: Optional[AsyncConnection] = None
     try:
-        conn = await get_db_connection()  # Your async DB connection function
-        async with conn.cursor() as cur:
+        async with get_db_connection() as conn, conn.cursor() as cur:
             await cur.execute(
                 """
-                UPDATE categories
+                UPDATE categories AS c
                 SET is_active = FALSE
-                WHERE id = %s
-                  AND is_active = TRUE;
+                FROM users AS u
+                WHERE c.id = %s
+                  AND c.is_active = TRUE
+                  AND u.id = c.user_id
+                RETURNING u.tg_user_id, c.is_ex;
                 """,
                 (category_id,)
             )
+            row = await cur.fetchone()
             await conn.commit()
 
-            if cur.rowcount == 1:
+            if row:
+                tg_user_id, is_ex = row
+                _cache_remove_category(tg_user_id, is_ex, category_id)
                 logging.info(f"Category {category_id} was active and now deactivated.")
                 return "deactivated"
             else:
@@ -704,47 +1096,29 @@ async def deactivate_category(category_id: int) -> Optional[str]:
         logging.error(f"Failed to deactivate category {category_id}: {e}")
         return None
 
-    finally:
-        if conn:
-            await conn.close()
 
 
+@instrumented
 async def get_user_language(user_id: int) -> str | None:
-    connection = None
-    try:
-        connection = await get_db_connection()
-        async with connection.cursor() as cursor:
-            await cursor.execute(
-                "SELECT language_is FROM users WHERE tg_user_id = %s LIMIT 1;", (user_id,)
-            )
-            result = await cursor.fetchone()
-            if result:
-                return result[0]  # language_is
-            return None
+    user = await get_user_identity(user_id)
+    if user:
+        return user["language_is"]
+    return None
 
-    except (Exception, Error) as error:
-        logging.error("Error while fetching user language: %s", error)
-        return None
-
-    finally:
-        if connection is not None:
-            await connection.close()
 
 
+@instrumented
 async def user_exist(user_id: int) -> bool:
     try:
-        conn = await get_db_connection()
-        async with conn.cursor() as cursor:
+        async with get_db_connection() as conn, conn.cursor() as cursor:
             await cursor.execute("SELECT 1 FROM users WHERE tg_user_id = %s LIMIT 1;", (user_id,))
             result = await cursor.fetchone()
             return result is not None
     except Exception as e:
-        logging(f"Error user_exist: {e}")
+        logging.error(f"Error user_exist: {e}")
         return False
-    finally:
-        if conn:
-            await conn.close()
 
+@instrumented
 async def insert_or_update_user(
     user_id: int,
     first_name: str,
@@ -757,10 +1131,17 @@ async def insert_or_update_user(
     - Updates default category names if user language changes.
     Returns: 'inserted', 'updated', or None on error.
     """
-    conn: Optional[AsyncConnection] = None
+    #Get translated category names
+    food = await translator.get_text(language_is, "cat_food")
+    salary = await translator.get_text(language_is, "cat_salary")
+    transport = await translator.get_text(language_is, "cat_transport")
+    gifts = await translator.get_text(language_is, "cat_gift")
+    other = await translator.get_text(language_is, "other")
+
     try:
-        conn = await get_db_connection()
-        async with conn.cursor(row_factory=dict_row) as cur:
+        # Both statements go out in one flush
+        async with get_pipeline_connection() as conn, \
+                conn.cursor(row_factory=dict_row) as cur, conn.cursor() as categories_cur:
             # Insert or update the user
             await cur.execute(
                 """
@@ -777,79 +1158,29 @@ async def insert_or_update_user(
                 """,
                 (user_id, first_name, user_name, language_is)
             )
+            # Default categories, only for a user without any categories (a new one)
+            await categories_cur.execute(
+                """
+                INSERT INTO categories (title, is_ex, user_id)
+                SELECT v.title, v.is_ex, u.id
+                FROM users u
+                CROSS JOIN (VALUES
+                    (%s, TRUE), (%s, TRUE), (%s, TRUE),
+                    (%s, FALSE), (%s, FALSE), (%s, FALSE)
+                ) AS v(title, is_ex)
+                WHERE u.tg_user_id = %s
+                  AND NOT EXISTS (SELECT 1 FROM categories c WHERE c.user_id = u.id);
+                """,
+                (food, transport, other, salary, gifts, other, user_id)
+            )
             result = await cur.fetchone()
             if not result:
                 return None
 
-            user_db_id = result["id"]
             inserted = result["inserted"]
-
-
-            #Get translated category names
-            food = await translator.get_text(language_is, "cat_food")
-            # food_names = translator.get_all_values_by_key(translator.translations, "cat_food")
-
-            salary = await translator.get_text(language_is, "cat_salary")
-            # sal_names = translator.get_all_values_by_key(translator.translations, "cat_salary")
-
-            transport = await translator.get_text(language_is, "cat_transport")
-            # transport_names = translator.get_all_values_by_key(translator.translations, "cat_transport")
-
-            gifts = await translator.get_text(language_is, "cat_gift")
-            # gifts_names = translator.get_all_values_by_key(translator.translations, "cat_gift")
-            
-            other = await translator.get_text(language_is, "other")
-            # other_names = translator.get_all_values_by_key(translator.translations, "other")
-
-            if inserted:
-                # Create default categories if user is new
-                await cur.executemany(
-                    """
-                    INSERT INTO categories (title, is_ex, user_id)
-                    VALUES (%s, TRUE, %s);
-                    """,
-                    [(food, user_db_id), (transport, user_db_id), (other, user_db_id)]
-                )
-                await cur.executemany(
-                    """
-                    INSERT INTO categories (title, is_ex, user_id)
-                    VALUES (%s, FALSE, %s);
-                    """,
-                    [(salary, user_db_id), (gifts, user_db_id), (other, user_db_id)]
-                )
-                logging.info(f"✅ Created default categories for new user {user_id}")
-            # else:
-            #     # Update existing default categories to match new language
-            #     await cur.execute(
-            #         """
-            #         UPDATE categories
-            #         SET title = CASE
-            #             WHEN LOWER(title) = ANY(%s) THEN %s
-            #             WHEN LOWER(title) = ANY(%s) THEN %s
-            #             WHEN LOWER(title) = ANY(%s) THEN %s
-            #             ELSE title
-            #         END
-            #         WHERE user_id = %s AND is_ex = TRUE;
-            #         """,
-            #         (food_names, food, transport_names, transport, other_names, other, user_db_id)
-            #     )
-
-            #     await cur.execute(
-            #         """
-            #         UPDATE categories
-            #         SET title = CASE
-            #             WHEN LOWER(title) = ANY(%s) THEN %s
-            #             WHEN LOWER(title) = ANY(%s) THEN %s
-            #             WHEN LOWER(title) = ANY(%s) THEN %s
-            #             ELSE title
-            #         END
-            #         WHERE user_id = %s AND is_ex = FALSE;
-            #         """,
-            #         (sal_names, salary, gifts_names, gifts, other_names, other, user_db_id)
-            #     )
-            #     logging.info(f"🔁 Updated default categories for existing user {user_id} language {language_is}")
-
             await conn.commit()
+            if categories_cur.rowcount > 0:
+                logging.info(f"✅ Created default categories for new user {user_id}")
             return "inserted" if inserted else "updated"
 
     except Exception as e:
@@ -857,98 +1188,106 @@ async def insert_or_update_user(
         return None
 
     finally:
-        if conn:
-            await conn.close()
+        invalidate_user(user_id)
 
 
 
-async def get_last_times() -> list[str] | None:
-    connection = None
+
+# Onboarding keyboards suggest the offsets and currencies users chose most recently.
+# Kept in memory: updated by update_user_info and reloaded from the newest
+# users every ONBOARDING_REFRESH seconds to pick up other instances' writes.
+ONBOARDING_SUGGESTIONS = int(os.getenv('ONBOARDING_SUGGESTIONS', 5))
+ONBOARDING_REFRESH = float(os.getenv('ONBOARDING_REFRESH', 600))
+ONBOARDING_SCAN_ROWS = int(os.getenv('ONBOARDING_SCAN_ROWS', 500))
+
+_recent_offsets = RecentValues(ONBOARDING_SUGGESTIONS)
+_recent_currencies = RecentValues(ONBOARDING_SUGGESTIONS)
+_onboarding_loaded_at: float | None = None
+
+register_statement(
+    "recent_user_settings",
+    """
+    SELECT time_utc, currency_is
+    FROM users
+    ORDER BY id DESC
+    LIMIT %s;
+    """
+)
+
+
+async def _load_onboarding_suggestions() -> bool:
+    global _onboarding_loaded_at
+    if _onboarding_loaded_at is not None and time.monotonic() - _onboarding_loaded_at < ONBOARDING_REFRESH:
+        return True
+
     try:
-        connection = await get_db_connection()
-        async with connection.cursor() as cursor:
-            await cursor.execute(
-                """
-                SELECT time_utc, id
-                FROM (
-                    SELECT DISTINCT ON (time_utc) time_utc, id
-                    FROM users
-                    ORDER BY time_utc, id
-                ) AS distinct_times
-                ORDER BY id DESC
-                LIMIT 5;
-                """
-            )
+        async with get_read_connection() as connection, connection.cursor() as cursor:
+            await execute_prepared(cursor, "recent_user_settings", (ONBOARDING_SCAN_ROWS,))
             rows = await cursor.fetchall()
 
-            # Get current UTC time (not local time)
-            now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+    except (Exception, Error) as error:
+        logging.error("Error while loading onboarding suggestions: %s", error)
+        # Serve what we have, if anything
+        return _onboarding_loaded_at is not None
 
-            result_times = []
-            for row in rows:
-                time_offset: timedelta = row[0]
-                local_time = now_utc + time_offset
-                result_times.append(local_time.strftime("%Y-%m-%d %H:%M"))
+    _recent_offsets.replace(row[0] for row in rows)
+    _recent_currencies.replace(row[1] for row in rows)
+    _onboarding_loaded_at = time.monotonic()
+    return True
 
-            # logging.info(f"Local times based on UTC now: {result_times}")
-            return result_times
 
-    except (Exception, Error) as error:
-        logging.error("Error while calculating local times: %s", error)
+@instrumented
+async def get_last_times() -> list[str] | None:
+    if not await _load_onboarding_suggestions():
         return None
 
-    finally:
-        if connection:
-            await connection.close()
+    # Get current UTC time (not local time)
+    now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
 
+    result_times = []
+    for time_offset in _recent_offsets.values:
+        local_time = now_utc + time_offset
+        result_times.append(local_time.strftime("%Y-%m-%d %H:%M"))
 
-async def get_last_currencies() -> list[str] | None:
-    connection: Optional[AsyncConnection] = None
-    try:
-        connection = await get_db_connection()
-        async with connection.cursor() as cursor:
-            await cursor.execute(
-                """
-                SELECT currency_is
-                FROM (
-                    SELECT DISTINCT ON (currency_is) currency_is, id
-                    FROM users
-                    ORDER BY currency_is, id DESC
-                ) AS distinct_currencies
-                ORDER BY id DESC
-                LIMIT 5;
-                """
-            )
-            rows = await cursor.fetchall()
+    return result_times
 
-            # Extract currency codes as a list of strings
-            result_currencies = [row[0] for row in rows]
-            # logging.info(f"Returning keyboard with {result_currencies} values")
-            return result_currencies
 
-    except Exception as error:
-        logging.error("Error while fetching last currencies: %s", error)
+@instrumented
+async def get_last_currencies() -> list[str] | None:
+    if not await _load_onboarding_suggestions():
         return None
+    return list(_recent_currencies.values)
 
-    finally:
-        if connection:
-            await connection.close()
 
 
+register_statement(
+    "upsert_zone_offset",
+    """
+    INSERT INTO zone_offsets (time_zone, utc_offset)
+    VALUES (%s, %s)
+    ON CONFLICT (time_zone) DO UPDATE
+    SET utc_offset = EXCLUDED.utc_offset,
+        refreshed_at = EXCLUDED.refreshed_at
+    WHERE zone_offsets.utc_offset <> EXCLUDED.utc_offset;
+    """
+)
+
+
+@instrumented
 async def update_user_info(
     user_id: int,
     rounded_offset,
     currency: str,
-    balans: float | None = None
+    balans: float | None = None,
+    time_zone: str | None = None
 ) -> bool:
     """
-    Updates time_utc, currency, and optionally balans for the given user.
-    If balans is None, it will not be updated.
+    Updates time_utc, currency, and optionally balans and time_zone for the given user.
+    If balans or time_zone is None, it will not be updated. rounded_offset is the
+    zone's current offset, which is recorded in zone_offsets for the scheduler.
     """
-    conn: AsyncConnection | None = None
     try:
-        conn = await get_db_connection()
-        async with conn.cursor() as cur:
+        async with get_db_connection() as conn, conn.cursor() as cur:
             # Build the SQL dynamically
             sql = "UPDATE users SET time_utc = %s, currency_is = %s"
             params = [rounded_offset, currency]
@@ -957,16 +1296,25 @@ async def update_user_info(
                 sql += ", balans = %s"
                 params.append(balans)
 
+            if time_zone is not None:
+                sql += ", time_zone = %s"
+                params.append(time_zone)
+
             sql += " WHERE tg_user_id = %s;"
             params.append(user_id)
 
             await cur.execute(sql, params)
+            if time_zone is not None:
+                await execute_prepared(cur, "upsert_zone_offset", (time_zone, rounded_offset))
             await conn.commit()
             
             logging.info(
                 f"Updated user {user_id} with values utc {rounded_offset}, currency {currency}"
+                + (f", time zone {time_zone}" if time_zone is not None else "")
                 + (f", balans {balans}" if balans is not None else "")
             )
+            _recent_offsets.add(rounded_offset)
+            _recent_currencies.add(currency)
             return True
 
     except Exception as e:
@@ -974,21 +1322,23 @@ async def update_user_info(
         return False
 
     finally:
-        if conn:
-            await conn.close()
+        invalidate_user(user_id)
+
 
-async def update_comment_text(dengies_id: int, comment_text: str) -> bool:
-    conn = None
+@instrumented
+async def update_comment_text(dengies_id: int, created_day: date, comment_text: str) -> bool:
+    """created_day (local) keeps the update to the row's partition of dengies."""
     try:
-        conn = await get_db_connection()
-        async with conn.cursor() as cur:
+        async with get_db_connection() as conn, conn.cursor() as cur:
             await cur.execute(
                 """
                 UPDATE dengies
-                SET comment_text = %s
-                WHERE id = %s;
+                SET comment_text = %(comment_text)s
+                WHERE id = %(dengies_id)s
+                  AND created_date >= %(created_day)s::date
+                  AND created_date < %(created_day)s::date + 1;
                 """,
-                (comment_text, dengies_id)
+                {"comment_text": comment_text, "dengies_id": dengies_id, "created_day": created_day}
             )
             await conn.commit()
             logging.info(f"Succesfuly saved comment to {dengies_id}")
@@ -998,229 +1348,365 @@ async def update_comment_text(dengies_id: int, comment_text: str) -> bool:
         logging.error(f"Failed to update comment for amount_id={dengies_id}: {e}")
         return False
 
-    finally:
-        if conn:
-            await conn.close()
 
 
-async def add_user_balance(user_id: int, amount: float, MAX_NUMERIC_12_2: float) -> float | None:
+register_statement(
+    "rollup_lock_users",
+    # Every insert into dengies holds a lock on its users row until it commits,
+    # taken before the row's id is drawn (the balance UPDATE in
+    # insert_dengies_with_balance, the import's lock). Waiting for them here means
+    # no row with an id below the new watermark can still become visible after this
+    # run, and two runs for a user take turns.
+    """
+    SELECT id
+    FROM users
+    WHERE tg_user_id = ANY(%s)
+    ORDER BY id
+    FOR UPDATE;
+    """
+)
+
+
+register_statement(
+    "incremental_rollups",
+    # Each level upserts into the period's row: years first, so the months can link
+    # to their year (year_id) and the days to their month (month_id) from the rows
+    # returned just before. A period has one row (the *_period_key constraints of
+    # migration 0007), so a run adds to it or inserts it in one statement.
+    """
+    WITH delta AS MATERIALIZED (
+        SELECT
+            d.id,
+            d.user_id,
+            d.category_id,
+            c.is_ex,
+            d.amount,
+            d.created_date::date AS day,
+            u.time_utc
+        FROM users u
+        LEFT JOIN rollup_watermarks w ON w.user_id = u.id
+        JOIN dengies d
+            ON d.user_id = u.id
+            AND d.id > COALESCE(w.last_dengies_id, 0)
+            AND d.created_date >= COALESCE(w.min_created_date, '-infinity')
+        JOIN categories c ON c.id = d.category_id
+        WHERE u.tg_user_id = ANY(%s)
+    ), yearly AS (
+        INSERT INTO yearly_category_reports AS r (user_id, category_id, period_start, total_amount, created_date)
+        SELECT
+            user_id,
+            category_id,
+            date_trunc('year', day)::date,
+            SUM(amount),
+            date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + MAX(time_utc)
+        FROM delta
+        GROUP BY user_id, category_id, date_trunc('year', day)
+        ON CONFLICT (user_id, period_start, category_id) DO UPDATE
+        SET total_amount = r.total_amount + EXCLUDED.total_amount
+        RETURNING r.id, r.user_id, r.category_id, r.period_start
+    ), monthly AS (
+        INSERT INTO monthly_category_reports AS r (user_id, category_id, year_id, period_start, total_amount, created_date)
+        SELECT
+            m.user_id,
+            m.category_id,
+            y.id,
+            m.period_start,
+            m.amount,
+            date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + m.time_utc
+        FROM (
+            SELECT user_id, category_id, date_trunc('month', day)::date AS period_start, SUM(amount) AS amount, MAX(time_utc) AS time_utc
+            FROM delta
+            GROUP BY user_id, category_id, date_trunc('month', day)
+        ) m
+        JOIN yearly y
+            ON y.user_id = m.user_id
+            AND y.category_id = m.category_id
+            AND y.period_start = date_trunc('year', m.period_start)::date
+        ON CONFLICT (user_id, period_start, category_id) DO UPDATE
+        SET total_amount = r.total_amount + EXCLUDED.total_amount,
+            year_id = COALESCE(r.year_id, EXCLUDED.year_id)
+        RETURNING r.id, r.user_id, r.category_id, r.period_start
+    ), daily_category AS (
+        INSERT INTO daily_category_reports AS r (user_id, category_id, month_id, period_start, total_amount, created_date)
+        SELECT
+            d.user_id,
+            d.category_id,
+            m.id,
+            d.period_start,
+            d.amount,
+            date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + d.time_utc
+        FROM (
+            SELECT user_id, category_id, day AS period_start, SUM(amount) AS amount, MAX(time_utc) AS time_utc
+            FROM delta
+            GROUP BY user_id, category_id, day
+        ) d
+        JOIN monthly m
+            ON m.user_id = d.user_id
+            AND m.category_id = d.category_id
+            AND m.period_start = date_trunc('month', d.period_start)::date
+        ON CONFLICT (user_id, period_start, category_id) DO UPDATE
+        SET total_amount = r.total_amount + EXCLUDED.total_amount,
+            month_id = COALESCE(r.month_id, EXCLUDED.month_id)
+        RETURNING r.id
+    ), daily AS (
+        INSERT INTO daily_reports AS r (user_id, is_ex, period_start, total_amount, created_date)
+        SELECT
+            user_id,
+            is_ex,
+            day,
+            SUM(amount),
+            date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + MAX(time_utc)
+        FROM delta
+        GROUP BY user_id, is_ex, day
+        ON CONFLICT (user_id, period_start, is_ex) DO UPDATE
+        SET total_amount = r.total_amount + EXCLUDED.total_amount
+        RETURNING r.id
+    ), marked AS (
+        -- Rows entered after this run have a local created_date no earlier than a day
+        -- before its UTC time (offsets are within a day); imports move it back
+        INSERT INTO rollup_watermarks AS w (user_id, last_dengies_id, min_created_date, updated_at)
+        SELECT
+            user_id,
+            MAX(id),
+            date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') - INTERVAL '1 day',
+            date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+        FROM delta
+        GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET last_dengies_id = EXCLUDED.last_dengies_id,
+            min_created_date = EXCLUDED.min_created_date,
+            updated_at = EXCLUDED.updated_at
+        RETURNING 1
+    )
+    SELECT
+        (SELECT COUNT(*) FROM delta),
+        (SELECT COUNT(*) FROM daily),
+        (SELECT COUNT(*) FROM daily_category),
+        (SELECT COUNT(*) FROM monthly),
+        (SELECT COUNT(*) FROM yearly),
+        (SELECT COUNT(*) FROM marked);
+    """
+)
+
+
+@instrumented
+async def run_daily_rollups(tg_user_ids: list[int]):
+    """
+    Adds the given users' new dengies rows to the daily, daily per category, monthly
+    and yearly reports and moves their watermarks, in one transaction per chunk of users.
+    A failed chunk leaves its watermarks where they were and is retried by the next run.
+    """
+    totals = [0] * 6
+    failed_chunks = 0
+    started = time.perf_counter()
+    for chunk in _chunks(tg_user_ids):
+        try:
+            async with get_db_connection(BACKGROUND) as connection, connection.cursor() as cursor:
+                await execute_prepared(cursor, "rollup_lock_users", (chunk,))
+                await execute_prepared(cursor, "incremental_rollups", (chunk,))
+                counts = await cursor.fetchone()
+                await connection.commit()
+            totals = [total + count for total, count in zip(totals, counts)]
+
+        except (Exception, Error) as e:
+            logging.error("Rollups of %s users failed: %s", len(chunk), e)
+            failed_chunks += 1
+
+    entries, daily, daily_category, monthly, yearly, users = totals
+    logging.info(
+        f"Rollups for {len(tg_user_ids)} users: {entries} new entries of {users} users into "
+        f"{daily} daily, {daily_category} daily category, {monthly} monthly and {yearly} yearly rows, "
+        f"{failed_chunks} failed chunks in {time.perf_counter() - started:.3f}s"
+    )
+
+
+# dengies is partitioned by month (migrations/0003_partition_dengies.sql).
+# Partitions are created this many months ahead; with a retention > 0, partitions
+# older than that many months are detached from the table (not dropped).
+DENGIES_PARTITIONS_AHEAD = int(os.getenv('DENGIES_PARTITIONS_AHEAD', 3))
+DENGIES_RETENTION_MONTHS = int(os.getenv('DENGIES_RETENTION_MONTHS', 0))
+
+
+@instrumented
+async def maintain_dengies_partitions() -> list[tuple[str, str]]:
     """
-    Atomically adds the given amount to the user's balance if it doesn't exceed NUMERIC(12,2) max.
-    Returns the new balance, or None if addition would overflow or user not found.
+    Creates upcoming monthly partitions of dengies and detaches expired ones.
+    Returns (action, partition_name) for every change made.
     """
-    conn = None
     try:
-        conn = await get_db_connection()
-        async with conn.cursor() as cur:
-            # Perform addition only if it does not exceed MAX_NUMERIC_12_2
-            await cur.execute(
-                """
-                UPDATE users
-                SET balans = balans + %s
-                WHERE tg_user_id = %s AND balans + %s <= %s
-                RETURNING balans;
-                """,
-                (amount, user_id, amount, MAX_NUMERIC_12_2)
+        async with get_db_connection(BACKGROUND) as connection, connection.cursor() as cursor:
+            await cursor.execute(
+                "SELECT action, partition_name FROM maintain_dengies_partitions(%s, %s);",
+                (DENGIES_PARTITIONS_AHEAD, DENGIES_RETENTION_MONTHS)
             )
+            changes = await cursor.fetchall()
+            await connection.commit()
 
-            result = await cur.fetchone()
-            await conn.commit()
+    except (Exception, Error) as e:
+        logging.error(f"Error maintaining dengies partitions: {e}")
+        return []
 
-            if result:
-                # Successfully updated and returned new balance
-                return float(result[0])
-            else:
-                # Either user not found or addition would exceed NUMERIC(12,2) max
-                logging.warning(
-                    f"Cannot add amount: user_id={user_id}, amount={amount} would exceed NUMERIC(12,2) limit"
-                )
-                return None
+    for action, partition_name in changes:
+        logging.info(f"dengies partition {partition_name} {action}")
+    return changes
 
-    except Exception as e:
-        logging.error(f"Failed to add balance for user_id={user_id}: {e}")
-        return None
 
-    finally:
-        if conn:
-            await conn.close()
 
+# Outbound message queue (migrations/0006_outbox.sql), delivered by app/auto/outbox.py
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
 
-async def insert_monthly_category_reports(tg_user_ids: list[int]):
+register_statement(
+    "enqueue_message",
     """
-    Aggregate the previous month's daily category reports for each user,
-    insert into monthly_category_reports with created_date in user's local time,
-    and update daily_category_reports.month_id.
+    INSERT INTO outbox (dedup_key, chat_id, texts)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (dedup_key) DO NOTHING;
     """
-    connection = None
+)
+
+
+@instrumented
+async def enqueue_messages(messages: list[tuple[str, int, list[str]]]) -> int | None:
+    """
+    Adds (dedup_key, chat_id, texts) messages to the outbox, one transaction per chunk.
+    Messages whose dedup_key is already there are ignored, so a job can safely
+    enqueue again after a restart. Returns how many were added, None on errors.
+    """
+    added = 0
     try:
-        connection = await get_db_connection()
-        async with connection.cursor() as cursor:
-
-            # Determine previous month and year
-            today = datetime.utcnow()
-            first_day_this_month = today.replace(day=1)
-            last_day_prev_month = first_day_this_month - timedelta(days=1)
-            prev_month = last_day_prev_month.month
-            prev_year = last_day_prev_month.year
-
-            # # --- Manual override for testing ---
-            # prev_month = 11   # May
-            # prev_year = 2025 # Year 2024
-
-            for tg_user_id in tg_user_ids:
-                # Get the user's internal id and time_utc
-                await cursor.execute(
-                    "SELECT id, time_utc FROM users WHERE tg_user_id = %s",
-                    (tg_user_id,)
-                )
-                result = await cursor.fetchone()
-                if not result:
-                    continue
-                user_id, time_utc = result
-
-                # Aggregate total_amount per category for previous month from daily_category_reports
-                await cursor.execute(
-                    """
-                    SELECT 
-                        category_id,
-                        SUM(total_amount) AS total_amount
-                    FROM daily_category_reports
-                    WHERE user_id = %s
-                        AND EXTRACT(MONTH FROM created_date) = %s
-                        AND EXTRACT(YEAR FROM created_date) = %s
-                        AND month_id IS NULL
-                    GROUP BY category_id
-                    """,
-                    (user_id, prev_month, prev_year)
-                )
-                aggregated_rows = await cursor.fetchall()
-
-                # Insert into monthly_category_reports and update daily_category_reports
-                for category_id, total_amount in aggregated_rows:
-                    await cursor.execute(
-                        """
-                        INSERT INTO monthly_category_reports (
-                            user_id, category_id, year_id, total_amount, created_date
-                        )
-                        VALUES (%s, %s, NULL, %s, date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + %s)
-                        RETURNING id
-                        """,
-                        (user_id, category_id, total_amount, time_utc)
-                    )
-                    monthly_id_row = await cursor.fetchone()
-                    monthly_id = monthly_id_row[0]
-
-                    # Update daily_category_reports.month_id for this user and category
-                    await cursor.execute(
-                        """
-                        UPDATE daily_category_reports
-                        SET month_id = %s
-                        WHERE user_id = %s
-                            AND category_id = %s
-                            AND month_id IS NULL
-                            AND EXTRACT(MONTH FROM created_date) = %s
-                            AND EXTRACT(YEAR FROM created_date) = %s
-                        """,
-                        (monthly_id, user_id, category_id, prev_month, prev_year)
-                    )
+        for chunk in _chunks(messages):
+            async with get_db_connection(BACKGROUND) as connection, connection.cursor() as cursor:
+                await cursor.executemany(PREPARED_STATEMENTS["enqueue_message"], chunk)
+                added += max(cursor.rowcount, 0)
+                await connection.commit()
 
+    except (Exception, Error) as e:
+        logging.error(f"Error enqueueing {len(messages)} messages ({added} added): {e}")
+        return None
+
+    return added
+
+
+register_statement(
+    "expire_outbox",
+    """
+    UPDATE outbox
+    SET status = 'failed',
+        last_error = COALESCE(last_error, 'lease expired'),
+        finished_at = date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+    WHERE status = 'pending'
+        AND attempts >= %s
+        AND available_at <= CURRENT_TIMESTAMP AT TIME ZONE 'UTC';
+    """
+)
+
+register_statement(
+    "claim_outbox",
+    """
+    WITH claimed AS (
+        SELECT id
+        FROM outbox
+        WHERE status = 'pending'
+            AND available_at <= CURRENT_TIMESTAMP AT TIME ZONE 'UTC'
+        ORDER BY available_at, id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE outbox o
+    SET available_at = date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + make_interval(secs => %s),
+        attempts = o.attempts + 1
+    FROM claimed
+    WHERE o.id = claimed.id
+    RETURNING o.id, o.chat_id, o.texts, o.sent_parts;
+    """
+)
+
+
+@instrumented
+async def claim_outbox(limit: int, lease_seconds: float) -> list[tuple[int, int, list[str], int]] | None:
+    """
+    Claims up to `limit` due messages for this sender: (id, chat_id, texts, sent_parts).
+    They are leased for lease_seconds; finish_outbox must record the outcome before
+    that, or they are claimed again. Messages claimed OUTBOX_MAX_ATTEMPTS times
+    without an outcome are marked failed. Returns None on errors.
+    """
+    try:
+        async with get_db_connection(BACKGROUND) as connection, connection.cursor() as cursor:
+            await execute_prepared(cursor, "expire_outbox", (OUTBOX_MAX_ATTEMPTS,))
+            if cursor.rowcount > 0:
+                logging.warning(f"{cursor.rowcount} outbox messages failed after {OUTBOX_MAX_ATTEMPTS} attempts")
+            await execute_prepared(cursor, "claim_outbox", (limit, lease_seconds))
+            rows = await cursor.fetchall()
             await connection.commit()
-            logging.info("Monthly category reports inserted and daily reports updated successfully.")
+            return rows
 
     except (Exception, Error) as e:
-        logging.error("Error inserting monthly category reports: %s", e)
-        if connection:
-            await connection.rollback()
+        logging.error(f"Error claiming outbox messages: {e}")
+        return None
 
-    finally:
-        if connection is not None:
-            await connection.close()
 
+register_statement(
+    "finish_outbox",
+    """
+    UPDATE outbox o
+    SET status = CASE WHEN v.retry_after IS NULL THEN v.status ELSE 'pending' END,
+        sent_parts = v.sent_parts,
+        last_error = v.error,
+        available_at = CASE
+            WHEN v.retry_after IS NULL THEN o.available_at
+            ELSE date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + make_interval(secs => v.retry_after)
+        END,
+        finished_at = CASE
+            WHEN v.retry_after IS NULL THEN date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+        END
+    FROM unnest(%s::bigint[], %s::text[], %s::int[], %s::text[], %s::float8[])
+        AS v(id, status, sent_parts, error, retry_after)
+    WHERE o.id = v.id
+        AND o.status = 'pending';
+    """
+)
 
-async def insert_yearly_category_reports(tg_user_ids: list[int]):
+
+@instrumented
+async def finish_outbox(results: list[tuple[int, str, int, str | None, float | None]]) -> bool:
     """
-    Aggregate the previous year's monthly totals per category for each user,
-    insert into yearly_category_reports with created_date in user's local time.
-    Then update monthly_category_reports.year_id for the inserted yearly report.
+    Records (id, status, sent_parts, error, retry_after) for claimed messages in one
+    statement: status is 'sent' or 'failed'; with a retry_after (seconds) the message
+    stays pending and is due again after it.
     """
-    connection = None
+    if not results:
+        return True
     try:
-        connection = await get_db_connection()
-        async with connection.cursor() as cursor:
-
-            for tg_user_id in tg_user_ids:
-                # Get user's internal id and time_utc
-                await cursor.execute(
-                    "SELECT id, time_utc FROM users WHERE tg_user_id = %s",
-                    (tg_user_id,)
-                )
-                result = await cursor.fetchone()
-                if not result:
-                    continue
-                user_id, time_utc = result
-
-                # Calculate user's local date
-                now_utc = datetime.utcnow()
-                local_time = now_utc + time_utc  # time_utc is INTERVAL in Postgres
-                # Uncomment if you want to restrict to Jan 1
-                if local_time.month != 1 or local_time.day != 1:
-                    logging.info(f"Today is not Jan 1 for user {tg_user_id}. Skipping.")
-                    continue
-
-                prev_year = local_time.year - 1  # last completed year
-                # prev_year = 2025  # for testing manually
-
-                # Aggregate total_amount per category for the previous year
-                await cursor.execute(
-                    """
-                    SELECT 
-                        category_id,
-                        SUM(total_amount) AS total_amount
-                    FROM monthly_category_reports
-                    WHERE user_id = %s
-                        AND EXTRACT(YEAR FROM created_date) = %s
-                    GROUP BY category_id
-                    """,
-                    (user_id, prev_year)
-                )
-                aggregated_rows = await cursor.fetchall()
-
-                for category_id, total_amount in aggregated_rows:
-                    # Insert into yearly_category_reports
-                    await cursor.execute(
-                        """
-                        INSERT INTO yearly_category_reports (
-                            user_id, category_id, total_amount, created_date
-                        )
-                        VALUES (%s, %s, %s, date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + %s)
-                        RETURNING id
-                        """,
-                        (user_id, category_id, total_amount, time_utc)
-                    )
-                    yearly_id_row = await cursor.fetchone()
-                    yearly_id = yearly_id_row[0]
-
-                    # Update monthly_category_reports.year_id where it is null for this user/category
-                    await cursor.execute(
-                        """
-                        UPDATE monthly_category_reports
-                        SET year_id = %s
-                        WHERE user_id = %s
-                            AND category_id = %s
-                            AND year_id IS NULL
-                            AND EXTRACT(YEAR FROM created_date) = %s
-                        """,
-                        (yearly_id, user_id, category_id, prev_year)
-                    )
-
+        async with get_db_connection(BACKGROUND) as connection, connection.cursor() as cursor:
+            await execute_prepared(cursor, "finish_outbox", [list(column) for column in zip(*results)])
             await connection.commit()
-            logging.info("Yearly category reports inserted and monthly reports updated successfully.")
+            return True
 
     except (Exception, Error) as e:
-        logging.error("Error inserting yearly category reports: %s", e)
-        if connection:
-            await connection.rollback()
+        logging.error(f"Error finishing {len(results)} outbox messages: {e}")
+        return False
 
-    finally:
-        if connection is not None:
-            await connection.close()
\ No newline at end of file
+
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', 7))
+
+
+@instrumented
+async def purge_outbox() -> int | None:
+    """Deletes messages finished more than OUTBOX_RETENTION_DAYS ago. Returns how many."""
+    try:
+        async with get_db_connection(BACKGROUND) as connection, connection.cursor() as cursor:
+            await cursor.execute(
+                """
+                DELETE FROM outbox
+                WHERE status <> 'pending'
+                    AND finished_at < (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') - make_interval(days => %s);
+                """,
+                (OUTBOX_RETENTION_DAYS,)
+            )
+            await connection.commit()
+            logging.info(f"Purged {cursor.rowcount} finished outbox messages")
+            return cursor.rowcount
+
+    except (Exception, Error) as e:
+        logging.error(f"Error purging the outbox: {e}")
+        return None
@@ -0,0 +1,158 @@
+import csv
+import gzip
+import io
+import os
+import re
+import asyncio
+from contextlib import contextmanager
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import BinaryIO, Iterator
+
+
+# The CSV format of /import and /export, shared by the storage backends.
+# An import file has a header with date, category, amount and optionally type, comment;
+# an export is written in the same format, so it can be imported again.
+IMPORT_MAX_ROWS = int(os.getenv('IMPORT_MAX_ROWS', 200_000))
+IMPORT_MAX_BYTES = int(os.getenv('IMPORT_MAX_BYTES', 20 * 1024 * 1024))  # Bot API download limit
+IMPORT_PROGRESS_EVERY = int(os.getenv('IMPORT_PROGRESS_EVERY', 10_000))
+IMPORT_MAX_ERRORS = 5  # invalid rows reported back to the user
+MAX_BALANCE = 9_999_999_999.99
+
+import_slots = asyncio.Semaphore(int(os.getenv('IMPORT_CONCURRENCY', 2)))
+
+DATE_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d", "%d.%m.%Y %H:%M", "%d.%m.%Y")
+EXPENSE_VALUES = {"expense", "ex", "e", "-", "1", "true"}
+INCOME_VALUES = {"income", "in", "i", "+", "0", "false"}
+FORBIDDEN_CHARS = re.compile(r'[:;"\'\\<>]')
+REQUIRED_COLUMNS = ("date", "category", "amount")
+OPTIONAL_COLUMNS = ("type", "comment")
+MIN_DATE = datetime(2000, 1, 1)
+
+EXPORT_BATCH = int(os.getenv('EXPORT_BATCH', 5_000))
+EXPORT_COLUMNS = ("date", "category", "amount", "type", "comment")
+
+
+class ImportAborted(Exception):
+    """Rolls the import transaction back and tells the user why (status)."""
+
+    def __init__(self, status: str):
+        super().__init__(status)
+        self.status = status
+
+
+def _parse_date(value: str) -> datetime:
+    value = value.strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"bad date '{value}'")
+
+
+def _parse_amount(value: str) -> Decimal:
+    try:
+        return Decimal(value.replace(" ", "").replace("\u00a0", "").replace(",", ".")).quantize(Decimal("0.01"))
+    except InvalidOperation:
+        raise ValueError(f"bad amount '{value}'")
+
+
+def parse_row(row: list[str], columns: dict[str, int], now_local: datetime) -> tuple:
+    """
+    Validates one CSV row and returns (created_date, is_ex, category_title, amount, comment_text).
+    Without a type, negative amounts are expenses and the rest incomes.
+    Raises ValueError with the reason.
+    """
+    def cell(name: str) -> str:
+        index = columns.get(name)
+        return row[index].strip() if index is not None and index < len(row) else ""
+
+    created_date = _parse_date(cell("date"))
+    if not MIN_DATE <= created_date <= now_local:
+        raise ValueError("date is in the future or before 2000")
+
+    amount = _parse_amount(cell("amount"))
+    kind = cell("type").lower()
+    if kind in EXPENSE_VALUES:
+        is_ex = True
+    elif kind in INCOME_VALUES:
+        is_ex = False
+    elif not kind:
+        is_ex = amount < 0
+    else:
+        raise ValueError(f"bad type '{kind}'")
+    amount = abs(amount)
+    if not (1 <= amount <= 1_000_000_000):
+        raise ValueError("amount must be between 1 and 1,000,000,000")
+
+    title = cell("category")
+    if not title or len(title) > 15 or FORBIDDEN_CHARS.search(title):
+        raise ValueError(f"bad category '{title}'")
+
+    comment = cell("comment") or None
+    if comment and (len(comment) > 30 or FORBIDDEN_CHARS.search(comment)):
+        raise ValueError("bad comment")
+
+    return created_date, is_ex, title, amount, comment
+
+
+def _open_csv(raw: BinaryIO) -> tuple[io.TextIOWrapper, "csv._reader", dict[str, int]]:
+    text = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+    first = text.readline()
+    # Spreadsheets in ru/uz locales export with ';'
+    delimiter = ";" if first.count(";") > first.count(",") else ","
+    header = next(csv.reader([first], delimiter=delimiter), [])
+    columns = {name.strip().lower(): index for index, name in enumerate(header)}
+    columns = {name: index for name, index in columns.items() if name in REQUIRED_COLUMNS + OPTIONAL_COLUMNS}
+    if any(name not in columns for name in REQUIRED_COLUMNS):
+        text.detach()
+        raise ImportAborted("bad_header")
+    return text, csv.reader(text, delimiter=delimiter), columns
+
+
+def read_rows(raw: BinaryIO, now_local: datetime, result: dict) -> Iterator[tuple]:
+    """
+    Yields (line_no, created_date, is_ex, category_title, amount, comment_text) for every
+    valid row of the file. Invalid rows are counted in result["skipped"] and the first
+    IMPORT_MAX_ERRORS of them described in result["errors"]; valid ones in result["imported"].
+    Raises ImportAborted for a bad header or more than IMPORT_MAX_ROWS valid rows.
+    Use it with contextlib.closing, so raw is handed back to the caller on errors too.
+    """
+    text, reader, columns = _open_csv(raw)
+    try:
+        # Line 1 is the header
+        for line_no, row in enumerate(reader, start=2):
+            if not any(cell.strip() for cell in row):
+                continue
+            try:
+                parsed = parse_row(row, columns, now_local)
+            except ValueError as e:
+                result["skipped"] += 1
+                if len(result["errors"]) < IMPORT_MAX_ERRORS:
+                    result["errors"].append(f"{line_no}: {e}")
+                continue
+
+            result["imported"] += 1
+            if result["imported"] > IMPORT_MAX_ROWS:
+                raise ImportAborted("too_many_rows")
+            yield (line_no, *parsed)
+    finally:
+        # Leave the file to the caller
+        text.detach()
+
+
+@contextmanager
+def export_writer(destination: BinaryIO, compress: bool = False):
+    """csv.writer over destination (gzip-compressed if asked) with the header already written."""
+    stream = gzip.GzipFile(fileobj=destination, mode="wb") if compress else destination
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    try:
+        writer = csv.writer(text)
+        writer.writerow(EXPORT_COLUMNS)
+        yield writer
+    finally:
+        text.flush()
+        text.detach()
+        if compress:
+            stream.close()
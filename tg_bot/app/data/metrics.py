@@ -0,0 +1,178 @@
+import os
+import re
+import time
+import bisect
+import logging
+import functools
+from contextvars import ContextVar
+
+from psycopg import AsyncCursor
+
+
+# Latency buckets in milliseconds, the last one catches everything slower
+BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1_000, 2_000, 5_000, 10_000, float("inf"))
+SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', 200))
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+class LatencyStats:
+    """Call/error/row counters and a fixed-bucket latency histogram."""
+
+    __slots__ = ("calls", "errors", "rows", "total_ms", "max_ms", "buckets")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * len(BUCKETS_MS)
+
+    def record(self, elapsed_ms: float, rows: int = 0, error: bool = False):
+        self.calls += 1
+        self.errors += error
+        self.rows += rows
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.buckets[bisect.bisect_left(BUCKETS_MS, elapsed_ms)] += 1
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th percentile (max for the open bucket)."""
+        if not self.calls:
+            return 0.0
+        rank = q * self.calls
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "rows": self.rows,
+            "avg_ms": round(self.total_ms / self.calls, 2) if self.calls else 0.0,
+            "p50_ms": round(self.percentile(0.50), 2),
+            "p95_ms": round(self.percentile(0.95), 2),
+            "p99_ms": round(self.percentile(0.99), 2),
+            "max_ms": round(self.max_ms, 2),
+        }
+
+
+_stats: dict[str, LatencyStats] = {}
+
+
+class _Call:
+    __slots__ = ("name", "rows", "errors")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.rows = 0
+        self.errors = 0
+
+
+# The instrumented dbContext function currently running in this task
+_current_call: ContextVar[_Call | None] = ContextVar("db_current_call", default=None)
+
+
+def instrumented(func):
+    """
+    Records calls, latency, rows and errors of a dbContext function. Most of them
+    catch their exceptions and return None, so query errors are counted by
+    InstrumentedCursor and attributed to the function here.
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        call = _Call(name)
+        token = _current_call.set(call)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await func(*args, **kwargs)
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            _current_call.reset(token)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            _stats.setdefault(name, LatencyStats()).record(
+                elapsed_ms, call.rows, failed or call.errors > 0
+            )
+
+    return wrapper
+
+
+def _redact(params) -> str:
+    """Only the shape of the parameters is logged, never user data."""
+    if params is None:
+        return "()"
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{key}: <{type(value).__name__}>" for key, value in params.items()) + "}"
+    return "(" + ", ".join(
+        f"<{type(value).__name__}[{len(value)}]>" if isinstance(value, (list, tuple)) else f"<{type(value).__name__}>"
+        for value in params
+    ) + ")"
+
+
+class InstrumentedCursor(AsyncCursor):
+    """
+    Cursor used by the pools: attributes rows and failed queries to the running
+    instrumented function and logs statements slower than DB_SLOW_QUERY_MS.
+    In pipeline mode execute only queues, so there only the function is timed.
+    """
+
+    async def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        call = _current_call.get()
+        try:
+            result = await super().execute(query, params, **kwargs)
+        except BaseException:
+            if call is not None:
+                call.errors += 1
+            raise
+
+        if getattr(self.connection, "_pipeline", None) is None:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if call is not None and self.rowcount > 0:
+                call.rows += self.rowcount
+            if elapsed_ms >= SLOW_QUERY_MS:
+                sql = query if isinstance(query, str) else repr(query)
+                logging.warning(
+                    f"Slow query in {call.name if call else '?'}: {elapsed_ms:.1f}ms "
+                    f"{_WHITESPACE.sub(' ', sql).strip()} params={_redact(params)}"
+                )
+        return result
+
+
+def get_query_stats() -> dict[str, dict]:
+    return {name: stats.as_dict() for name, stats in sorted(_stats.items())}
+
+
+def reset_query_stats():
+    _stats.clear()
+
+
+def format_query_stats() -> str:
+    """Text table of get_query_stats(), slowest p95 first."""
+    rows = sorted(get_query_stats().items(), key=lambda item: item[1]["p95_ms"], reverse=True)
+    lines = [f"{'function':<36} {'calls':>8} {'errors':>7} {'rows':>9} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>9}"]
+    for name, s in rows:
+        lines.append(
+            f"{name:<36} {s['calls']:>8} {s['errors']:>7} {s['rows']:>9} "
+            f"{s['p50_ms']:>8} {s['p95_ms']:>8} {s['p99_ms']:>8} {s['max_ms']:>9}"
+        )
+    return "\n".join(lines)
+
+
+def format_statement_stats(stats: dict[str, dict[str, int]]) -> str:
+    """Text table of the prepared statement counters (dbContext.get_statement_stats), most called first."""
+    rows = sorted(stats.items(), key=lambda item: item[1]["calls"], reverse=True)
+    lines = [f"{'statement':<36} {'calls':>8} {'prepares':>9} {'saved':>8}"]
+    for name, s in rows:
+        lines.append(f"{name:<36} {s['calls']:>8} {s['prepares']:>9} {s['calls'] - s['prepares']:>8}")
+    return "\n".join(lines)
@@ -0,0 +1,397 @@
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import re
+import sys
+import asyncio
+import logging
+import argparse
+from pathlib import Path
+from datetime import datetime, timedelta
+
+import psycopg
+from psycopg import Error
+
+import app.data.dbContext as db
+
+
+MIGRATIONS_DIR = Path(__file__).resolve().parents[2] / "migrations"
+MIGRATION_FILE_RE = re.compile(r"^(\d+)_(\w+)\.sql$")
+# Any constant works, it only has to be the same for every bot instance
+MIGRATION_LOCK_ID = 720_314_001
+# The schema the queries in _BASELINE_QUERIES were written for; the registered
+# statements need the later migrations
+BASELINE_SCHEMA_VERSION = 1
+
+
+def load_migrations() -> list[tuple[int, str, Path]]:
+    """
+    Returns (version, name, path) for every migrations/NNNN_name.sql file, ordered by version.
+    """
+    migrations = []
+    for path in MIGRATIONS_DIR.glob("*.sql"):
+        match = MIGRATION_FILE_RE.match(path.name)
+        if not match:
+            logging.warning(f"Skipping {path.name}: not a NNNN_name.sql migration")
+            continue
+        migrations.append((int(match.group(1)), match.group(2), path))
+
+    migrations.sort()
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError(f"Duplicate migration versions in {MIGRATIONS_DIR}")
+    return migrations
+
+
+async def get_applied_versions(conn) -> set[int]:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL DEFAULT date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+        );
+        """
+    )
+    cursor = await conn.execute("SELECT version FROM schema_migrations;")
+    return {row[0] for row in await cursor.fetchall()}
+
+
+async def run_migrations(explain_report: str | None = None) -> list[int]:
+    """
+    Applies every pending migration, each in its own transaction, and returns
+    the applied versions. A session advisory lock keeps two bot instances from
+    migrating at the same time.
+
+    If explain_report is given and something is pending, EXPLAIN ANALYZE of the
+    hot queries is captured before and after and written there as markdown.
+    """
+    conn = await db.get_direct_connection(autocommit=True)
+    applied_now = []
+    try:
+        await conn.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_ID,))
+        try:
+            applied = await get_applied_versions(conn)
+            pending = [m for m in load_migrations() if m[0] not in applied]
+            if not pending:
+                logging.info("Database schema is up to date.")
+                return applied_now
+
+            # On the baseline schema the registered statements cannot run yet: the
+            # before plans are of the queries as they were then
+            baseline = all(version <= BASELINE_SCHEMA_VERSION for version in applied)
+            before = await explain_hot_queries(baseline) if explain_report else None
+
+            for version, name, path in pending:
+                started = datetime.utcnow()
+                async with conn.transaction():
+                    await conn.execute(path.read_text(encoding="utf-8"))
+                    await conn.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s);",
+                        (version, name)
+                    )
+                applied_now.append(version)
+                logging.info(f"Applied migration {version:04d}_{name} in {(datetime.utcnow() - started).total_seconds():.2f}s")
+
+            if explain_report:
+                # Tables and partitions the migrations created have no statistics yet
+                await conn.execute("ANALYZE;")
+                after = await explain_hot_queries()
+                write_explain_report(explain_report, before, after, pending)
+
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_ID,))
+
+    finally:
+        await conn.close()
+
+    return applied_now
+
+
+async def _sample_user(conn) -> dict | None:
+    """The most recent user with at least one category, used as EXPLAIN parameters."""
+    cursor = await conn.execute(
+        """
+        SELECT u.id, u.tg_user_id, u.time_utc, c.id
+        FROM users u
+        JOIN categories c ON c.user_id = u.id
+        ORDER BY u.id DESC
+        LIMIT 1;
+        """
+    )
+    row = await cursor.fetchone()
+    if not row:
+        return None
+    return {"user_id": row[0], "tg_user_id": row[1], "time_utc": row[2], "category_id": row[3]}
+
+
+def _explain_targets(sample: dict) -> list[tuple[str, object]]:
+    """(registered statement name, sample parameters) for every query in the report."""
+    return [
+        ("todays_dengies_for_users", {"tg_user_ids": [sample["tg_user_id"]], "per_user_limit": None, "days_ago": 0}),
+        ("todays_expense_count", {"user_id": sample["user_id"], "time_utc": sample["time_utc"]}),
+        ("last_amounts", (sample["user_id"], sample["category_id"], db.AMOUNT_SEED_ROWS)),
+        ("active_categories_by_type", (True, sample["user_id"])),
+        ("infos_get_user", (sample["tg_user_id"],)),
+        ("users_by_offsets", ([sample["time_utc"]],)),
+        ("incremental_rollups", ([sample["tg_user_id"]],)),
+        ("daily_digests", {"tg_user_ids": [sample["tg_user_id"]], "days_ago": 1}),
+    ]
+
+
+# The hot queries before the migrations, as dbContext ran them on the baseline
+# schema, for the before plans of the report
+_BASELINE_QUERIES = {
+    "todays_dengies": """
+        SELECT
+            d.amount,
+            c.title AS category_name,
+            d.comment_text,
+            to_char(d.created_date, 'HH24:MI') AS created_time,
+            u.currency_is
+        FROM dengies d
+        JOIN categories c ON d.category_id = c.id
+        JOIN users u ON d.user_id = u.id
+        WHERE
+            u.tg_user_id = %s
+            AND c.is_ex = TRUE
+            AND date_trunc('day', d.created_date) =
+                date_trunc('day', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc)
+        ORDER BY d.created_date DESC;
+    """,
+    "todays_expense_count": """
+        SELECT COUNT(*)
+        FROM dengies d
+        JOIN users u ON d.user_id = u.id
+        WHERE u.tg_user_id = %s
+        AND d.created_date::date = (CURRENT_TIMESTAMP AT TIME ZONE 'UTC' + u.time_utc::interval)::date;
+    """,
+    "last_amounts": """
+        SELECT amount, id
+        FROM (
+            SELECT DISTINCT ON (amount) amount, id
+            FROM dengies
+            WHERE category_id = %s
+            AND user_id = (SELECT id FROM users WHERE tg_user_id = %s)
+            ORDER BY amount, id
+        ) AS distinct_amounts
+        ORDER BY id DESC
+        LIMIT 5;
+    """,
+    "is_premium": "SELECT is_premium, id FROM users WHERE tg_user_id = %s LIMIT 1;",
+    "active_categories_by_type": """
+        SELECT c.id, c.title
+        FROM categories AS c
+        WHERE c.is_active = TRUE
+          AND c.is_ex = %s
+          AND c.user_id = %s;
+    """,
+    "infos_get_user": """
+        SELECT
+            u.balans,
+            u.currency_is,
+            u.language_is AS lang_code,
+            u.is_premium,
+            TO_CHAR(u.premium_date, 'YYYY-MM-DD') AS premium_date,
+            COALESCE((
+                SELECT SUM(dr.total_amount)
+                FROM daily_reports dr
+                WHERE dr.user_id = u.id
+                  AND dr.is_ex = TRUE
+                  AND DATE_TRUNC('month', dr.created_date) =
+                      DATE_TRUNC('month', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc::interval)
+            ), 0) AS monthly_expenses,
+            COALESCE((
+                SELECT SUM(dr.total_amount)
+                FROM daily_reports dr
+                WHERE dr.user_id = u.id
+                  AND dr.is_ex = FALSE
+                  AND DATE_TRUNC('month', dr.created_date) =
+                      DATE_TRUNC('month', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc::interval)
+            ), 0) AS monthly_income
+        FROM users u
+        WHERE u.tg_user_id = %s
+        LIMIT 1;
+    """,
+    "users_by_time": """
+        SELECT tg_user_id, language_is
+        FROM users
+        WHERE time_utc = CAST(%s AS INTERVAL);
+    """,
+    "daily_category_totals": """
+        SELECT
+            d.category_id,
+            SUM(d.amount) AS total_amount,
+            u.id AS user_id,
+            u.time_utc
+        FROM dengies d
+        JOIN users u ON d.user_id = u.id
+        WHERE
+            u.tg_user_id = %s
+            AND date_trunc('day', d.created_date) =
+                date_trunc('day', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc)
+        GROUP BY d.category_id, u.id, u.time_utc;
+    """,
+    "daily_totals": """
+        SELECT
+            u.id AS user_id,
+            u.time_utc,
+            SUM(d.amount) AS total_amount,
+            CASE
+                WHEN c.is_ex THEN TRUE
+                ELSE FALSE
+            END AS is_ex
+        FROM dengies d
+        JOIN users u ON d.user_id = u.id
+        JOIN categories c ON c.id = d.category_id
+        WHERE u.tg_user_id = %s
+            AND date_trunc('day', d.created_date) =
+                date_trunc('day', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc)
+        GROUP BY u.id, u.time_utc, is_ex;
+    """,
+    "monthly_totals": """
+        SELECT
+            category_id,
+            SUM(total_amount) AS total_amount
+        FROM daily_category_reports
+        WHERE user_id = %s
+            AND EXTRACT(MONTH FROM created_date) = %s
+            AND EXTRACT(YEAR FROM created_date) = %s
+            AND month_id IS NULL
+        GROUP BY category_id
+    """,
+    "yearly_totals": """
+        SELECT
+            category_id,
+            SUM(total_amount) AS total_amount
+        FROM monthly_category_reports
+        WHERE user_id = %s
+            AND EXTRACT(YEAR FROM created_date) = %s
+        GROUP BY category_id
+    """,
+}
+
+
+def _baseline_targets(sample: dict) -> list[tuple[str, list[tuple[str, object]]]]:
+    """
+    (report name, [(baseline query text, sample parameters)]) for the queries of
+    _explain_targets: the queries each of them replaced, by the same name.
+    """
+    previous_month = datetime.utcnow().replace(day=1) - timedelta(days=1)
+    todays_dengies = [(_BASELINE_QUERIES["todays_dengies"], (sample["tg_user_id"],))]
+    return [
+        # The digest listed and summed todays_dengies, one query per user
+        ("todays_dengies_for_users", todays_dengies),
+        ("todays_expense_count", [(_BASELINE_QUERIES["todays_expense_count"], (sample["tg_user_id"],))]),
+        ("last_amounts", [(_BASELINE_QUERIES["last_amounts"], (sample["category_id"], sample["tg_user_id"]))]),
+        ("active_categories_by_type", [
+            (_BASELINE_QUERIES["is_premium"], (sample["tg_user_id"],)),
+            (_BASELINE_QUERIES["active_categories_by_type"], (True, sample["user_id"])),
+        ]),
+        ("infos_get_user", [(_BASELINE_QUERIES["infos_get_user"], (sample["tg_user_id"],))]),
+        ("users_by_offsets", [(_BASELINE_QUERIES["users_by_time"], (sample["time_utc"],))]),
+        # The sums of the daily, monthly and yearly reports; their INSERTs are single rows
+        ("incremental_rollups", [
+            (_BASELINE_QUERIES["daily_totals"], (sample["tg_user_id"],)),
+            (_BASELINE_QUERIES["daily_category_totals"], (sample["tg_user_id"],)),
+            (_BASELINE_QUERIES["monthly_totals"], (sample["user_id"], previous_month.month, previous_month.year)),
+            (_BASELINE_QUERIES["yearly_totals"], (sample["user_id"], previous_month.year)),
+        ]),
+        ("daily_digests", todays_dengies),
+    ]
+
+
+def _explain_queries(sample: dict, baseline: bool) -> list[tuple[str, list[tuple[str, object]]]]:
+    if baseline:
+        return _baseline_targets(sample)
+    return [(name, [(db.PREPARED_STATEMENTS[name], params)]) for name, params in _explain_targets(sample)]
+
+
+async def explain_hot_queries(baseline: bool = False) -> dict[str, str]:
+    """
+    EXPLAIN (ANALYZE, BUFFERS) for the registered hot statements, or with baseline
+    for the queries they replaced (_baseline_targets).
+    Every statement runs in a transaction that is always rolled back,
+    so the rollups do not leave rows behind or move watermarks.
+    """
+    plans: dict[str, str] = {}
+    conn = await db.get_direct_connection()
+    try:
+        sample = await _sample_user(conn)
+        await conn.rollback()
+        if sample is None:
+            logging.warning("No users with categories, skipping EXPLAIN report.")
+            return plans
+
+        # Client-side binding, so the plan is made for the actual sample values
+        cursor = psycopg.AsyncClientCursor(conn)
+        for name, queries in _explain_queries(sample, baseline):
+            try:
+                query_plans = []
+                async with conn.transaction(force_rollback=True):
+                    for query, params in queries:
+                        await cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, params)
+                        query_plans.append("\n".join(row[0] for row in await cursor.fetchall()))
+                plans[name] = "\n\n".join(query_plans)
+            except (Exception, Error) as e:
+                plans[name] = f"EXPLAIN failed: {e}"
+            await conn.rollback()
+
+    except (Exception, Error) as e:
+        logging.error(f"Error while collecting EXPLAIN plans: {e}")
+
+    finally:
+        await conn.close()
+
+    return plans
+
+
+def write_explain_report(path: str, before: dict[str, str], after: dict[str, str], migrations: list):
+    lines = [
+        "# EXPLAIN report",
+        "",
+        f"Generated {datetime.utcnow():%Y-%m-%d %H:%M} UTC around migrations: "
+        + ", ".join(f"{version:04d}_{name}" for version, name, _ in migrations),
+        "",
+        "Before: the plans before them; from the baseline schema, of the queries dbContext",
+        "ran then (one plan per query). After: the registered statements.",
+        "",
+    ]
+    for name in sorted(set(before) | set(after)):
+        lines += [
+            f"## {name}",
+            "",
+            "Before:",
+            "```",
+            before.get(name, "(not collected)"),
+            "```",
+            "",
+            "After:",
+            "```",
+            after.get(name, "(not collected)"),
+            "```",
+            "",
+        ]
+    Path(path).write_text("\n".join(lines), encoding="utf-8")
+    logging.info(f"EXPLAIN report written to {path}")
+
+
+async def main(argv: list[str]):
+    parser = argparse.ArgumentParser(description="Apply pending tg_bot schema migrations.")
+    parser.add_argument("--explain-report", help="write before/after EXPLAIN ANALYZE of the hot queries to this file")
+    parser.add_argument("--explain-only", action="store_true", help="only print EXPLAIN ANALYZE of the hot queries")
+    args = parser.parse_args(argv)
+
+    if args.explain_only:
+        for name, plan in (await explain_hot_queries()).items():
+            print(f"## {name}\n{plan}\n")
+        return
+
+    applied = await run_migrations(explain_report=args.explain_report)
+    print(f"Applied migrations: {applied or 'none'}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(sys.argv[1:]))
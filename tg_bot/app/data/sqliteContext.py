@@ -0,0 +1,1406 @@
+import re
+import json
+import time
+import asyncio
+import logging
+import aiosqlite
+import app.cmn.transtalor as translator
+import app.cmn.zones as zones
+from contextlib import asynccontextmanager, closing
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal, ROUND_HALF_UP
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, BinaryIO, Callable, Optional
+from app.data.ledger_csv import (
+    IMPORT_PROGRESS_EVERY, MAX_BALANCE, EXPORT_BATCH, ImportAborted, import_slots, read_rows, export_writer
+)
+from app.data.metrics import instrumented
+from app.data.suggestions import AmountStats, RecentValues, RANKINGS, RECENT
+import os
+
+
+# Embedded storage backend: the functions of dbContext on one SQLite file in WAL mode,
+# selected with STORAGE_BACKEND=sqlite (see storage.py). WAL lets the reader connection
+# run while a write is in progress; writes go through one connection, one at a time.
+# Schema: migrations/sqlite, where money is kept as integer cents and time_utc in seconds.
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'tg_bot.sqlite3')
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+# Kept for parity with the Postgres backend, SQLite has no separate pools
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+MIGRATIONS_DIR = Path(__file__).resolve().parents[2] / "migrations" / "sqlite"
+MIGRATION_FILE_RE = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+_write_conn: aiosqlite.Connection | None = None
+_read_conn: aiosqlite.Connection | None = None
+_open_lock: asyncio.Lock | None = None
+_write_lock: asyncio.Lock | None = None
+
+
+def _lower(value):
+    return value.lower() if isinstance(value, str) else value
+
+
+async def _connect(read_only: bool = False) -> aiosqlite.Connection:
+    # isolation_level=None: transactions are only the ones opened by _transaction
+    conn = await aiosqlite.connect(SQLITE_PATH, isolation_level=None)
+    await conn.execute("PRAGMA journal_mode = WAL;")
+    # In WAL mode NORMAL only risks the last commits on power loss, never corruption
+    await conn.execute("PRAGMA synchronous = NORMAL;")
+    await conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS};")
+    await conn.execute("PRAGMA foreign_keys = ON;")
+    if read_only:
+        await conn.execute("PRAGMA query_only = ON;")
+    # The built-in lower() only folds ASCII, category titles are often Cyrillic
+    await conn.create_function("ulower", 1, _lower, deterministic=True)
+    return conn
+
+
+def _get_open_lock() -> asyncio.Lock:
+    global _open_lock
+    if _open_lock is None:
+        _open_lock = asyncio.Lock()
+    return _open_lock
+
+
+def _get_write_lock() -> asyncio.Lock:
+    global _write_lock
+    if _write_lock is None:
+        _write_lock = asyncio.Lock()
+    return _write_lock
+
+
+async def open_pools():
+    """Open the writer and the reader connection (the name matches the Postgres backend)."""
+    global _write_conn, _read_conn
+    async with _get_open_lock():
+        if _write_conn is None:
+            _write_conn = await _connect()
+        if _read_conn is None:
+            _read_conn = await _connect(read_only=True)
+    logging.info(f"Opened SQLite database {SQLITE_PATH}")
+
+
+async def close_pools():
+    global _write_conn, _read_conn
+    for conn in (_read_conn, _write_conn):
+        if conn is not None:
+            await conn.close()
+    _write_conn = _read_conn = None
+    logging.info("Closed SQLite database")
+
+
+@asynccontextmanager
+async def _transaction(conn: aiosqlite.Connection | None = None) -> AsyncIterator[aiosqlite.Connection]:
+    """
+    BEGIN IMMEDIATE ... COMMIT on the writer connection (or conn), rolled back on error.
+    Writers of this process queue on a lock instead of busy-waiting on the file lock.
+    """
+    if conn is None:
+        if _write_conn is None:
+            await open_pools()
+        conn = _write_conn
+
+    async with _get_write_lock():
+        await conn.execute("BEGIN IMMEDIATE;")
+        try:
+            yield conn
+        except BaseException:
+            await conn.execute("ROLLBACK;")
+            raise
+        await conn.execute("COMMIT;")
+
+
+async def _reader() -> aiosqlite.Connection:
+    if _read_conn is None:
+        await open_pools()
+    return _read_conn
+
+
+async def _fetchone(conn: aiosqlite.Connection, query: str, params=()):
+    async with conn.execute(query, params) as cursor:
+        return await cursor.fetchone()
+
+
+async def _fetchall(conn: aiosqlite.Connection, query: str, params=()) -> list:
+    async with conn.execute(query, params) as cursor:
+        return await cursor.fetchall()
+
+
+async def _execute(conn: aiosqlite.Connection, query: str, params=()) -> int:
+    """Runs a statement and returns its rowcount."""
+    async with conn.execute(query, params) as cursor:
+        return cursor.rowcount
+
+
+async def run_migrations(explain_report: str | None = None) -> list[int]:
+    """
+    Applies the pending migrations/sqlite/NNNN_name.sql files, each in its own
+    transaction, and returns the applied versions. explain_report is Postgres only.
+    """
+    migrations = []
+    for path in MIGRATIONS_DIR.glob("*.sql"):
+        match = MIGRATION_FILE_RE.match(path.name)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), path))
+    migrations.sort()
+
+    if _write_conn is None:
+        await open_pools()
+    await _write_conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL DEFAULT (datetime('now'))
+        );
+        """
+    )
+    applied = {row[0] for row in await _fetchall(_write_conn, "SELECT version FROM schema_migrations;")}
+
+    applied_now = []
+    async with _get_write_lock():
+        for version, name, path in migrations:
+            if version in applied:
+                continue
+            # executescript runs outside of the sqlite3 module's transaction handling,
+            # so the transaction is part of the script
+            try:
+                await _write_conn.executescript(
+                    "BEGIN IMMEDIATE;\n"
+                    + path.read_text(encoding="utf-8")
+                    + f"\nINSERT INTO schema_migrations (version, name) VALUES ({version}, '{name}');\nCOMMIT;"
+                )
+            except Exception:
+                if _write_conn.in_transaction:
+                    await _write_conn.execute("ROLLBACK;")
+                raise
+            applied_now.append(version)
+            logging.info(f"Applied SQLite migration {version:04d}_{name}")
+
+    if not applied_now:
+        logging.info("SQLite schema is up to date.")
+    return applied_now
+
+
+
+# Conversions between the Postgres-shaped values handlers expect and the SQLite columns
+_CENTS = Decimal("0.01")
+# SQL date modifier for the user's UTC offset: date('now', <offset>) is their local date
+_LOCAL_OFFSET = "u.time_utc || ' seconds'"
+# SQL date modifier going :days_ago days back from it
+_DAYS_AGO = "-:days_ago || ' days'"
+
+
+def _to_cents(amount) -> int:
+    return int((Decimal(str(amount)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def _from_cents(cents) -> Decimal:
+    return (Decimal(cents or 0) / 100).quantize(_CENTS)
+
+
+def _offset_seconds(time_utc) -> int:
+    return int(time_utc.total_seconds()) if isinstance(time_utc, timedelta) else int(time_utc)
+
+
+def _local_now(time_utc: timedelta) -> datetime:
+    return datetime.utcnow().replace(microsecond=0) + time_utc
+
+
+def _ts(value: datetime) -> str:
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _ids_json(ids: list[int]) -> str:
+    """A list parameter, read in SQL with json_each (SQLite has no arrays)."""
+    return json.dumps([int(i) for i in ids])
+
+
+
+@instrumented
+async def get_user_identity(tg_user_id: int) -> dict | None:
+    """
+    Returns {id, time_utc, language_is, is_premium, currency_is} for a Telegram user,
+    or None if the user is not registered.
+    """
+    try:
+        row = await _fetchone(
+            await _reader(),
+            """
+            SELECT id, time_utc, language_is, is_premium, currency_is
+            FROM users
+            WHERE tg_user_id = ?
+            LIMIT 1;
+            """,
+            (tg_user_id,)
+        )
+
+    except Exception as e:
+        logging.error(f"Error fetching identity for tg_user_id {tg_user_id}: {e}")
+        return None
+
+    if row is None:
+        return None
+    return {
+        "id": row[0],
+        "time_utc": timedelta(seconds=row[1]),
+        "language_is": row[2],
+        "is_premium": bool(row[3]),
+        "currency_is": row[4],
+    }
+
+
+def invalidate_user(tg_user_id: int):
+    """Nothing is cached in front of SQLite, reads are local."""
+
+
+@instrumented
+async def get_todays_dengies_for_users(tg_user_ids: list[int], per_user_limit: int | None = None, days_ago: int = 0) -> dict[int, list[tuple]] | None:
+    """
+    Today's expenses of many users in one query: {tg_user_id: rows} of (amount,
+    title, comment_text, created_time, currency_is), latest first; with
+    per_user_limit only the latest rows of each user, with days_ago the rows of
+    that many local days before today. None on errors.
+    """
+    try:
+        rows = await _fetchall(
+            await _reader(),
+            f"""
+            SELECT tg_user_id, amount, title, comment_text, created_time, currency_is
+            FROM (
+                SELECT
+                    u.tg_user_id,
+                    d.amount,
+                    c.title,
+                    d.comment_text,
+                    strftime('%H:%M', d.created_date) AS created_time,
+                    u.currency_is,
+                    d.created_date,
+                    ROW_NUMBER() OVER (PARTITION BY u.id ORDER BY d.created_date DESC) AS n
+                FROM users u
+                JOIN dengies d ON d.user_id = u.id
+                JOIN categories c ON d.category_id = c.id
+                WHERE
+                    u.tg_user_id IN (SELECT value FROM json_each(:ids))
+                    AND c.is_ex = 1
+                    AND d.created_date >= date('now', {_LOCAL_OFFSET}, {_DAYS_AGO})
+                    AND d.created_date < date('now', {_LOCAL_OFFSET}, {_DAYS_AGO}, '+1 day')
+            )
+            WHERE :per_user_limit IS NULL OR n <= :per_user_limit
+            ORDER BY tg_user_id, created_date DESC;
+            """,
+            {"ids": _ids_json(tg_user_ids), "per_user_limit": per_user_limit, "days_ago": days_ago}
+        )
+
+    except Exception as error:
+        logging.error("Error while fetching today's dengies of %s users: %s", len(tg_user_ids), error)
+        return None
+
+    rows_by_user: dict[int, list[tuple]] = {}
+    for row in rows:
+        rows_by_user.setdefault(row[0], []).append((_from_cents(row[1]), *row[2:]))
+    logging.info(f"Fetched today's records of {len(rows_by_user)}/{len(tg_user_ids)} users")
+    return rows_by_user
+
+
+@instrumented
+async def get_daily_digests(tg_user_ids: list[int], days_ago: int = 0) -> dict[int, dict] | None:
+    """
+    The expense summary of each user's local day, today or days_ago days before it,
+    from the daily rollups, in one query:
+    {tg_user_id: {currency, total, entries, categories: [(title, amount)]}}.
+    Run after the day's rollups. None on errors.
+    """
+    try:
+        rows = await _fetchall(
+            await _reader(),
+            f"""
+            SELECT
+                u.tg_user_id,
+                u.currency_is,
+                dr.total_amount,
+                COALESCE(t.entries_count, 0),
+                c.title,
+                dcr.total_amount
+            FROM users u
+            JOIN daily_reports dr
+                ON dr.user_id = u.id
+                AND dr.period_start = date('now', {_LOCAL_OFFSET}, {_DAYS_AGO})
+                AND dr.is_ex = 1
+            JOIN daily_category_reports dcr
+                ON dcr.user_id = u.id
+                AND dcr.period_start = date('now', {_LOCAL_OFFSET}, {_DAYS_AGO})
+            JOIN categories c ON c.id = dcr.category_id AND c.is_ex = 1
+            LEFT JOIN user_day_totals t
+                ON t.user_id = u.id
+                AND t.local_day = date('now', {_LOCAL_OFFSET}, {_DAYS_AGO})
+                AND t.is_ex = 1
+            WHERE u.tg_user_id IN (SELECT value FROM json_each(:ids))
+            ORDER BY u.tg_user_id, dcr.total_amount DESC, c.title;
+            """,
+            {"ids": _ids_json(tg_user_ids), "days_ago": days_ago}
+        )
+
+    except Exception as error:
+        logging.error("Error while fetching daily digests of %s users: %s", len(tg_user_ids), error)
+        return None
+
+    digests: dict[int, dict] = {}
+    for tg_user_id, currency, total, entries, title, amount in rows:
+        digest = digests.get(tg_user_id)
+        if digest is None:
+            digest = digests[tg_user_id] = {
+                "currency": currency,
+                "total": _from_cents(total),
+                "entries": entries,
+                "categories": [],
+            }
+        digest["categories"].append((title, _from_cents(amount)))
+    return digests
+
+ROLLUP_CHUNK_SIZE = int(os.getenv('ROLLUP_CHUNK_SIZE', 1000))
+
+
+def _chunks(items: list, size: int = ROLLUP_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+# Incremental rollups, see dbContext.py: the rows above each user's watermark
+# (rollup_watermarks) are added to the reports of their day, month and year.
+def _rollup_level(table: str, key: str, period: str, parent: tuple[str, str, str] | None = None) -> str:
+    """
+    The upsert adding the rows in rollup_delta to the row of their period in table
+    (per user and key column, the *_period_key index of migration 0004), inserting
+    the periods without a row. period is the period_start of a rollup_delta row.
+    With parent (link column, parent table, the parent's period_start of a row) the
+    rows are linked to the parent level, which is rolled up first.
+    """
+    link_set = link_column = link_value = ""
+    if parent:
+        column, parent_table, parent_period = parent
+        link_set = f", {column} = COALESCE({column}, excluded.{column})"
+        link_column = f", {column}"
+        link_value = (
+            f", (SELECT p.id FROM {parent_table} p WHERE p.user_id = r.user_id "
+            f"AND p.category_id = r.category_id AND p.period_start = {parent_period.format('r.period_start')})"
+        )
+
+    # WHERE true: without it SQLite would read ON CONFLICT as part of the join
+    return f"""
+    INSERT INTO {table} (user_id, {key}, period_start, total_amount, created_date{link_column})
+    SELECT r.user_id, r.{key}, r.period_start, r.amount, datetime('now', r.time_utc || ' seconds'){link_value}
+    FROM (
+        SELECT user_id, {key}, {period.format('day')} AS period_start, SUM(amount) AS amount, MAX(time_utc) AS time_utc
+        FROM rollup_delta
+        GROUP BY user_id, {key}, {period.format('day')}
+    ) r
+    WHERE true
+    ON CONFLICT (user_id, period_start, {key}) DO UPDATE
+    SET total_amount = total_amount + excluded.total_amount{link_set};
+    """
+
+
+_YEAR = "strftime('%Y-01-01', {})"
+_MONTH = "strftime('%Y-%m-01', {})"
+_DAY = "{}"
+
+# Years first, so months link to their year and days to their month
+_ROLLUP_LEVELS = (
+    _rollup_level("yearly_category_reports", "category_id", _YEAR),
+    _rollup_level("monthly_category_reports", "category_id", _MONTH, ("year_id", "yearly_category_reports", _YEAR)),
+    _rollup_level("daily_category_reports", "category_id", _DAY, ("month_id", "monthly_category_reports", _MONTH)),
+    _rollup_level("daily_reports", "is_ex", _DAY),
+)
+
+_ROLLUP_WATERMARKS = """
+    INSERT INTO rollup_watermarks (user_id, last_dengies_id, updated_at)
+    SELECT user_id, MAX(id), datetime('now')
+    FROM rollup_delta
+    GROUP BY user_id
+    ON CONFLICT (user_id) DO UPDATE
+    SET last_dengies_id = excluded.last_dengies_id,
+        updated_at = excluded.updated_at;
+    """
+
+
+async def _rollup(conn, ids: str) -> list[int]:
+    # SQLite has no data-modifying CTEs: the new rows are copied to a temp table once
+    # and summed up from there. The writer lock is held for the whole transaction,
+    # so no row can be inserted below the new watermark meanwhile.
+    await conn.execute(
+        """
+        CREATE TEMP TABLE IF NOT EXISTS rollup_delta (
+            id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            category_id INTEGER NOT NULL,
+            is_ex INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            time_utc INTEGER NOT NULL
+        );
+        """
+    )
+    await conn.execute("DELETE FROM rollup_delta;")
+    entries = await _execute(
+        conn,
+        """
+        INSERT INTO rollup_delta (id, user_id, category_id, is_ex, amount, day, time_utc)
+        SELECT d.id, d.user_id, d.category_id, c.is_ex, d.amount, date(d.created_date), u.time_utc
+        FROM users u
+        LEFT JOIN rollup_watermarks w ON w.user_id = u.id
+        JOIN dengies d ON d.user_id = u.id AND d.id > COALESCE(w.last_dengies_id, 0)
+        JOIN categories c ON c.id = d.category_id
+        WHERE u.tg_user_id IN (SELECT value FROM json_each(?));
+        """,
+        (ids,)
+    )
+    rows = [await _execute(conn, level) for level in _ROLLUP_LEVELS]
+    users = await _execute(conn, _ROLLUP_WATERMARKS)
+    await conn.execute("DELETE FROM rollup_delta;")
+    # In the order of the log line: daily, daily per category, monthly, yearly
+    return [entries, *reversed(rows), users]
+
+
+@instrumented
+async def run_daily_rollups(tg_user_ids: list[int]):
+    """
+    The given users' new dengies rows into the daily, daily per category, monthly and
+    yearly reports, moving their watermarks, in one transaction per chunk of users.
+    """
+    totals = [0] * 6
+    failed_chunks = 0
+    started = time.perf_counter()
+    for chunk in _chunks(tg_user_ids):
+        try:
+            async with _transaction() as conn:
+                counts = await _rollup(conn, _ids_json(chunk))
+            totals = [total + count for total, count in zip(totals, counts)]
+
+        except Exception as e:
+            logging.error(f"Rollups of {len(chunk)} users failed: {e}")
+            failed_chunks += 1
+
+    entries, daily, daily_category, monthly, yearly, users = totals
+    logging.info(
+        f"Rollups for {len(tg_user_ids)} users: {entries} new entries of {users} users into "
+        f"{daily} daily, {daily_category} daily category, {monthly} monthly and {yearly} yearly rows, "
+        f"{failed_chunks} failed chunks in {time.perf_counter() - started:.3f}s"
+    )
+
+
+def get_statement_stats() -> dict[str, dict[str, int]]:
+    """The sqlite3 module caches prepared statements per connection itself, there is no registry."""
+    return {}
+
+
+@instrumented
+async def maintain_dengies_partitions() -> list[tuple[str, str]]:
+    """dengies is a plain table in SQLite, there is nothing to maintain."""
+    return []
+
+
+@instrumented
+async def get_todays_expense_count(tg_user_id: int):
+    """Returns how many entries the user made today according to their local time."""
+    user = await get_user_identity(tg_user_id)
+    if user is None:
+        return 0
+
+    try:
+        row = await _fetchone(
+            await _reader(),
+            "SELECT COALESCE(SUM(entries_count), 0) FROM user_day_totals WHERE user_id = ? AND local_day = ?;",
+            (user["id"], _local_now(user["time_utc"]).date().isoformat())
+        )
+        return row[0] if row else 0
+
+    except Exception as e:
+        logging.error(f"Error fetching today's expense count for {tg_user_id}: {e}")
+        return 0
+
+
+@instrumented
+async def infos_get_user(tg_user_id: int):
+    """
+    Returns balance, currency, lang_code, is_premium, premium_date and the
+    month-to-date monthly_expenses / monthly_income in the user's local time.
+    """
+    try:
+        row = await _fetchone(
+            await _reader(),
+            f"""
+            SELECT
+                u.balans,
+                u.currency_is,
+                u.language_is,
+                u.is_premium,
+                strftime('%Y-%m-%d', u.premium_date),
+                COALESCE(SUM(CASE WHEN t.is_ex THEN t.total_amount END), 0),
+                COALESCE(SUM(CASE WHEN NOT t.is_ex THEN t.total_amount END), 0)
+            FROM users u
+            LEFT JOIN user_day_totals t
+                ON t.user_id = u.id
+                AND t.local_day >= date('now', {_LOCAL_OFFSET}, 'start of month')
+                AND t.local_day < date('now', {_LOCAL_OFFSET}, 'start of month', '+1 month')
+            WHERE u.tg_user_id = ?
+            GROUP BY u.id;
+            """,
+            (tg_user_id,)
+        )
+        if not row:
+            return None
+
+        return {
+            "balance": float(_from_cents(row[0])),
+            "currency": row[1],
+            "lang_code": row[2],
+            "is_premium": bool(row[3]),
+            "premium_date": row[4],
+            "monthly_expenses": float(_from_cents(row[5])),
+            "monthly_income": float(_from_cents(row[6])),
+        }
+
+    except Exception as e:
+        logging.error(f"Error fetching user data for tg_user_id {tg_user_id}: {e}")
+        return None
+
+
+@instrumented
+async def get_users_by_time(target_hour: int, target_minute: int) -> list[tuple[int, str]] | None:
+    """
+    Return a list of (tg_user_id, language_is) of users whose local time is
+    target_hour:target_minute at the current 15-minute scheduler tick.
+    """
+    offsets = [_offset_seconds(offset) for offset in zones.due_offsets(target_hour, target_minute)]
+    try:
+        rows = await _fetchall(
+            await _reader(),
+            f"""
+            SELECT u.tg_user_id, u.language_is
+            FROM zone_offsets z
+            JOIN users u ON u.time_zone = z.time_zone
+            WHERE z.utc_offset IN ({", ".join("?" * len(offsets))});
+            """,
+            offsets
+        )
+        if not rows:
+            return None
+        return [(row[0], row[1]) for row in rows]
+
+    except Exception as error:
+        logging.error("Error fetching users by time: %s", error)
+        return None
+
+
+@instrumented
+async def refresh_zone_offsets() -> int | None:
+    """
+    Recomputes the current offset of every zone in zone_offsets and, for the zones
+    whose offset changed (DST), updates it together with users.time_utc.
+    Returns the number of zones changed.
+    """
+    try:
+        rows = await _fetchall(await _reader(), "SELECT time_zone, utc_offset FROM zone_offsets;")
+
+        now = datetime.now(timezone.utc)
+        changed = {}
+        for time_zone, utc_offset in rows:
+            offset = _offset_seconds(zones.current_offset(time_zone, now))
+            if offset != utc_offset:
+                changed[time_zone] = offset
+        if not changed:
+            return 0
+
+        async with _transaction() as conn:
+            await conn.executemany(
+                "UPDATE zone_offsets SET utc_offset = ?, refreshed_at = datetime('now') WHERE time_zone = ?;",
+                [(offset, time_zone) for time_zone, offset in changed.items()]
+            )
+            await conn.executemany(
+                "UPDATE users SET time_utc = ? WHERE time_zone = ?;",
+                [(offset, time_zone) for time_zone, offset in changed.items()]
+            )
+
+    except Exception as error:
+        logging.error("Error refreshing zone offsets: %s", error)
+        return None
+
+    logging.info(f"Zone offsets changed: {changed}")
+    return len(changed)
+
+
+
+AMOUNT_SUGGESTIONS = int(os.getenv('AMOUNT_SUGGESTIONS', 5))
+AMOUNT_TRACKED = int(os.getenv('AMOUNT_TRACKED', 20))
+AMOUNT_SEED_ROWS = int(os.getenv('AMOUNT_SEED_ROWS', 200))
+AMOUNT_RANKING = os.getenv('AMOUNT_RANKING', RECENT)
+if AMOUNT_RANKING not in RANKINGS:
+    AMOUNT_RANKING = RECENT
+
+
+@instrumented
+async def get_last_amounts(category_id: int, user_id: int) -> list:
+    """
+    Up to AMOUNT_SUGGESTIONS distinct amounts for the amount keyboard, ranked by
+    AMOUNT_RANKING over the latest AMOUNT_SEED_ROWS entries of the category.
+    """
+    user = await get_user_identity(user_id)
+    if user is None:
+        return []
+
+    try:
+        rows = await _fetchall(
+            await _reader(),
+            """
+            SELECT amount, CAST(strftime('%H', created_date) AS INTEGER)
+            FROM dengies
+            WHERE user_id = ? AND category_id = ?
+            ORDER BY created_date DESC
+            LIMIT ?;
+            """,
+            (user["id"], category_id, AMOUNT_SEED_ROWS)
+        )
+
+    except Exception as error:
+        logging.error("Error while fetching last amounts: %s", error)
+        return None
+
+    stats = AmountStats(AMOUNT_TRACKED, AMOUNT_SUGGESTIONS)
+    for cents, hour in reversed(rows):
+        stats.add(_from_cents(cents), hour)
+    return stats.top(AMOUNT_SUGGESTIONS, AMOUNT_RANKING, _local_now(user["time_utc"]).hour)
+
+
+async def _add_to_day_totals(conn, user_id: int, local_day: str, category_id: int, cents: int):
+    """user_day_totals is kept in step with dengies, in the same transaction."""
+    await _execute(
+        conn,
+        """
+        INSERT INTO user_day_totals (user_id, local_day, is_ex, entries_count, total_amount)
+        SELECT ?, ?, c.is_ex, 1, ?
+        FROM categories c
+        WHERE c.id = ?
+        ON CONFLICT (user_id, local_day, is_ex) DO UPDATE
+        SET entries_count = entries_count + 1,
+            total_amount = total_amount + excluded.total_amount;
+        """,
+        (user_id, local_day, cents, category_id)
+    )
+
+
+@instrumented
+async def insert_dengies_with_balance(
+    tg_user_id: int,
+    category_id: int,
+    amount: float,
+    is_ex: bool,
+    max_balance: float = 9_999_999_999.99
+) -> tuple[float, int, str, date] | None:
+    """
+    Changes the user's balance, inserts the dengies row and returns
+    (new_balance, dengies_id, category_title, created_day), all in one transaction.
+    Returns None if the balance check fails or the user/category is not found.
+    """
+    user = await get_user_identity(tg_user_id)
+    if user is None:
+        logging.warning(f"Cannot insert amount, user {tg_user_id} is not registered")
+        return None
+
+    now_local = _local_now(user["time_utc"])
+    cents = _to_cents(amount)
+    try:
+        async with _transaction() as conn:
+            row = await _fetchone(
+                conn,
+                """
+                UPDATE users
+                SET balans = balans + :delta
+                WHERE id = :user_id
+                  AND balans + :delta BETWEEN 0 AND :max_balance
+                  AND EXISTS (SELECT 1 FROM categories c WHERE c.id = :category_id AND c.user_id = users.id)
+                RETURNING balans;
+                """,
+                {
+                    "delta": -cents if is_ex else cents,
+                    "user_id": user["id"],
+                    "category_id": category_id,
+                    "max_balance": _to_cents(max_balance),
+                }
+            )
+            if row is not None:
+                (dengies_id,) = await _fetchone(
+                    conn,
+                    "INSERT INTO dengies (amount, created_date, category_id, user_id) VALUES (?, ?, ?, ?) RETURNING id;",
+                    (cents, _ts(now_local), category_id, user["id"])
+                )
+                await _add_to_day_totals(conn, user["id"], now_local.date().isoformat(), category_id, cents)
+                (title,) = await _fetchone(conn, "SELECT title FROM categories WHERE id = ?;", (category_id,))
+
+    except Exception as e:
+        logging.error(f"Failed to insert dengies with balance for user_id={tg_user_id}: {e}")
+        return None
+
+    if row is None:
+        logging.warning(
+            f"Balance check failed or category not found: user_id={tg_user_id}, "
+            f"category_id={category_id}, amount={amount}, is_ex={is_ex}"
+        )
+        return None
+
+    logging.info(f"Amount: {amount} is inserted to category: {category_id}")
+    return float(_from_cents(row[0])), dengies_id, title, now_local.date()
+
+
+@instrumented
+async def get_active_categories_by_type(
+    tg_user_id: int, is_ex: bool
+) -> tuple[list[tuple[int, str]], int] | None:
+    """
+    Returns active categories (id, title) for a user based on expense/income type,
+    and the max allowed categories: 20 for premium users, 8 otherwise.
+    """
+    user = await get_user_identity(tg_user_id)
+    if user is None:
+        return [], 8
+
+    max_categories = 20 if user["is_premium"] else 8
+    try:
+        rows = await _fetchall(
+            await _reader(),
+            "SELECT id, title FROM categories WHERE is_active = 1 AND is_ex = ? AND user_id = ?;",
+            (is_ex, user["id"])
+        )
+        return [tuple(row) for row in rows], max_categories
+
+    except Exception as e:
+        logging.error("Failed to fetch categories for user %s: %s", tg_user_id, e)
+        return None
+
+
+@instrumented
+async def get_is_premium(user_id: int) -> bool | None:
+    user = await get_user_identity(user_id)
+    if user:
+        return user["is_premium"]
+    return None
+
+
+_FIND_CATEGORY = """
+    SELECT id, is_active
+    FROM categories
+    WHERE user_id = ? AND is_ex = ? AND ulower(title) = ulower(?)
+    ORDER BY is_active DESC, id
+    LIMIT 1;
+"""
+
+
+@instrumented
+async def add_category(tg_user_id: int, title: str, is_ex: bool) -> str | None:
+    """
+    Returns:
+        "exists"      -> an active category with this title already exists
+        "reactivated" -> an inactive one was reactivated
+        "created"     -> a new category was created
+        None          -> error or unknown user
+    """
+    title = title.strip()
+    user = await get_user_identity(tg_user_id)
+    if user is None:
+        return None
+
+    try:
+        async with _transaction() as conn:
+            found = await _fetchone(conn, _FIND_CATEGORY, (user["id"], is_ex, title))
+            if found is not None:
+                category_id, is_active = found
+                if is_active:
+                    return "exists"
+                await _execute(conn, "UPDATE categories SET is_active = 1 WHERE id = ?;", (category_id,))
+                return "reactivated"
+            await _execute(
+                conn, "INSERT INTO categories (title, is_ex, user_id) VALUES (?, ?, ?);", (title, is_ex, user["id"])
+            )
+
+    except Exception as e:
+        logging.error(f"Failed to add category '{title}' for user {tg_user_id}: {e}")
+        return None
+
+    logging.info(f"Category '{title}' created for user {tg_user_id}")
+    return "created"
+
+
+@instrumented
+async def deactivate_category(category_id: int) -> Optional[str]:
+    """
+    Returns 'deactivated' if changed from active to inactive,
+    'already_inactive' if it was already inactive, None if an error occurred.
+    """
+    try:
+        async with _transaction() as conn:
+            updated = await _execute(
+                conn, "UPDATE categories SET is_active = 0 WHERE id = ? AND is_active = 1;", (category_id,)
+            )
+
+    except Exception as e:
+        logging.error(f"Failed to deactivate category {category_id}: {e}")
+        return None
+
+    if updated:
+        logging.info(f"Category {category_id} was active and now deactivated.")
+        return "deactivated"
+    logging.info(f"Category {category_id} was already inactive.")
+    return "already_inactive"
+
+
+@instrumented
+async def get_user_language(user_id: int) -> str | None:
+    user = await get_user_identity(user_id)
+    if user:
+        return user["language_is"]
+    return None
+
+
+@instrumented
+async def user_exist(user_id: int) -> bool:
+    try:
+        row = await _fetchone(await _reader(), "SELECT 1 FROM users WHERE tg_user_id = ? LIMIT 1;", (user_id,))
+        return row is not None
+    except Exception as e:
+        logging.error(f"Error user_exist: {e}")
+        return False
+
+
+@instrumented
+async def insert_or_update_user(
+    user_id: int,
+    first_name: str,
+    user_name: Optional[str],
+    language_is: str
+) -> Optional[str]:
+    """
+    Inserts or updates a user and creates the default categories for a new one.
+    Returns: 'inserted', 'updated', or None on error.
+    """
+    food = await translator.get_text(language_is, "cat_food")
+    salary = await translator.get_text(language_is, "cat_salary")
+    transport = await translator.get_text(language_is, "cat_transport")
+    gifts = await translator.get_text(language_is, "cat_gift")
+    other = await translator.get_text(language_is, "other")
+
+    try:
+        async with _transaction() as conn:
+            existing = await _fetchone(conn, "SELECT id FROM users WHERE tg_user_id = ?;", (user_id,))
+            (internal_id,) = await _fetchone(
+                conn,
+                """
+                INSERT INTO users (tg_user_id, first_name, user_name, language_is)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (tg_user_id) DO UPDATE
+                SET
+                    first_name = excluded.first_name,
+                    user_name = excluded.user_name,
+                    language_is = excluded.language_is
+                RETURNING id;
+                """,
+                (user_id, first_name, user_name, language_is)
+            )
+            created = await _execute(
+                conn,
+                """
+                INSERT INTO categories (title, is_ex, user_id)
+                SELECT v.column1, v.column2, :user_id
+                FROM (VALUES (:food, 1), (:transport, 1), (:other, 1), (:salary, 0), (:gifts, 0), (:other, 0)) AS v
+                WHERE NOT EXISTS (SELECT 1 FROM categories c WHERE c.user_id = :user_id);
+                """,
+                {
+                    "user_id": internal_id, "food": food, "transport": transport,
+                    "other": other, "salary": salary, "gifts": gifts,
+                }
+            )
+
+    except Exception as e:
+        logging.error("❌ Failed to insert/update user %s: %s", user_id, e)
+        return None
+
+    if created > 0:
+        logging.info(f"✅ Created default categories for new user {user_id}")
+    return "updated" if existing else "inserted"
+
+
+ONBOARDING_SUGGESTIONS = int(os.getenv('ONBOARDING_SUGGESTIONS', 5))
+ONBOARDING_SCAN_ROWS = int(os.getenv('ONBOARDING_SCAN_ROWS', 500))
+
+
+async def _recent_user_settings(column: str) -> list | None:
+    """The last ONBOARDING_SUGGESTIONS distinct values of column among the newest users."""
+    try:
+        rows = await _fetchall(
+            await _reader(), f"SELECT {column} FROM users ORDER BY id DESC LIMIT ?;", (ONBOARDING_SCAN_ROWS,)
+        )
+    except Exception as error:
+        logging.error("Error while loading onboarding suggestions: %s", error)
+        return None
+
+    recent = RecentValues(ONBOARDING_SUGGESTIONS)
+    recent.replace(row[0] for row in rows)
+    return recent.values
+
+
+@instrumented
+async def get_last_times() -> list[str] | None:
+    offsets = await _recent_user_settings("time_utc")
+    if offsets is None:
+        return None
+
+    now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+    return [(now_utc + timedelta(seconds=offset)).strftime("%Y-%m-%d %H:%M") for offset in offsets]
+
+
+@instrumented
+async def get_last_currencies() -> list[str] | None:
+    return await _recent_user_settings("currency_is")
+
+
+@instrumented
+async def update_user_info(
+    user_id: int,
+    rounded_offset,
+    currency: str,
+    balans: float | None = None,
+    time_zone: str | None = None
+) -> bool:
+    """
+    Updates time_utc, currency, and optionally balans and time_zone for the given user.
+    If balans or time_zone is None, it will not be updated.
+    """
+    offset = _offset_seconds(rounded_offset)
+    query = "UPDATE users SET time_utc = ?, currency_is = ?"
+    params = [offset, currency]
+    if balans is not None:
+        query += ", balans = ?"
+        params.append(_to_cents(balans))
+    if time_zone is not None:
+        query += ", time_zone = ?"
+        params.append(time_zone)
+    query += " WHERE tg_user_id = ?;"
+    params.append(user_id)
+
+    try:
+        async with _transaction() as conn:
+            await _execute(conn, query, params)
+            if time_zone is not None:
+                await _execute(
+                    conn,
+                    """
+                    INSERT INTO zone_offsets (time_zone, utc_offset) VALUES (?, ?)
+                    ON CONFLICT (time_zone) DO UPDATE
+                    SET utc_offset = excluded.utc_offset, refreshed_at = excluded.refreshed_at
+                    WHERE zone_offsets.utc_offset <> excluded.utc_offset;
+                    """,
+                    (time_zone, offset)
+                )
+
+    except Exception as e:
+        logging.error("Failed to update user %s: %s", user_id, e)
+        return False
+
+    logging.info(
+        f"Updated user {user_id} with values utc {rounded_offset}, currency {currency}"
+        + (f", time zone {time_zone}" if time_zone is not None else "")
+        + (f", balans {balans}" if balans is not None else "")
+    )
+    return True
+
+
+@instrumented
+async def update_comment_text(dengies_id: int, created_day: date, comment_text: str) -> bool:
+    try:
+        async with _transaction() as conn:
+            updated = await _execute(
+                conn,
+                """
+                UPDATE dengies
+                SET comment_text = :comment_text
+                WHERE id = :dengies_id
+                  AND created_date >= :created_day
+                  AND created_date < date(:created_day, '+1 day');
+                """,
+                {"comment_text": comment_text, "dengies_id": dengies_id, "created_day": created_day.isoformat()}
+            )
+        logging.info(f"Succesfuly saved comment to {dengies_id}")
+        return updated > 0
+
+    except Exception as e:
+        logging.error(f"Failed to update comment for amount_id={dengies_id}: {e}")
+        return False
+
+
+
+# /import and /export (CSV format in ledger_csv.py). Rows are staged in a TEMP table
+# on a connection of their own, so parsing a large file does not hold the write lock;
+# only the merge into the ledger does.
+_STAGING_BATCH = 1_000
+
+
+async def _stage_rows(conn, raw: BinaryIO, now_local: datetime, result: dict, progress) -> None:
+    batch = []
+    with closing(read_rows(raw, now_local, result)) as rows:
+        for line_no, created_date, is_ex, title, amount, comment in rows:
+            batch.append((line_no, _ts(created_date), is_ex, title, _to_cents(amount), comment))
+            if len(batch) >= _STAGING_BATCH:
+                await conn.executemany("INSERT INTO import_staging VALUES (?, ?, ?, ?, ?, ?, NULL);", batch)
+                batch.clear()
+            if progress and result["imported"] % IMPORT_PROGRESS_EVERY == 0:
+                await progress(result["imported"])
+    if batch:
+        await conn.executemany("INSERT INTO import_staging VALUES (?, ?, ?, ?, ?, ?, NULL);", batch)
+
+
+async def _merge(conn, user: dict, result: dict) -> None:
+    params = {"user_id": user["id"], "max_balance": _to_cents(MAX_BALANCE)}
+
+    # Unknown categories are created (first spelling in the file wins), matching is case-insensitive per type
+    changed_categories = await _execute(
+        conn,
+        """
+        INSERT INTO categories (title, is_ex, user_id)
+        SELECT s.category_title, s.is_ex, :user_id
+        FROM import_staging s
+        WHERE s.line_no = (
+                SELECT MIN(s2.line_no) FROM import_staging s2
+                WHERE s2.is_ex = s.is_ex AND ulower(s2.category_title) = ulower(s.category_title)
+            )
+          AND NOT EXISTS (
+                SELECT 1 FROM categories c
+                WHERE c.user_id = :user_id AND c.is_ex = s.is_ex AND ulower(c.title) = ulower(s.category_title)
+            )
+        ORDER BY s.line_no;
+        """,
+        params
+    )
+    await _execute(
+        conn,
+        """
+        UPDATE import_staging
+        SET category_id = (
+            SELECT c.id FROM categories c
+            WHERE c.user_id = :user_id
+              AND c.is_ex = import_staging.is_ex
+              AND ulower(c.title) = ulower(import_staging.category_title)
+            ORDER BY c.is_active DESC, c.id
+            LIMIT 1
+        );
+        """,
+        params
+    )
+    changed_categories += await _execute(
+        conn,
+        """
+        UPDATE categories
+        SET is_active = 1
+        WHERE user_id = :user_id
+          AND NOT is_active
+          AND id IN (SELECT category_id FROM import_staging);
+        """,
+        params
+    )
+    if changed_categories:
+        counts = await _fetchone(
+            conn,
+            """
+            SELECT COALESCE(SUM(is_ex), 0), COALESCE(SUM(NOT is_ex), 0)
+            FROM categories
+            WHERE user_id = :user_id AND is_active;
+            """,
+            params
+        )
+        if max(counts) > (20 if user["is_premium"] else 8):
+            raise ImportAborted("category_limit")
+
+    result["imported"] = await _execute(
+        conn,
+        """
+        INSERT INTO dengies (amount, comment_text, created_date, category_id, user_id)
+        SELECT amount, comment_text, created_date, category_id, :user_id
+        FROM import_staging
+        ORDER BY created_date;
+        """,
+        params
+    )
+    await _execute(
+        conn,
+        """
+        INSERT INTO user_day_totals (user_id, local_day, is_ex, entries_count, total_amount)
+        SELECT :user_id, date(created_date), is_ex, COUNT(*), SUM(amount)
+        FROM import_staging
+        WHERE TRUE
+        GROUP BY date(created_date), is_ex
+        ON CONFLICT (user_id, local_day, is_ex) DO UPDATE
+        SET entries_count = entries_count + excluded.entries_count,
+            total_amount = total_amount + excluded.total_amount;
+        """,
+        params
+    )
+    balance = await _fetchone(
+        conn,
+        """
+        UPDATE users
+        SET balans = balans + (SELECT COALESCE(SUM(CASE WHEN is_ex THEN -amount ELSE amount END), 0) FROM import_staging)
+        WHERE id = :user_id
+          AND balans + (SELECT COALESCE(SUM(CASE WHEN is_ex THEN -amount ELSE amount END), 0) FROM import_staging)
+              BETWEEN 0 AND :max_balance
+        RETURNING balans;
+        """,
+        params
+    )
+    if balance is None:
+        raise ImportAborted("balance")
+    result["balance"] = float(_from_cents(balance[0]))
+
+
+@instrumented
+async def import_csv(
+    tg_user_id: int,
+    raw: BinaryIO,
+    progress: Callable[[int], Awaitable[None]] | None = None
+) -> dict:
+    """
+    Imports a CSV file into the user's ledger: either all valid rows are imported with
+    the balance and day totals adjusted, or nothing is. The next rollup adds them to
+    the reports.
+
+    Returns {"status", "imported", "skipped", "errors", "balance"}; status is "ok" or
+    one of not_registered, bad_header, no_rows, too_many_rows, encoding,
+    category_limit, balance, error.
+    """
+    result = {"status": "ok", "imported": 0, "skipped": 0, "errors": [], "balance": None}
+    user = await get_user_identity(tg_user_id)
+    if user is None:
+        result["status"] = "not_registered"
+        return result
+
+    now_local = datetime.utcnow() + user["time_utc"]
+    started = time.perf_counter()
+    async with import_slots:
+        conn = await _connect()
+        try:
+            await conn.execute("PRAGMA temp_store = MEMORY;")
+            await conn.execute(
+                """
+                CREATE TEMP TABLE import_staging (
+                    line_no INTEGER NOT NULL,
+                    created_date TEXT NOT NULL,
+                    is_ex INTEGER NOT NULL,
+                    category_title TEXT NOT NULL,
+                    amount INTEGER NOT NULL,
+                    comment_text TEXT,
+                    category_id INTEGER
+                );
+                """
+            )
+            await _stage_rows(conn, raw, now_local, result, progress)
+            if not result["imported"]:
+                raise ImportAborted("no_rows")
+            async with _transaction(conn):
+                await _merge(conn, user, result)
+
+        except ImportAborted as e:
+            result["status"] = e.status
+        except UnicodeDecodeError:
+            result["status"] = "encoding"
+        except Exception as e:
+            logging.error(f"Import failed for user {tg_user_id}: {e}")
+            result["status"] = "error"
+        finally:
+            await conn.close()
+
+    logging.info(
+        f"Import for user {tg_user_id}: {result['status']}, {result['imported']} rows, "
+        f"{result['skipped']} skipped in {time.perf_counter() - started:.2f}s"
+    )
+    return result
+
+
+@instrumented
+async def export_csv(
+    tg_user_id: int,
+    date_from: datetime,
+    date_to: datetime,
+    destination: BinaryIO,
+    compress: bool = False
+) -> int | None:
+    """
+    Writes the user's entries with date_from <= created_date < date_to (local time)
+    to destination as CSV, gzip-compressed if asked. Returns the number of rows,
+    or None if the user is not registered or the export failed.
+    """
+    user = await get_user_identity(tg_user_id)
+    if user is None:
+        return None
+
+    started = time.perf_counter()
+    rows_written = 0
+    try:
+        with export_writer(destination, compress) as writer:
+            conn = await _reader()
+            async with conn.execute(
+                """
+                SELECT
+                    d.created_date,
+                    c.title,
+                    d.amount,
+                    CASE WHEN c.is_ex THEN 'expense' ELSE 'income' END,
+                    COALESCE(d.comment_text, '')
+                FROM dengies d
+                JOIN categories c ON c.id = d.category_id
+                WHERE d.user_id = ?
+                  AND d.created_date >= ?
+                  AND d.created_date < ?
+                ORDER BY d.created_date, d.id;
+                """,
+                (user["id"], _ts(date_from), _ts(date_to))
+            ) as cursor:
+                while rows := await cursor.fetchmany(EXPORT_BATCH):
+                    writer.writerows((row[0], row[1], _from_cents(row[2]), *row[3:]) for row in rows)
+                    rows_written += len(rows)
+
+    except Exception as e:
+        logging.error(f"Export failed for user {tg_user_id}: {e}")
+        return None
+
+    logging.info(
+        f"Exported {rows_written} rows for user {tg_user_id} "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+    return rows_written
+
+
+
+# Outbound message queue (migrations/sqlite/0003_outbox.sql), delivered by app/auto/outbox.py
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', 7))
+
+
+@instrumented
+async def enqueue_messages(messages: list[tuple[str, int, list[str]]]) -> int | None:
+    """
+    Adds (dedup_key, chat_id, texts) messages to the outbox, ignoring dedup_keys that
+    are already there. Returns how many were added, None on errors.
+    """
+    added = 0
+    try:
+        for chunk in _chunks(messages):
+            async with _transaction() as conn:
+                cursor = await conn.executemany(
+                    "INSERT OR IGNORE INTO outbox (dedup_key, chat_id, texts) VALUES (?, ?, ?);",
+                    [(dedup_key, chat_id, json.dumps(texts)) for dedup_key, chat_id, texts in chunk]
+                )
+                added += max(cursor.rowcount, 0)
+                await cursor.close()
+
+    except Exception as e:
+        logging.error(f"Error enqueueing {len(messages)} messages ({added} added): {e}")
+        return None
+
+    return added
+
+
+@instrumented
+async def claim_outbox(limit: int, lease_seconds: float) -> list[tuple[int, int, list[str], int]] | None:
+    """
+    Claims up to `limit` due messages: (id, chat_id, texts, sent_parts), leased for
+    lease_seconds. Messages claimed OUTBOX_MAX_ATTEMPTS times are marked failed.
+    Returns None on errors.
+    """
+    try:
+        async with _transaction() as conn:
+            expired = await _execute(
+                conn,
+                """
+                UPDATE outbox
+                SET status = 'failed', last_error = COALESCE(last_error, 'lease expired'), finished_at = datetime('now')
+                WHERE status = 'pending' AND attempts >= ? AND available_at <= datetime('now');
+                """,
+                (OUTBOX_MAX_ATTEMPTS,)
+            )
+            if expired > 0:
+                logging.warning(f"{expired} outbox messages failed after {OUTBOX_MAX_ATTEMPTS} attempts")
+            rows = await _fetchall(
+                conn,
+                """
+                UPDATE outbox
+                SET available_at = datetime('now', ? || ' seconds'), attempts = attempts + 1
+                WHERE id IN (
+                    SELECT id FROM outbox
+                    WHERE status = 'pending' AND available_at <= datetime('now')
+                    ORDER BY available_at, id
+                    LIMIT ?
+                )
+                RETURNING id, chat_id, texts, sent_parts;
+                """,
+                (lease_seconds, limit)
+            )
+
+    except Exception as e:
+        logging.error(f"Error claiming outbox messages: {e}")
+        return None
+
+    return sorted((row[0], row[1], json.loads(row[2]), row[3]) for row in rows)
+
+
+@instrumented
+async def finish_outbox(results: list[tuple[int, str, int, str | None, float | None]]) -> bool:
+    """
+    Records (id, status, sent_parts, error, retry_after) for claimed messages: status is
+    'sent' or 'failed'; with a retry_after (seconds) the message stays pending until then.
+    """
+    if not results:
+        return True
+    try:
+        async with _transaction() as conn:
+            await conn.executemany(
+                """
+                UPDATE outbox
+                SET status = CASE WHEN :retry_after IS NULL THEN :status ELSE 'pending' END,
+                    sent_parts = :sent_parts,
+                    last_error = :error,
+                    available_at = CASE
+                        WHEN :retry_after IS NULL THEN available_at
+                        ELSE datetime('now', :retry_after || ' seconds')
+                    END,
+                    finished_at = CASE WHEN :retry_after IS NULL THEN datetime('now') END
+                WHERE id = :id AND status = 'pending';
+                """,
+                [
+                    {"id": message_id, "status": status, "sent_parts": sent_parts, "error": error, "retry_after": retry_after}
+                    for message_id, status, sent_parts, error, retry_after in results
+                ]
+            )
+
+    except Exception as e:
+        logging.error(f"Error finishing {len(results)} outbox messages: {e}")
+        return False
+
+    return True
+
+
+@instrumented
+async def purge_outbox() -> int | None:
+    """Deletes messages finished more than OUTBOX_RETENTION_DAYS ago. Returns how many."""
+    try:
+        async with _transaction() as conn:
+            purged = await _execute(
+                conn,
+                "DELETE FROM outbox WHERE status <> 'pending' AND finished_at < datetime('now', ? || ' days');",
+                (-OUTBOX_RETENTION_DAYS,)
+            )
+
+    except Exception as e:
+        logging.error(f"Error purging the outbox: {e}")
+        return None
+
+    logging.info(f"Purged {purged} finished outbox messages")
+    return purged
@@ -0,0 +1,103 @@
+import os
+import logging
+import importlib
+from typing import Any
+
+
+# The storage interface used by handlers, keyboards and the scheduler:
+#
+#     import app.data.storage as db
+#     await db.get_user_identity(tg_user_id)
+#
+# STORAGE_BACKEND selects the implementation once at startup:
+#   postgres (default) - dbContext.py, with import/export in transfer.py and migrations.py
+#   sqlite             - sqliteContext.py, an embedded database file in WAL mode (SQLITE_PATH)
+# Both implement every function below with the same signatures and return values.
+POSTGRES = "postgres"
+SQLITE = "sqlite"
+
+BACKENDS = {
+    POSTGRES: ("app.data.dbContext", "app.data.transfer", "app.data.migrations"),
+    SQLITE: ("app.data.sqliteContext",),
+}
+
+INTERFACE = (
+    # lifecycle
+    "open_pools",
+    "close_pools",
+    "run_migrations",
+    "get_statement_stats",
+    # users
+    "get_user_identity",
+    "invalidate_user",
+    "get_user_language",
+    "get_is_premium",
+    "user_exist",
+    "insert_or_update_user",
+    "update_user_info",
+    "infos_get_user",
+    "get_users_by_time",
+    "refresh_zone_offsets",
+    "get_last_times",
+    "get_last_currencies",
+    # categories
+    "get_active_categories_by_type",
+    "add_category",
+    "deactivate_category",
+    # entries
+    "insert_dengies_with_balance",
+    "update_comment_text",
+    "get_todays_dengies_for_users",
+    "get_todays_expense_count",
+    "get_last_amounts",
+    # reports and maintenance
+    "run_daily_rollups",
+    "get_daily_digests",
+    "maintain_dengies_partitions",
+    # outbox
+    "enqueue_messages",
+    "claim_outbox",
+    "finish_outbox",
+    "purge_outbox",
+    # /import and /export
+    "import_csv",
+    "export_csv",
+)
+
+BACKEND = os.getenv('STORAGE_BACKEND', POSTGRES).strip().lower()
+
+
+def _load(backend: str) -> dict[str, Any]:
+    """Resolve every interface function from the backend's modules, failing fast on gaps."""
+    if backend not in BACKENDS:
+        raise RuntimeError(f"Unknown STORAGE_BACKEND={backend!r}, expected one of {', '.join(BACKENDS)}")
+
+    modules = [importlib.import_module(name) for name in BACKENDS[backend]]
+    functions = {}
+    for name in INTERFACE:
+        for module in modules:
+            if hasattr(module, name):
+                functions[name] = getattr(module, name)
+                break
+
+    missing = [name for name in INTERFACE if name not in functions]
+    if missing:
+        raise RuntimeError(f"Storage backend {backend!r} does not implement: {', '.join(missing)}")
+
+    logging.info(f"Using the {backend} storage backend")
+    return functions
+
+
+_functions = _load(BACKEND)
+
+
+def __getattr__(name: str):
+    # Module attribute lookup (PEP 562), so `db.x` and `from app.data.storage import x` both work
+    try:
+        return _functions[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+
+
+def __dir__():
+    return sorted(list(globals()) + list(INTERFACE))
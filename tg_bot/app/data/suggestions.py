@@ -0,0 +1,85 @@
+from decimal import Decimal
+
+
+RECENT = "recent"        # most recently used amounts first (the original behaviour)
+FREQUENT = "frequent"    # most used amounts first
+HOURLY = "hourly"        # most used at the current local hour first
+
+RANKINGS = (RECENT, FREQUENT, HOURLY)
+
+_CENTS = Decimal("0.01")
+
+
+def normalize_amount(amount) -> Decimal:
+    """Amounts are keyed as NUMERIC(12,2) values, whether they come from Python or Postgres."""
+    return Decimal(str(amount)).quantize(_CENTS)
+
+
+class AmountStats:
+    """
+    Bounded use statistics of the amounts a user enters in one category.
+
+    Keeps at most `max_tracked` distinct amounts with their use count, last use
+    and per-hour counts. When full, the least used amount (oldest on ties) is
+    dropped, so both `add` and `top` work on a fixed number of entries. The
+    `max_recent` most recently used amounts are never dropped: new amounts start
+    with one use and would otherwise be the first to go, leaving the "recent"
+    ranking without the latest amounts.
+    """
+
+    __slots__ = ("max_tracked", "max_recent", "entries", "seq")
+
+    def __init__(self, max_tracked: int = 20, max_recent: int = 5):
+        self.max_tracked = max_tracked
+        self.max_recent = max_recent
+        # amount -> [uses, last_use_seq, uses_per_hour]
+        self.entries: dict[Decimal, list] = {}
+        self.seq = 0
+
+    def add(self, amount, hour: int) -> "AmountStats":
+        amount = normalize_amount(amount)
+        self.seq += 1
+        entry = self.entries.get(amount)
+        if entry is None:
+            if len(self.entries) >= self.max_tracked:
+                by_last_use = sorted(self.entries, key=lambda a: self.entries[a][1])
+                candidates = by_last_use[:len(by_last_use) - self.max_recent] or by_last_use
+                evicted = min(candidates, key=lambda a: (self.entries[a][0], self.entries[a][1]))
+                del self.entries[evicted]
+            entry = self.entries[amount] = [0, 0, [0] * 24]
+
+        entry[0] += 1
+        entry[1] = self.seq
+        entry[2][hour % 24] += 1
+        return self
+
+    def top(self, limit: int = 5, ranking: str = RECENT, hour: int | None = None) -> list[Decimal]:
+        if ranking == HOURLY and hour is not None:
+            key = lambda a: (self.entries[a][2][hour % 24], self.entries[a][0], self.entries[a][1])
+        elif ranking == FREQUENT:
+            key = lambda a: (self.entries[a][0], self.entries[a][1])
+        else:
+            key = lambda a: self.entries[a][1]
+        return sorted(self.entries, key=key, reverse=True)[:limit]
+
+
+class RecentValues:
+    """The last `size` distinct values used, most recent first."""
+
+    __slots__ = ("size", "values")
+
+    def __init__(self, size: int = 5):
+        self.size = size
+        self.values: list = []
+
+    def add(self, value) -> None:
+        if value in self.values:
+            self.values.remove(value)
+        self.values.insert(0, value)
+        del self.values[self.size:]
+
+    def replace(self, values) -> None:
+        """Rebuild from values ordered newest first."""
+        self.values = []
+        for value in reversed(list(values)):
+            self.add(value)
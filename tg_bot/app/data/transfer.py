@@ -0,0 +1,277 @@
+import time
+import logging
+from contextlib import closing
+from datetime import datetime
+from typing import Awaitable, BinaryIO, Callable
+
+from psycopg import Error
+
+import app.data.dbContext as db
+from app.data.ledger_csv import (
+    IMPORT_PROGRESS_EVERY, MAX_BALANCE, EXPORT_BATCH, ImportAborted, import_slots, read_rows, export_writer
+)
+from app.data.metrics import instrumented
+
+
+# Bulk import of a user's history from a CSV file (format in ledger_csv.py). Rows are
+# validated while the file is read and streamed into a temp staging table with COPY,
+# then merged into dengies in one set-based transaction, so the file is never fully in memory.
+
+
+async def _copy_rows(cursor, raw: BinaryIO, now_local: datetime, result: dict, progress) -> None:
+    async with cursor.copy(
+        "COPY import_staging (line_no, created_date, is_ex, category_title, amount, comment_text) FROM STDIN"
+    ) as copy:
+        with closing(read_rows(raw, now_local, result)) as rows:
+            for row in rows:
+                await copy.write_row(row)
+                if progress and result["imported"] % IMPORT_PROGRESS_EVERY == 0:
+                    await progress(result["imported"])
+
+
+async def _merge(cursor, user: dict, result: dict) -> None:
+    user_id = user["id"]
+
+    # Held until commit, so the rollups wait for the imported rows (see rollup_lock_users)
+    await cursor.execute("SELECT 1 FROM users WHERE id = %s FOR NO KEY UPDATE;", (user_id,))
+
+    # Historical months get their own partitions instead of the default one
+    await cursor.execute(
+        """
+        SELECT create_dengies_partition(m::date)
+        FROM generate_series(
+            (SELECT date_trunc('month', MIN(created_date)) FROM import_staging),
+            (SELECT date_trunc('month', MAX(created_date)) FROM import_staging),
+            INTERVAL '1 month'
+        ) AS m;
+        """
+    )
+
+    # Unknown categories are created, matching is case-insensitive per type
+    await cursor.execute(
+        """
+        INSERT INTO categories (title, is_ex, user_id)
+        SELECT DISTINCT ON (s.is_ex, lower(s.category_title)) s.category_title, s.is_ex, %(user_id)s
+        FROM import_staging s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM categories c
+            WHERE c.user_id = %(user_id)s
+              AND c.is_ex = s.is_ex
+              AND lower(c.title) = lower(s.category_title)
+        )
+        ORDER BY s.is_ex, lower(s.category_title), s.line_no;
+        """,
+        {"user_id": user_id}
+    )
+    changed_categories = cursor.rowcount
+
+    await cursor.execute(
+        """
+        UPDATE import_staging s
+        SET category_id = c.id
+        FROM (
+            SELECT DISTINCT ON (is_ex, lower(title)) id, is_ex, lower(title) AS title_key
+            FROM categories
+            WHERE user_id = %s
+            ORDER BY is_ex, lower(title), is_active DESC, id
+        ) c
+        WHERE c.is_ex = s.is_ex
+          AND c.title_key = lower(s.category_title);
+        """,
+        (user_id,)
+    )
+
+    await cursor.execute(
+        """
+        UPDATE categories
+        SET is_active = TRUE
+        WHERE user_id = %s
+          AND NOT is_active
+          AND id IN (SELECT DISTINCT category_id FROM import_staging);
+        """,
+        (user_id,)
+    )
+    changed_categories += cursor.rowcount
+
+    if changed_categories:
+        await cursor.execute(
+            """
+            SELECT COUNT(*) FILTER (WHERE is_ex), COUNT(*) FILTER (WHERE NOT is_ex)
+            FROM categories
+            WHERE user_id = %s AND is_active;
+            """,
+            (user_id,)
+        )
+        max_categories = 20 if user["is_premium"] else 8
+        if max(await cursor.fetchone()) > max_categories:
+            raise ImportAborted("category_limit")
+
+    await cursor.execute(
+        """
+        WITH d AS (
+            INSERT INTO dengies (amount, comment_text, created_date, category_id, user_id)
+            SELECT amount, comment_text, created_date, category_id, %(user_id)s
+            FROM import_staging
+            ORDER BY created_date
+            RETURNING id
+        ), t AS (
+            INSERT INTO user_day_totals (user_id, local_day, is_ex, entries_count, total_amount)
+            SELECT %(user_id)s, created_date::date, is_ex, COUNT(*), SUM(amount)
+            FROM import_staging
+            GROUP BY created_date::date, is_ex
+            ON CONFLICT (user_id, local_day, is_ex) DO UPDATE
+            SET entries_count = user_day_totals.entries_count + EXCLUDED.entries_count,
+                total_amount = user_day_totals.total_amount + EXCLUDED.total_amount
+        ), w AS (
+            -- The rows are older than the next rollup expects (see incremental_rollups)
+            UPDATE rollup_watermarks
+            SET min_created_date = LEAST(min_created_date, (SELECT MIN(created_date) FROM import_staging))
+            WHERE user_id = %(user_id)s
+        ), b AS (
+            UPDATE users
+            SET balans = balans + delta.amount
+            FROM (
+                SELECT COALESCE(SUM(CASE WHEN is_ex THEN -amount ELSE amount END), 0) AS amount
+                FROM import_staging
+            ) delta
+            WHERE users.id = %(user_id)s
+              AND users.balans + delta.amount BETWEEN 0 AND %(max_balance)s
+            RETURNING users.balans
+        )
+        SELECT (SELECT COUNT(*) FROM d), (SELECT balans FROM b);
+        """,
+        {"user_id": user_id, "max_balance": MAX_BALANCE}
+    )
+    inserted, balance = await cursor.fetchone()
+    if balance is None:
+        raise ImportAborted("balance")
+    result["imported"] = inserted
+    result["balance"] = float(balance)
+
+
+@instrumented
+async def import_csv(
+    tg_user_id: int,
+    raw: BinaryIO,
+    progress: Callable[[int], Awaitable[None]] | None = None
+) -> dict:
+    """
+    Imports a CSV file (header with date, category, amount and optionally type, comment)
+    into the user's ledger. Everything happens in one transaction: either all valid
+    rows are imported with the balance and day totals adjusted, or nothing is.
+    The next rollup adds the imported rows to the reports of their periods.
+
+    Returns {"status", "imported", "skipped", "errors", "balance"}; status is "ok" or
+    one of not_registered, bad_header, no_rows, too_many_rows, encoding,
+    category_limit, balance, error.
+    """
+    result = {"status": "ok", "imported": 0, "skipped": 0, "errors": [], "balance": None}
+    user = await db.get_user_identity(tg_user_id)
+    if user is None:
+        result["status"] = "not_registered"
+        return result
+
+    now_local = datetime.utcnow() + user["time_utc"]
+    started = time.perf_counter()
+    async with import_slots:
+        try:
+            async with db.get_db_connection(db.BACKGROUND) as conn:
+                async with conn.transaction(), conn.cursor() as cur:
+                    await cur.execute(
+                        """
+                        CREATE TEMP TABLE import_staging (
+                            line_no INT NOT NULL,
+                            created_date TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL,
+                            is_ex BOOLEAN NOT NULL,
+                            category_title VARCHAR(15) NOT NULL,
+                            amount NUMERIC(12,2) NOT NULL,
+                            comment_text VARCHAR(30),
+                            category_id BIGINT
+                        ) ON COMMIT DROP;
+                        """
+                    )
+                    await _copy_rows(cur, raw, now_local, result, progress)
+                    if not result["imported"]:
+                        raise ImportAborted("no_rows")
+                    await _merge(cur, user, result)
+
+        except ImportAborted as e:
+            result["status"] = e.status
+        except UnicodeDecodeError:
+            result["status"] = "encoding"
+        except (Exception, Error) as e:
+            logging.error(f"Import failed for user {tg_user_id}: {e}")
+            result["status"] = "error"
+
+    if result["status"] == "ok":
+        # Categories may have been created or reactivated
+        db.invalidate_user(tg_user_id)
+    logging.info(
+        f"Import for user {tg_user_id}: {result['status']}, {result['imported']} rows, "
+        f"{result['skipped']} skipped in {time.perf_counter() - started:.2f}s"
+    )
+    return result
+
+
+
+# Export of a user's ledger as CSV in the import format. Rows are read through a named
+# (server-side) cursor in batches and written straight to a temp file, so memory stays
+# flat whatever the history size. The transaction only lives while rows are copied
+# to local disk, never while the file is uploaded.
+
+
+@instrumented
+async def export_csv(
+    tg_user_id: int,
+    date_from: datetime,
+    date_to: datetime,
+    destination: BinaryIO,
+    compress: bool = False
+) -> int | None:
+    """
+    Writes the user's entries with date_from <= created_date < date_to (local time)
+    to destination as CSV, gzip-compressed if asked. Returns the number of rows,
+    or None if the user is not registered or the export failed.
+    """
+    user = await db.get_user_identity(tg_user_id)
+    if user is None:
+        return None
+
+    started = time.perf_counter()
+    rows_written = 0
+    try:
+        with export_writer(destination, compress) as writer:
+            async with db.get_read_connection(db.EXPORT) as conn:
+                await conn.execute("SET TRANSACTION READ ONLY;")
+                async with conn.cursor(name="ledger_export") as cursor:
+                    cursor.itersize = EXPORT_BATCH
+                    await cursor.execute(
+                        """
+                        SELECT
+                            to_char(d.created_date, 'YYYY-MM-DD HH24:MI:SS'),
+                            c.title,
+                            d.amount,
+                            CASE WHEN c.is_ex THEN 'expense' ELSE 'income' END,
+                            COALESCE(d.comment_text, '')
+                        FROM dengies d
+                        JOIN categories c ON c.id = d.category_id
+                        WHERE d.user_id = %s
+                          AND d.created_date >= %s
+                          AND d.created_date < %s
+                        ORDER BY d.created_date, d.id;
+                        """,
+                        (user["id"], date_from, date_to)
+                    )
+                    while rows := await cursor.fetchmany(EXPORT_BATCH):
+                        writer.writerows(rows)
+                        rows_written += len(rows)
+
+    except (Exception, Error) as e:
+        logging.error(f"Export failed for user {tg_user_id}: {e}")
+        return None
+
+    logging.info(
+        f"Exported {rows_written} rows for user {tg_user_id} "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+    return rows_written
@@ -8,7 +8,9 @@ from datetime import datetime
 import logging
 
 import app.cmn.transtalor as translator
-import app.data.dbContext as db
+import app.cmn.quota as quota
+import app.cmn.zones as zones
+import app.data.storage as db
 import app.keyboards.in_line as inKb
 import app.keyboards.out_line as outKb
 
@@ -50,37 +52,54 @@ async def get_time2(message: Message, state: FSMContext, bot: Bot):
     data = await state.get_data()
     lang_code = data.get("lang_code")
 
-    try:
-        # Try parsing user input
-        user_local_dt = datetime.strptime(date_time, "%Y-%m-%d %H:%M")
-    except ValueError:
-        await translator.smart_sleep(
-            message.reply,
-            text=await translator.get_text(lang_code, 'askTime')
-        )
-        return
+    # Either a time zone name like Asia/Tashkent...
+    time_zone = zones.resolve_zone(date_time)
+    typed_time = time_zone is None
+    if time_zone is not None:
+        rounded_offset = zones.current_offset(time_zone)
+    else:
+        # ...or the user's current local time
+        try:
+            user_local_dt = datetime.strptime(date_time, "%Y-%m-%d %H:%M")
+        except ValueError:
+            await translator.smart_sleep(
+                message.reply,
+                text=await translator.get_text(lang_code, 'askTime')
+            )
+            return
 
-    now_utc = datetime.utcnow()
-    time_offset = user_local_dt - now_utc
-    rounded_offset = timedelta(hours=round(time_offset.total_seconds() / 3600))
+        now_utc = datetime.utcnow()
+        time_offset = user_local_dt - now_utc
+        rounded_offset = zones.round_offset(time_offset)
 
-    # ✅ Validate min/max UTC offset
-    min_offset = timedelta(hours=-12)
-    max_offset = timedelta(hours=14)
+        # ✅ Validate min/max UTC offset
+        if rounded_offset < zones.MIN_OFFSET or rounded_offset > zones.MAX_OFFSET:
+            await translator.smart_sleep(
+                message.answer,
+                text=await translator.get_text(lang_code, 'invalidUtcOffset')
+            )
+            return
 
-    if rounded_offset < min_offset or rounded_offset > max_offset:
-        await translator.smart_sleep(
-            message.answer,
-            text=await translator.get_text(lang_code, 'invalidUtcOffset')
-        )
-        return
+        time_zone = zones.zone_for_offset(rounded_offset)
+        if time_zone is None:
+            await translator.smart_sleep(
+                message.answer,
+                text=await translator.get_text(lang_code, 'unknownTimeZone')
+            )
+            return
 
-    await state.update_data(datetime_time = rounded_offset)
+    await state.update_data(datetime_time = rounded_offset, time_zone = time_zone)
 
     await translator.smart_sleep(
         message.reply,
         text=await translator.get_text(lang_code, 'timeUpdated')
     )
+    if typed_time and zones.is_fixed_offset(time_zone):
+        # A typed time keeps its offset all year
+        await translator.smart_sleep(
+            message.answer,
+            text=await translator.get_text(lang_code, 'fixedOffsetZone')
+        )
     await get_curriencies(bot, message.from_user.id, lang_code)
     # await message.answer(f"{await translator.get_text(lang_code, "currenciesTxt")}", parse_mode="Markdown")
     await state.set_state(User.currency)
@@ -151,10 +170,11 @@ async def get_balance(message: Message, state: FSMContext, bot: Bot):
     lang_code = data.get("lang_code")
     currency = data.get("currency")
     rouded_offset = data.get("datetime_time")
+    time_zone = data.get("time_zone")
     
     if data_text == "/skip":
         #way with skipping the balance update
-        await db.update_user_info(user_id=user_id, rounded_offset=rouded_offset, currency=currency)
+        await db.update_user_info(user_id=user_id, rounded_offset=rouded_offset, currency=currency, time_zone=time_zone)
     else:
         balans_text = data_text.replace(",", ".")
         MAX_BALANCE = 9999999999.99
@@ -189,7 +209,9 @@ async def get_balance(message: Message, state: FSMContext, bot: Bot):
 
         # Save balance
         
-        await db.update_user_info(user_id=user_id, rounded_offset=rouded_offset, currency=currency, balans=balans)
+        await db.update_user_info(user_id=user_id, rounded_offset=rouded_offset, currency=currency, balans=balans, time_zone=time_zone)
+    # The local day may have changed with the time zone
+    quota.forget(user_id)
     
     # 💬 Copy another message
     try:
@@ -4,9 +4,11 @@ from aiogram.fsm.context import FSMContext
 
 import re
 import logging
+from datetime import date
 
 import app.cmn.transtalor as translator
-import app.data.dbContext as db
+import app.cmn.quota as quota
+import app.data.storage as db
 import app.keyboards.in_line as inKb
 import app.keyboards.out_line as outKb
 
@@ -60,34 +62,26 @@ async def add_amount2(message: Message, state: FSMContext):
         )
         return
     
-    if is_ex_bool:
-        new_balance = await db.minus_user_balance(user_id, amount)
-        if new_balance is None:
-            await translator.smart_sleep(
-                message.reply,
-                text=await translator.get_text(lng_code, "minusVal")
-            )
-            return
-    else:
-        new_balance = await db.add_user_balance(user_id, amount, 9_999_999_999.99)
-        if new_balance is None:
-            await translator.smart_sleep(
-                message.reply,
-                text=await translator.get_text(lng_code, "addVal")
-            )
-            return
-
-    amount_id = await db.insert_dengies(amount, cat_id, user_id)
+    result = await db.insert_dengies_with_balance(user_id, int(cat_id), amount, is_ex_bool)
+    if result is None:
+        await translator.smart_sleep(
+            message.reply,
+            text=await translator.get_text(lng_code, "minusVal" if is_ex_bool else "addVal")
+        )
+        return
+    new_balance, amount_id, category_name, created_day = result
+    quota.record_entry(user_id)
+
     await translator.smart_sleep(
         message.answer,
         text=await translator.get_text(lng_code, 'addComment'),
-        reply_markup=await inKb.add_comment(amount_id, lng_code)
+        reply_markup=await inKb.add_comment(amount_id, created_day, lng_code)
     )
     
     await translator.smart_sleep(
         message.reply,
         text=(
-            f"<b>{await db.get_category_name(int(cat_id))}:</b> <i>{amount}</i>\n"
+            f"<b>{category_name}:</b> <i>{amount}</i>\n"
             f"{await translator.get_text(lng_code, 'rashxodSaved')}\n\n"
             f"<b>{await translator.get_text(lng_code, 'currentBalance')}</b> "
             f"<span class='tg-spoiler'>{new_balance}</span>"
@@ -98,23 +92,16 @@ async def add_amount2(message: Message, state: FSMContext):
 
     await state.clear()
 
-@router.message(F.text.in_(translator.get_all_values_by_key(translator.translations, "rashod")))
+# The daily limit is checked by QuotaMiddleware
+@router.message(F.text.in_(translator.get_all_values_by_key(translator.translations, "rashod")), flags={"quota": "rashod"})
 async def get_all_categories(message: Message):
     user_id = message.from_user.id
     lng_code = await translator.get_lang_code_by_text_async(translator.translations, 'rashod', message.text)
-    count_ex = await db.get_todays_expense_count(user_id)
-    # logging.info(count_ex)
-    if count_ex < 50:
-        await translator.smart_sleep(
-            message.reply,
-            text=await translator.get_text(lng_code, 'category'),
-            reply_markup=await inKb.get_categories(user_id=user_id, lng_code=lng_code)
-        )
-    else:
-        await translator.smart_sleep(
-            message.reply,
-            text=await translator.get_text(lng_code, "errorLimit")
-        )
+    await translator.smart_sleep(
+        message.reply,
+        text=await translator.get_text(lng_code, 'category'),
+        reply_markup=await inKb.get_categories(user_id=user_id, lng_code=lng_code)
+    )
 
 
 @router.callback_query(F.data.startswith("ex_add"))
@@ -178,18 +165,16 @@ async def add_category2(message: Message, state: FSMContext):
             text=await translator.get_text(lng_code, 'errorName')
         )
         return
-    is_exist = await db.is_exist_title(user_id, title, bool_type)
+    result = await db.add_category(user_id, title, bool_type)
     
-    if is_exist is True:
+    if result == "exists":
         await translator.smart_sleep(
             message.answer,
             text=await translator.get_text(lng_code, "catExist")
         )
         return
-    elif is_exist is False:
+    elif result == "reactivated":
         logging.info(f"Reactivated category from user {user_id}")
-    else:
-        await db.create_category(user_id, title, bool_type)
     
     await translator.smart_sleep(
         message.reply,
@@ -260,7 +245,7 @@ async def del_category(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("addComment_"))
 async def add_comment1(callback: CallbackQuery, state: FSMContext):
     data = callback.data.replace("addComment_", "")
-    dengies_id, lng_code = data.split(":")
+    dengies_id, created_day, lng_code = data.split(":")
     await translator.smart_sleep(callback.message.delete)
 
     # Ask the user for the comment
@@ -269,7 +254,7 @@ async def add_comment1(callback: CallbackQuery, state: FSMContext):
         text=await translator.get_text(lng_code, "commentTxt"),
         reply_markup=ReplyKeyboardRemove()
     )
-    await state.update_data(dengies_id_ln_code = f"{dengies_id}:{lng_code}")
+    await state.update_data(dengies_id_ln_code = f"{dengies_id}:{created_day}:{lng_code}")
     await state.set_state(Comment.comment_text)
 
 @router.message(Comment.comment_text)
@@ -287,7 +272,7 @@ async def add_comment2(message: Message, state: FSMContext):
         return
 
     data = await state.get_data()
-    dengies_id, lng_code = str(data.get("dengies_id_ln_code")).split(":")
+    dengies_id, created_day, lng_code = str(data.get("dengies_id_ln_code")).split(":")
     if len(comment_text) > 30:
         await translator.smart_sleep(
             message.answer,
@@ -295,7 +280,7 @@ async def add_comment2(message: Message, state: FSMContext):
         )
         return
     
-    result = await db.update_comment_text(int(dengies_id), comment_text)
+    result = await db.update_comment_text(int(dengies_id), date.fromisoformat(created_day), comment_text)
     
     if result:
         await translator.smart_sleep(
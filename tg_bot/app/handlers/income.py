@@ -6,7 +6,7 @@ import re
 import logging
 
 import app.cmn.transtalor as translator
-import app.data.dbContext as db
+import app.data.storage as db
 import app.keyboards.in_line as inKb
 import app.keyboards.out_line as outKb
 
@@ -103,18 +103,16 @@ async def add_category2(message: Message, state: FSMContext):
             text=await translator.get_text(lng_code, 'errorName')
         )
         return
-    is_exist = await db.is_exist_title(user_id, title, bool_type)
+    result = await db.add_category(user_id, title, bool_type)
     
-    if is_exist is True:
+    if result == "exists":
         await translator.smart_sleep(
             message.answer,
             text=await translator.get_text(lng_code, "catExist")
         )
         return
-    elif is_exist is False:
+    elif result == "reactivated":
         logging.info(f"Reactivated category from user {user_id}")
-    else:
-        await db.create_category(user_id, title, bool_type)
     
     await translator.smart_sleep(
         message.reply,
@@ -7,7 +7,7 @@ import re
 import logging
 
 import app.cmn.transtalor as translator
-import app.data.dbContext as db
+import app.data.storage as db
 import app.keyboards.in_line as inKb
 import app.keyboards.out_line as outKb
 
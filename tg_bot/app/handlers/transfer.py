@@ -0,0 +1,199 @@
+from aiogram import Router, F, Bot
+from aiogram.filters import Command
+from aiogram.filters import CommandObject
+from aiogram.types import Message, FSInputFile
+from aiogram.fsm.context import FSMContext
+
+import os
+import html
+import time
+import logging
+import tempfile
+from datetime import datetime, timedelta
+
+import app.cmn.transtalor as translator
+import app.cmn.quota as quota
+import app.data.storage as db
+import app.data.ledger_csv as ledger_csv
+import app.keyboards.out_line as outKb
+
+from app.models.models import Import
+
+router = Router()
+
+# Telegram limits how often a message can be edited
+PROGRESS_MIN_INTERVAL = 3.0
+
+IMPORT_ERRORS = {
+    "not_registered": "importFailed",
+    "bad_header": "importBadHeader",
+    "no_rows": "importNoRows",
+    "too_many_rows": "importTooManyRows",
+    "encoding": "importEncoding",
+    "category_limit": "importCategoryLimit",
+    "balance": "importBalance",
+    "error": "importFailed",
+}
+
+
+@router.message(Command("import"))
+async def import_start(message: Message, state: FSMContext):
+    lng_code = await db.get_user_language(message.from_user.id) or "en"
+    await translator.smart_sleep(
+        message.answer,
+        text=await translator.get_text(lng_code, "importHelp"),
+        parse_mode='HTML'
+    )
+    await state.update_data(lang_code=lng_code)
+    await state.set_state(Import.file)
+
+
+@router.message(Import.file, F.document)
+async def import_file(message: Message, state: FSMContext, bot: Bot):
+    user_id = message.from_user.id
+    lng_code = (await state.get_data()).get("lang_code", "en")
+    document = message.document
+
+    if not (document.file_name or "").lower().endswith(".csv"):
+        await translator.smart_sleep(
+            message.reply,
+            text=await translator.get_text(lng_code, "importNotCsv")
+        )
+        return
+
+    if document.file_size and document.file_size > ledger_csv.IMPORT_MAX_BYTES:
+        await translator.smart_sleep(
+            message.reply,
+            text=await translator.get_text(lng_code, "importTooLarge")
+        )
+        return
+
+    await state.clear()
+    status_message = await translator.smart_sleep(
+        message.answer,
+        text=await translator.get_text(lng_code, "importStarted")
+    )
+    progress_text = await translator.get_text(lng_code, "importProgress")
+    last_edit = time.monotonic()
+
+    async def progress(rows: int):
+        nonlocal last_edit
+        if status_message is None or time.monotonic() - last_edit < PROGRESS_MIN_INTERVAL:
+            return
+        last_edit = time.monotonic()
+        await translator.smart_sleep(status_message.edit_text, text=f"{progress_text} {rows}")
+
+    # On disk, not in memory: the file can hold 100k+ rows
+    with tempfile.TemporaryFile() as raw:
+        await bot.download(document, destination=raw)
+        result = await db.import_csv(user_id, raw, progress)
+
+    if result["status"] != "ok":
+        logging.info(f"Import of user {user_id} failed: {result['status']}")
+        await translator.smart_sleep(
+            message.reply,
+            text=await translator.get_text(lng_code, IMPORT_ERRORS[result["status"]]),
+            reply_markup=await outKb.main_menu(lng_code)
+        )
+        return
+
+    # Today's entry count may have changed
+    quota.forget(user_id)
+
+    text = (
+        f"{await translator.get_text(lng_code, 'importDone')} {result['imported']}\n"
+        f"<b>{await translator.get_text(lng_code, 'currentBalance')}</b> "
+        f"<span class='tg-spoiler'>{result['balance']}</span>"
+    )
+    if result["skipped"]:
+        text += (
+            f"\n\n{await translator.get_text(lng_code, 'importSkipped')} {result['skipped']}\n"
+            + html.escape("\n".join(result["errors"]))
+        )
+    await translator.smart_sleep(
+        message.reply,
+        text=text,
+        parse_mode='HTML',
+        reply_markup=await outKb.main_menu(lng_code)
+    )
+
+
+@router.message(Import.file)
+async def import_not_file(message: Message, state: FSMContext):
+    lng_code = (await state.get_data()).get("lang_code", "en")
+    if message.text in translator.get_all_values_by_key(translator.translations, 'cancel') or message.text == "/cancel":
+        await state.clear()
+        await translator.smart_sleep(
+            message.answer,
+            text=await translator.get_text(lng_code, 'delCancel'),
+            reply_markup=await outKb.main_menu(lng_code)
+        )
+        return
+
+    await translator.smart_sleep(
+        message.reply,
+        text=await translator.get_text(lng_code, "importNotCsv")
+    )
+
+
+
+def _parse_export_args(args: str | None) -> tuple[datetime, datetime, bool]:
+    """
+    /export [YYYY-MM-DD [YYYY-MM-DD]] [gz] -> (date_from, date_to exclusive, compress).
+    Without dates the whole history is exported; the end date is inclusive.
+    """
+    compress = False
+    dates = []
+    for arg in (args or "").split():
+        if arg.lower() in ("gz", "gzip"):
+            compress = True
+        else:
+            dates.append(datetime.strptime(arg, "%Y-%m-%d"))
+
+    if len(dates) > 2:
+        raise ValueError("too many dates")
+    date_from = dates[0] if dates else datetime(2000, 1, 1)
+    date_to = dates[1] + timedelta(days=1) if len(dates) > 1 else datetime(9999, 1, 1)
+    return date_from, date_to, compress
+
+
+@router.message(Command("export"))
+async def export_ledger(message: Message, command: CommandObject):
+    user_id = message.from_user.id
+    lng_code = await db.get_user_language(user_id) or "en"
+    try:
+        date_from, date_to, compress = _parse_export_args(command.args)
+    except ValueError:
+        await translator.smart_sleep(
+            message.reply,
+            text=await translator.get_text(lng_code, "exportHelp"),
+            parse_mode='HTML'
+        )
+        return
+
+    await translator.smart_sleep(
+        message.answer,
+        text=await translator.get_text(lng_code, "exportStarted")
+    )
+
+    file_name = f"hisob_{user_id}_{datetime.utcnow():%Y%m%d}.csv" + (".gz" if compress else "")
+    # delete=False: the file is reopened by path for the upload, removed below
+    with tempfile.NamedTemporaryFile(suffix=".gz" if compress else ".csv", delete=False) as destination:
+        path = destination.name
+        rows = await db.export_csv(user_id, date_from, date_to, destination, compress)
+
+    try:
+        if rows is None:
+            await translator.smart_sleep(
+                message.reply,
+                text=await translator.get_text(lng_code, "exportFailed")
+            )
+            return
+
+        await translator.smart_sleep(
+            message.answer_document,
+            document=FSInputFile(path, filename=file_name),
+            caption=f"{await translator.get_text(lng_code, 'exportDone')} {rows}"
+        )
+    finally:
+        os.remove(path)
@@ -1,8 +1,10 @@
+from datetime import date
+
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 import app.cmn.transtalor as translator
-import app.data.dbContext as db
+import app.data.storage as db
 
 
 async def get_categories(user_id: int, lng_code: str, is_ex: bool = True, for_delete: bool = False) -> InlineKeyboardMarkup:
@@ -60,7 +62,7 @@ async def get_categories(user_id: int, lng_code: str, is_ex: bool = True, for_de
 
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-async def add_comment(amount_id: int, lang_code: str) -> InlineKeyboardMarkup:
+async def add_comment(amount_id: int, created_day: date, lang_code: str) -> InlineKeyboardMarkup:
     """
     Build an inline keyboard for language selection.
     Button text = full_name (e.g. English, Русский, O'zbek)
@@ -71,7 +73,7 @@ async def add_comment(amount_id: int, lang_code: str) -> InlineKeyboardMarkup:
     keyboard.add(
         InlineKeyboardButton(
             text=f"📝 {await translator.get_text(lang_code, 'addCommentBtn')}",
-            callback_data=f"addComment_{amount_id}:{lang_code}"
+            callback_data=f"addComment_{amount_id}:{created_day.isoformat()}:{lang_code}"
         )
     )
 
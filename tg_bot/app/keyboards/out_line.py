@@ -1,6 +1,6 @@
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 import app.cmn.transtalor as translator
-import app.data.dbContext as db
+import app.data.storage as db
 
 
 
@@ -0,0 +1,47 @@
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message
+
+import app.cmn.quota as quota
+import app.cmn.transtalor as translator
+
+
+class QuotaMiddleware(BaseMiddleware):
+    """
+    Rejects handlers flagged with `quota` when the user is over the daily entry
+    limit or sends too fast. The flag value is the translations key of the
+    button text, used to answer in the user's language.
+
+        @router.message(F.text.in_(...), flags={"quota": "rashod"})
+
+    Counters live in memory (app/cmn/quota.py), so rejected users cost no queries.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any]
+    ) -> Any:
+        text_key = get_flag(data, "quota")
+        if not text_key:
+            return await handler(event, data)
+
+        user_id = event.from_user.id
+        if not quota.allow_burst(user_id):
+            logging.info(f"Throttled user {user_id}")
+            return None
+
+        if quota.is_over_limit(await quota.entries_today(user_id)):
+            lng_code = await translator.get_lang_code_by_text_async(translator.translations, text_key, event.text)
+            await translator.smart_sleep(
+                event.reply,
+                text=await translator.get_text(lng_code, "errorLimit")
+            )
+            logging.info(f"User {user_id} is over the daily limit")
+            return None
+
+        return await handler(event, data)
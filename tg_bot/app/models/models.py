@@ -12,4 +12,7 @@ class Dengies(StatesGroup):
     amount = State()
 
 class Comment(StatesGroup):
-    comment_text = State()
\ No newline at end of file
+    comment_text = State()
+
+class Import(StatesGroup):
+    file = State()
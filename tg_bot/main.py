@@ -11,10 +11,14 @@ from aiohttp import ClientConnectorError
 import os
 
 from app.auto.automatik import schedule_hourly_task
+from app.auto.outbox import run_sender, OUTBOX_SENDER
+from app.data.storage import open_pools, close_pools, run_migrations
 from app.handlers.common import router as common
 from app.handlers.expense import router as expense
 from app.handlers.income import router as income
+from app.middlewares.quota import QuotaMiddleware
 from app.handlers.profile import router as profile
+from app.handlers.transfer import router as transfer
 
 from aiogram import Bot, Dispatcher
 # Initialize logging
@@ -27,13 +31,21 @@ bot = Bot(token = TOKEN)
 dp = Dispatcher()
 
 async def main():
+    dp.include_router(transfer)
     dp.include_router(expense)
     dp.include_router(profile)
     dp.include_router(common)
     dp.include_router(income)
 
     # dp.update.middleware(UnifiedMessageMiddleware())  # Update middleware
-    scheduler_task = asyncio.create_task(schedule_hourly_task(bot))
+    dp.message.middleware(QuotaMiddleware())
+    # Warm up the connection pools before the first update arrives
+    await open_pools()
+    if os.getenv('RUN_MIGRATIONS', '1') == '1':
+        await run_migrations()
+    scheduler_task = asyncio.create_task(schedule_hourly_task())
+    # Delivers the messages the scheduler queued, including those left by a previous run
+    outbox_task = asyncio.create_task(run_sender(bot)) if OUTBOX_SENDER else None
     try:
         # Start polling
         await dp.start_polling(bot)
@@ -49,6 +61,13 @@ async def main():
             await scheduler_task
         except asyncio.CancelledError:
             logging.info("Scheduler task cancelled.")
+        if outbox_task is not None:
+            outbox_task.cancel()
+            try:
+                await outbox_task
+            except asyncio.CancelledError:
+                logging.info("Outbox sender cancelled.")
+        await close_pools()
         await bot.session.close()
         logging.info("Bot session closed.")
 
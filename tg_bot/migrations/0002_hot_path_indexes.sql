@@ -0,0 +1,37 @@
+-- Secondary indexes for the predicates dbContext filters on.
+-- The date predicates in dbContext are half-open ranges on created_date,
+-- so the trailing created_date column can be used for range scans.
+
+-- Today's rows / counts per user, rollups over a day
+CREATE INDEX IF NOT EXISTS dengies_user_created_idx
+    ON dengies (user_id, created_date);
+
+-- Last amounts per (user, category)
+CREATE INDEX IF NOT EXISTS dengies_user_category_created_idx
+    ON dengies (user_id, category_id, created_date);
+
+-- Category keyboard (the active categories of a type) and add_category's
+-- case-insensitive title lookup
+CREATE INDEX IF NOT EXISTS categories_user_type_title_idx
+    ON categories (user_id, is_ex, lower(title));
+
+-- Scheduler: users due at the current hour
+CREATE INDEX IF NOT EXISTS users_time_utc_idx
+    ON users (time_utc);
+
+-- Profile month-to-date totals
+CREATE INDEX IF NOT EXISTS daily_reports_user_type_created_idx
+    ON daily_reports (user_id, is_ex, created_date);
+
+-- Monthly rollup only reads daily rows not yet linked to a month
+CREATE INDEX IF NOT EXISTS daily_category_reports_unlinked_idx
+    ON daily_category_reports (user_id, created_date)
+    WHERE month_id IS NULL;
+
+-- Yearly rollup only reads monthly rows not yet linked to a year
+CREATE INDEX IF NOT EXISTS monthly_category_reports_unlinked_idx
+    ON monthly_category_reports (user_id, created_date)
+    WHERE year_id IS NULL;
+
+CREATE INDEX IF NOT EXISTS yearly_category_reports_user_created_idx
+    ON yearly_category_reports (user_id, created_date);
@@ -0,0 +1,127 @@
+-- dengies becomes a ledger partitioned by month on created_date (user's local time).
+-- Partitions are named dengies_YYYY_MM; rows outside every partition go to dengies_default.
+-- maintain_dengies_partitions() is called daily by the scheduler (see automatik.py).
+
+ALTER TABLE dengies RENAME TO dengies_unpartitioned;
+ALTER TABLE dengies_unpartitioned RENAME CONSTRAINT dengies_pkey TO dengies_unpartitioned_pkey;
+ALTER INDEX IF EXISTS dengies_user_created_idx RENAME TO dengies_unpartitioned_user_created_idx;
+ALTER INDEX IF EXISTS dengies_user_category_created_idx RENAME TO dengies_unpartitioned_user_category_created_idx;
+-- Keep the id sequence alive when the old table is dropped
+ALTER SEQUENCE dengies_id_seq OWNED BY NONE;
+
+CREATE TABLE dengies (
+    id BIGINT NOT NULL DEFAULT nextval('dengies_id_seq'),
+    amount NUMERIC(12,2) NOT NULL,
+    comment_text VARCHAR(30) DEFAULT NULL,
+    created_date TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL DEFAULT date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC'),
+    category_id BIGINT REFERENCES categories(id),
+    user_id BIGINT REFERENCES users(id),
+    -- The partition key has to be part of the primary key
+    PRIMARY KEY (id, created_date)
+) PARTITION BY RANGE (created_date);
+
+CREATE TABLE dengies_default PARTITION OF dengies DEFAULT;
+
+CREATE INDEX dengies_user_created_idx
+    ON dengies (user_id, created_date);
+CREATE INDEX dengies_user_category_created_idx
+    ON dengies (user_id, category_id, created_date);
+
+
+CREATE OR REPLACE FUNCTION create_dengies_partition(month_start DATE)
+RETURNS BOOLEAN AS $$
+DECLARE
+    month_end DATE := (month_start + INTERVAL '1 month')::date;
+    partition_name TEXT := 'dengies_' || to_char(month_start, 'YYYY_MM');
+BEGIN
+    -- Also true for detached partitions, they are never re-created
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN FALSE;
+    END IF;
+
+    -- Rows of this month that landed in the default partition have to move
+    -- out of it before the new range can be created.
+    CREATE TEMP TABLE dengies_moving ON COMMIT DROP AS
+        SELECT * FROM dengies_default
+        WHERE created_date >= month_start AND created_date < month_end;
+    DELETE FROM dengies_default
+        WHERE created_date >= month_start AND created_date < month_end;
+
+    EXECUTE format(
+        'CREATE TABLE %I PARTITION OF dengies FOR VALUES FROM (%L) TO (%L)',
+        partition_name, month_start, month_end
+    );
+
+    INSERT INTO dengies SELECT * FROM dengies_moving;
+    DROP TABLE dengies_moving;
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Creates partitions from last month up to months_ahead months ahead and, if
+-- retention_months > 0, detaches partitions older than that many months.
+-- Detached partitions stay in the database as plain tables.
+CREATE OR REPLACE FUNCTION maintain_dengies_partitions(months_ahead INT, retention_months INT)
+RETURNS TABLE (action TEXT, partition_name TEXT) AS $$
+DECLARE
+    this_month DATE := date_trunc('month', CURRENT_TIMESTAMP AT TIME ZONE 'UTC')::date;
+    month_start DATE;
+    oldest_kept TEXT;
+    rec RECORD;
+BEGIN
+    -- Local time is UTC-12..UTC+14, so last month can still receive rows
+    FOR i IN -1..months_ahead LOOP
+        month_start := (this_month + make_interval(months => i))::date;
+        IF create_dengies_partition(month_start) THEN
+            action := 'created';
+            partition_name := 'dengies_' || to_char(month_start, 'YYYY_MM');
+            RETURN NEXT;
+        END IF;
+    END LOOP;
+
+    IF retention_months > 0 THEN
+        oldest_kept := 'dengies_' || to_char(this_month - make_interval(months => retention_months), 'YYYY_MM');
+        FOR rec IN
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'dengies'::regclass
+              AND c.relname ~ '^dengies_\d{4}_\d{2}$'
+              AND c.relname < oldest_kept
+            ORDER BY c.relname
+        LOOP
+            EXECUTE format('ALTER TABLE dengies DETACH PARTITION %I', rec.relname);
+            action := 'detached';
+            partition_name := rec.relname;
+            RETURN NEXT;
+        END LOOP;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- One partition per month of existing history, plus the ones ahead
+DO $$
+DECLARE
+    month_start DATE;
+BEGIN
+    FOR month_start IN
+        SELECT gs::date
+        FROM generate_series(
+            (SELECT date_trunc('month', COALESCE(MIN(created_date), CURRENT_TIMESTAMP AT TIME ZONE 'UTC')) FROM dengies_unpartitioned),
+            date_trunc('month', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + INTERVAL '3 months',
+            INTERVAL '1 month'
+        ) AS gs
+    LOOP
+        PERFORM create_dengies_partition(month_start);
+    END LOOP;
+END;
+$$;
+
+INSERT INTO dengies (id, amount, comment_text, created_date, category_id, user_id)
+SELECT id, amount, comment_text, created_date, category_id, user_id
+FROM dengies_unpartitioned;
+
+DROP TABLE dengies_unpartitioned;
+ALTER SEQUENCE dengies_id_seq OWNED BY dengies.id;
@@ -0,0 +1,21 @@
+-- Running totals per user, local day and type, maintained by the statements
+-- that insert into dengies (same transaction), so "today" and month-to-date
+-- reads are primary key lookups instead of aggregations over dengies.
+-- local_day is created_date::date, created_date being the user's local time.
+
+CREATE TABLE IF NOT EXISTS user_day_totals (
+    user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    local_day DATE NOT NULL,
+    is_ex BOOLEAN NOT NULL,
+    entries_count INT NOT NULL DEFAULT 0,
+    total_amount NUMERIC(16,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, local_day, is_ex)
+);
+
+INSERT INTO user_day_totals (user_id, local_day, is_ex, entries_count, total_amount)
+SELECT d.user_id, d.created_date::date, c.is_ex, COUNT(*), SUM(d.amount)
+FROM dengies d
+JOIN categories c ON c.id = d.category_id
+WHERE d.user_id IS NOT NULL
+GROUP BY d.user_id, d.created_date::date, c.is_ex
+ON CONFLICT (user_id, local_day, is_ex) DO NOTHING;
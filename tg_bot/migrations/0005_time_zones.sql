@@ -0,0 +1,38 @@
+-- Users keep an IANA time zone; time_utc stays as the zone's current offset
+-- (every "local time" expression reads it) and is kept in step with DST by
+-- refresh_zone_offsets on each scheduler tick.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS time_zone TEXT NOT NULL DEFAULT 'Etc/UTC';
+
+-- Offsets so far were typed as whole hours, which are exactly the Etc/GMT zones
+-- (POSIX sign convention: Etc/GMT-5 is UTC+5)
+UPDATE users
+SET time_zone = 'Etc/GMT'
+    || CASE WHEN time_utc < INTERVAL '0' THEN '+' ELSE '-' END
+    || abs(EXTRACT(EPOCH FROM time_utc)::int / 3600)
+WHERE time_zone = 'Etc/UTC'
+  AND time_utc <> INTERVAL '0'
+  AND EXTRACT(EPOCH FROM time_utc)::int % 3600 = 0
+  AND time_utc BETWEEN INTERVAL '-12 hours' AND INTERVAL '14 hours';
+
+-- Current offset of every zone in use: the scheduler picks the zones where it is
+-- the target local time from here, then their users through users_time_zone_idx
+CREATE TABLE IF NOT EXISTS zone_offsets (
+    time_zone TEXT PRIMARY KEY,
+    utc_offset INTERVAL NOT NULL,
+    refreshed_at TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL DEFAULT date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+);
+
+CREATE INDEX IF NOT EXISTS zone_offsets_offset_idx
+    ON zone_offsets (utc_offset, time_zone);
+
+INSERT INTO zone_offsets (time_zone, utc_offset)
+SELECT DISTINCT ON (time_zone) time_zone, time_utc
+FROM users
+ORDER BY time_zone
+ON CONFLICT (time_zone) DO NOTHING;
+
+CREATE INDEX IF NOT EXISTS users_time_zone_idx
+    ON users (time_zone);
+
+-- Replaced by the lookup above
+DROP INDEX IF EXISTS users_time_utc_idx;
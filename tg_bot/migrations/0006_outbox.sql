@@ -0,0 +1,32 @@
+-- Outbound messages. Scheduler jobs enqueue rendered messages and the sender loop
+-- (app/auto/outbox.py) delivers them, so a restart in the middle of a run resumes
+-- where it stopped instead of dropping the rest.
+-- Senders claim due rows with FOR UPDATE SKIP LOCKED and lease them by moving
+-- available_at forward: rows of a sender that dies are claimed again once the
+-- lease is over (at-least-once delivery). dedup_key makes enqueueing the same
+-- job twice a no-op.
+CREATE TABLE IF NOT EXISTS outbox (
+    id BIGSERIAL PRIMARY KEY,
+    -- job:run:chat, e.g. 'reminder:202610171600:12345'
+    dedup_key TEXT NOT NULL UNIQUE,
+    chat_id BIGINT NOT NULL,
+    -- message parts, sent in order; sent_parts of them are delivered
+    texts TEXT[] NOT NULL,
+    sent_parts INT NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'sent', 'failed')),
+    attempts INT NOT NULL DEFAULT 0,
+    last_error TEXT,
+    available_at TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL DEFAULT date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC'),
+    created_at TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL DEFAULT date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC'),
+    finished_at TIMESTAMP(0) WITHOUT TIME ZONE
+);
+
+-- Claiming: due pending rows, oldest first
+CREATE INDEX IF NOT EXISTS outbox_pending_idx
+    ON outbox (available_at, id)
+    WHERE status = 'pending';
+
+-- Purging finished rows
+CREATE INDEX IF NOT EXISTS outbox_finished_idx
+    ON outbox (finished_at)
+    WHERE status <> 'pending';
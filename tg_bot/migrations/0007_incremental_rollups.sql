@@ -0,0 +1,465 @@
+-- Incremental rollups (dbContext.run_daily_rollups). Every report row gets the
+-- period it sums up (period_start: the day, the first of the month or Jan 1); the
+-- rollups add to the row of the period, or insert it, and link daily category rows
+-- to their month and monthly rows to their year as they go.
+-- rollup_watermarks keeps, per user, the highest dengies.id already added to the
+-- reports. A run only reads the rows above it, so running twice adds nothing and
+-- whatever a late or missed run left out is caught up by the next one. No row above
+-- it was created (local time) before min_created_date, which keeps a run to the
+-- recent partitions of dengies.
+--
+-- Existing report rows are kept: they get their period_start, the rows the previous
+-- rollups left out are added to them, the periods still open get their monthly and
+-- yearly rows, a period's rows are merged into one, and the watermarks start after
+-- what is in the reports.
+CREATE TABLE IF NOT EXISTS rollup_watermarks (
+    user_id BIGINT PRIMARY KEY REFERENCES users(id),
+    last_dengies_id BIGINT NOT NULL DEFAULT 0,
+    min_created_date TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL DEFAULT '-infinity',
+    updated_at TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL DEFAULT date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+);
+
+-- A user's rows above the watermark
+CREATE INDEX IF NOT EXISTS dengies_user_id_idx
+    ON dengies (user_id, id);
+
+ALTER TABLE daily_reports ADD COLUMN IF NOT EXISTS period_start DATE;
+ALTER TABLE daily_category_reports ADD COLUMN IF NOT EXISTS period_start DATE;
+ALTER TABLE monthly_category_reports ADD COLUMN IF NOT EXISTS period_start DATE;
+ALTER TABLE yearly_category_reports ADD COLUMN IF NOT EXISTS period_start DATE;
+
+-- Totals are summed up in steps now, whole numbers would round at every step.
+-- period_start is filled in by the same rewrite of the table, not by an UPDATE of
+-- every row: daily rows were written on the day they sum up, imported ones on its
+-- last second; monthly and yearly rows early in the month (year) after, or on the
+-- period's last second.
+ALTER TABLE daily_reports
+    ALTER COLUMN total_amount TYPE NUMERIC(16,2),
+    ALTER COLUMN period_start TYPE DATE USING created_date::date;
+ALTER TABLE daily_category_reports
+    ALTER COLUMN total_amount TYPE NUMERIC(16,2),
+    ALTER COLUMN period_start TYPE DATE USING created_date::date;
+ALTER TABLE monthly_category_reports
+    ALTER COLUMN total_amount TYPE NUMERIC(16,2),
+    ALTER COLUMN period_start TYPE DATE USING date_trunc('month', created_date - INTERVAL '1 day')::date;
+ALTER TABLE yearly_category_reports
+    ALTER COLUMN total_amount TYPE NUMERIC(16,2),
+    ALTER COLUMN period_start TYPE DATE USING date_trunc('year', created_date - INTERVAL '1 day')::date;
+
+-- Monthly and yearly rows with rows linked to them take the period of those
+UPDATE monthly_category_reports m
+SET period_start = l.period_start
+FROM (
+    SELECT month_id, date_trunc('month', MIN(period_start))::date AS period_start
+    FROM daily_category_reports
+    WHERE month_id IS NOT NULL
+    GROUP BY month_id
+) l
+WHERE m.id = l.month_id
+    AND m.period_start <> l.period_start;
+UPDATE yearly_category_reports y
+SET period_start = l.period_start
+FROM (
+    SELECT year_id, date_trunc('year', MIN(period_start))::date AS period_start
+    FROM monthly_category_reports
+    WHERE year_id IS NOT NULL
+    GROUP BY year_id
+) l
+WHERE y.id = l.year_id
+    AND y.period_start <> l.period_start;
+
+-- A period's rows, for the steps below; they add to the newest one. Not unique
+-- yet, the rows of a period are merged at the end.
+CREATE INDEX IF NOT EXISTS daily_reports_period_idx
+    ON daily_reports (user_id, period_start, is_ex);
+
+CREATE INDEX IF NOT EXISTS daily_category_reports_period_idx
+    ON daily_category_reports (user_id, period_start, category_id);
+
+CREATE INDEX IF NOT EXISTS monthly_category_reports_period_idx
+    ON monthly_category_reports (user_id, period_start, category_id);
+
+CREATE INDEX IF NOT EXISTS yearly_category_reports_period_idx
+    ON yearly_category_reports (user_id, period_start, category_id);
+
+-- The previous rollups summed up a day's rows when they ran on it: a row is in the
+-- reports if its day has a daily report written at or after it (local times on
+-- both sides; imported days were written on their last second). Each user's
+-- watermark is the highest such row. Rows below it that were left out (entered
+-- after the day's run, or on a day it did not run) are added here, rows above it
+-- by the next rollup.
+CREATE TEMP TABLE rollup_backlog ON COMMIT DROP AS
+SELECT
+    d.id,
+    d.user_id,
+    d.category_id,
+    c.is_ex,
+    d.amount,
+    d.created_date::date AS day,
+    COALESCE(d.created_date <= r.last_run, FALSE) AS reported
+FROM dengies d
+JOIN categories c ON c.id = d.category_id
+LEFT JOIN (
+    SELECT user_id, period_start, is_ex, MAX(created_date) AS last_run
+    FROM daily_reports
+    GROUP BY user_id, period_start, is_ex
+) r
+    ON r.user_id = d.user_id
+    AND r.period_start = d.created_date::date
+    AND r.is_ex = c.is_ex
+WHERE d.user_id IS NOT NULL;
+
+INSERT INTO rollup_watermarks (user_id, last_dengies_id)
+SELECT user_id, MAX(id)
+FROM rollup_backlog
+WHERE reported
+GROUP BY user_id
+ON CONFLICT (user_id) DO NOTHING;
+
+DELETE FROM rollup_backlog b
+WHERE b.reported
+    OR b.id > COALESCE((SELECT w.last_dengies_id FROM rollup_watermarks w WHERE w.user_id = b.user_id), 0);
+
+-- Amounts added to report rows that already have a parent are added to the parent
+-- (and its parent) too, the new rows are linked further down.
+CREATE TEMP TABLE rollup_links (
+    user_id BIGINT NOT NULL,
+    category_id BIGINT NOT NULL,
+    period_start DATE NOT NULL,
+    total_amount NUMERIC(16,2) NOT NULL,
+    parent_id BIGINT
+) ON COMMIT DROP;
+
+-- The newest row of each period (report_id) is looked up once, for the UPDATE and
+-- for the INSERT of the periods without one
+WITH leftover AS MATERIALIZED (
+    SELECT
+        l.*,
+        (
+            SELECT MAX(x.id)
+            FROM daily_reports x
+            WHERE x.user_id = l.user_id AND x.period_start = l.day AND x.is_ex = l.is_ex
+        ) AS report_id
+    FROM (
+        SELECT user_id, is_ex, day, SUM(amount) AS total_amount
+        FROM rollup_backlog
+        GROUP BY user_id, is_ex, day
+    ) l
+), added AS (
+    UPDATE daily_reports r
+    SET total_amount = r.total_amount + l.total_amount
+    FROM leftover l
+    WHERE r.id = l.report_id
+    RETURNING 1
+)
+INSERT INTO daily_reports (user_id, is_ex, period_start, total_amount, created_date)
+SELECT l.user_id, l.is_ex, l.day, l.total_amount, date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc
+FROM leftover l
+JOIN users u ON u.id = l.user_id
+WHERE l.report_id IS NULL;
+
+INSERT INTO rollup_links (user_id, category_id, period_start, total_amount)
+SELECT user_id, category_id, day, SUM(amount)
+FROM rollup_backlog
+GROUP BY user_id, category_id, day;
+
+UPDATE rollup_links l
+SET parent_id = (
+    SELECT MAX(d.id)
+    FROM daily_category_reports d
+    WHERE d.user_id = l.user_id
+        AND d.category_id = l.category_id
+        AND d.period_start = l.period_start
+);
+
+UPDATE daily_category_reports d
+SET total_amount = d.total_amount + l.total_amount
+FROM rollup_links l
+WHERE d.id = l.parent_id;
+
+UPDATE monthly_category_reports m
+SET total_amount = m.total_amount + l.total_amount
+FROM (
+    SELECT d.month_id, SUM(l.total_amount) AS total_amount
+    FROM rollup_links l
+    JOIN daily_category_reports d ON d.id = l.parent_id
+    GROUP BY d.month_id
+) l
+WHERE m.id = l.month_id;
+
+UPDATE yearly_category_reports y
+SET total_amount = y.total_amount + l.total_amount
+FROM (
+    SELECT m.year_id, SUM(l.total_amount) AS total_amount
+    FROM rollup_links l
+    JOIN daily_category_reports d ON d.id = l.parent_id
+    JOIN monthly_category_reports m ON m.id = d.month_id
+    GROUP BY m.year_id
+) l
+WHERE y.id = l.year_id;
+
+INSERT INTO daily_category_reports (user_id, category_id, period_start, total_amount, created_date)
+SELECT l.user_id, l.category_id, l.period_start, l.total_amount, date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc
+FROM rollup_links l
+JOIN users u ON u.id = l.user_id
+WHERE l.parent_id IS NULL;
+
+-- Monthly rows used to be written once the month was over, yearly rows once the
+-- year was: daily category rows of the current month (and of a month whose run
+-- was missed) have no monthly row yet. They are summed up into one, or added to
+-- the period's existing row, and linked to it; then the same for the monthly rows
+-- without a year.
+TRUNCATE rollup_links;
+
+INSERT INTO rollup_links (user_id, category_id, period_start, total_amount)
+SELECT user_id, category_id, date_trunc('month', period_start)::date, SUM(total_amount)
+FROM daily_category_reports
+WHERE month_id IS NULL
+GROUP BY user_id, category_id, date_trunc('month', period_start);
+
+UPDATE rollup_links l
+SET parent_id = (
+    SELECT MAX(m.id)
+    FROM monthly_category_reports m
+    WHERE m.user_id = l.user_id
+        AND m.category_id = l.category_id
+        AND m.period_start = l.period_start
+);
+
+UPDATE monthly_category_reports m
+SET total_amount = m.total_amount + l.total_amount
+FROM rollup_links l
+WHERE m.id = l.parent_id;
+
+UPDATE yearly_category_reports y
+SET total_amount = y.total_amount + l.total_amount
+FROM (
+    SELECT m.year_id, SUM(l.total_amount) AS total_amount
+    FROM rollup_links l
+    JOIN monthly_category_reports m ON m.id = l.parent_id
+    GROUP BY m.year_id
+) l
+WHERE y.id = l.year_id;
+
+WITH inserted AS (
+    INSERT INTO monthly_category_reports (user_id, category_id, period_start, total_amount, created_date)
+    SELECT l.user_id, l.category_id, l.period_start, l.total_amount, date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc
+    FROM rollup_links l
+    JOIN users u ON u.id = l.user_id
+    WHERE l.parent_id IS NULL
+    RETURNING id, user_id, category_id, period_start
+)
+UPDATE rollup_links l
+SET parent_id = i.id
+FROM inserted i
+WHERE l.user_id = i.user_id
+    AND l.category_id = i.category_id
+    AND l.period_start = i.period_start;
+
+UPDATE daily_category_reports d
+SET month_id = l.parent_id
+FROM rollup_links l
+WHERE d.month_id IS NULL
+    AND d.user_id = l.user_id
+    AND d.category_id = l.category_id
+    AND date_trunc('month', d.period_start) = l.period_start;
+
+TRUNCATE rollup_links;
+
+INSERT INTO rollup_links (user_id, category_id, period_start, total_amount)
+SELECT user_id, category_id, date_trunc('year', period_start)::date, SUM(total_amount)
+FROM monthly_category_reports
+WHERE year_id IS NULL
+GROUP BY user_id, category_id, date_trunc('year', period_start);
+
+UPDATE rollup_links l
+SET parent_id = (
+    SELECT MAX(y.id)
+    FROM yearly_category_reports y
+    WHERE y.user_id = l.user_id
+        AND y.category_id = l.category_id
+        AND y.period_start = l.period_start
+);
+
+UPDATE yearly_category_reports y
+SET total_amount = y.total_amount + l.total_amount
+FROM rollup_links l
+WHERE y.id = l.parent_id;
+
+WITH inserted AS (
+    INSERT INTO yearly_category_reports (user_id, category_id, period_start, total_amount, created_date)
+    SELECT l.user_id, l.category_id, l.period_start, l.total_amount, date_trunc('second', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc
+    FROM rollup_links l
+    JOIN users u ON u.id = l.user_id
+    WHERE l.parent_id IS NULL
+    RETURNING id, user_id, category_id, period_start
+)
+UPDATE rollup_links l
+SET parent_id = i.id
+FROM inserted i
+WHERE l.user_id = i.user_id
+    AND l.category_id = i.category_id
+    AND l.period_start = i.period_start;
+
+UPDATE monthly_category_reports m
+SET year_id = l.parent_id
+FROM rollup_links l
+WHERE m.year_id IS NULL
+    AND m.user_id = l.user_id
+    AND m.category_id = l.category_id
+    AND date_trunc('year', m.period_start) = l.period_start;
+
+-- Imports and re-runs of the previous rollups could write more than one row for a
+-- period. Now that every row is linked they are merged into the newest one: the
+-- totals are summed and the rows linked to the others are moved over to it. Then a
+-- period has exactly one row, the key the rollups upsert on.
+CREATE TEMP TABLE rollup_duplicates (
+    id BIGINT PRIMARY KEY,
+    keep_id BIGINT NOT NULL
+) ON COMMIT DROP;
+
+-- The links are checked once when the constraints are added back below, not
+-- for every deleted row (year_id and month_id have no index to look them up by)
+ALTER TABLE monthly_category_reports DROP CONSTRAINT fk_monthly_reports_year;
+ALTER TABLE daily_category_reports DROP CONSTRAINT fk_daily_reports_month;
+
+INSERT INTO rollup_duplicates
+SELECT id, keep_id
+FROM (
+    SELECT id, MAX(id) OVER (PARTITION BY user_id, category_id, period_start) AS keep_id
+    FROM yearly_category_reports
+) r
+WHERE id <> keep_id;
+
+UPDATE yearly_category_reports t
+SET total_amount = t.total_amount + s.total_amount
+FROM (
+    SELECT d.keep_id, SUM(r.total_amount) AS total_amount
+    FROM rollup_duplicates d
+    JOIN yearly_category_reports r ON r.id = d.id
+    GROUP BY d.keep_id
+) s
+WHERE t.id = s.keep_id;
+
+UPDATE monthly_category_reports c
+SET year_id = d.keep_id
+FROM rollup_duplicates d
+WHERE c.year_id = d.id;
+
+DELETE FROM yearly_category_reports t
+USING rollup_duplicates d
+WHERE t.id = d.id;
+
+TRUNCATE rollup_duplicates;
+
+INSERT INTO rollup_duplicates
+SELECT id, keep_id
+FROM (
+    SELECT id, MAX(id) OVER (PARTITION BY user_id, category_id, period_start) AS keep_id
+    FROM monthly_category_reports
+) r
+WHERE id <> keep_id;
+
+UPDATE monthly_category_reports t
+SET total_amount = t.total_amount + s.total_amount
+FROM (
+    SELECT d.keep_id, SUM(r.total_amount) AS total_amount
+    FROM rollup_duplicates d
+    JOIN monthly_category_reports r ON r.id = d.id
+    GROUP BY d.keep_id
+) s
+WHERE t.id = s.keep_id;
+
+UPDATE daily_category_reports c
+SET month_id = d.keep_id
+FROM rollup_duplicates d
+WHERE c.month_id = d.id;
+
+DELETE FROM monthly_category_reports t
+USING rollup_duplicates d
+WHERE t.id = d.id;
+
+TRUNCATE rollup_duplicates;
+
+INSERT INTO rollup_duplicates
+SELECT id, keep_id
+FROM (
+    SELECT id, MAX(id) OVER (PARTITION BY user_id, category_id, period_start) AS keep_id
+    FROM daily_category_reports
+) r
+WHERE id <> keep_id;
+
+UPDATE daily_category_reports t
+SET total_amount = t.total_amount + s.total_amount
+FROM (
+    SELECT d.keep_id, SUM(r.total_amount) AS total_amount
+    FROM rollup_duplicates d
+    JOIN daily_category_reports r ON r.id = d.id
+    GROUP BY d.keep_id
+) s
+WHERE t.id = s.keep_id;
+
+DELETE FROM daily_category_reports t
+USING rollup_duplicates d
+WHERE t.id = d.id;
+
+TRUNCATE rollup_duplicates;
+
+INSERT INTO rollup_duplicates
+SELECT id, keep_id
+FROM (
+    SELECT id, MAX(id) OVER (PARTITION BY user_id, is_ex, period_start) AS keep_id
+    FROM daily_reports
+) r
+WHERE id <> keep_id;
+
+UPDATE daily_reports t
+SET total_amount = t.total_amount + s.total_amount
+FROM (
+    SELECT d.keep_id, SUM(r.total_amount) AS total_amount
+    FROM rollup_duplicates d
+    JOIN daily_reports r ON r.id = d.id
+    GROUP BY d.keep_id
+) s
+WHERE t.id = s.keep_id;
+
+DELETE FROM daily_reports t
+USING rollup_duplicates d
+WHERE t.id = d.id;
+
+TRUNCATE rollup_duplicates;
+
+ALTER TABLE monthly_category_reports
+    ADD CONSTRAINT fk_monthly_reports_year
+        FOREIGN KEY (year_id)
+        REFERENCES yearly_category_reports (id);
+ALTER TABLE daily_category_reports
+    ADD CONSTRAINT fk_daily_reports_month
+        FOREIGN KEY (month_id)
+        REFERENCES monthly_category_reports (id);
+DROP INDEX IF EXISTS daily_reports_period_idx;
+DROP INDEX IF EXISTS daily_category_reports_period_idx;
+DROP INDEX IF EXISTS monthly_category_reports_period_idx;
+DROP INDEX IF EXISTS yearly_category_reports_period_idx;
+
+-- Also the digest's lookups by user and day
+ALTER TABLE daily_reports
+    ADD CONSTRAINT daily_reports_period_key UNIQUE (user_id, period_start, is_ex);
+ALTER TABLE daily_category_reports
+    ADD CONSTRAINT daily_category_reports_period_key UNIQUE (user_id, period_start, category_id);
+ALTER TABLE monthly_category_reports
+    ADD CONSTRAINT monthly_category_reports_period_key UNIQUE (user_id, period_start, category_id);
+ALTER TABLE yearly_category_reports
+    ADD CONSTRAINT yearly_category_reports_period_key UNIQUE (user_id, period_start, category_id);
+
+ALTER TABLE daily_reports ALTER COLUMN period_start SET NOT NULL;
+ALTER TABLE daily_category_reports ALTER COLUMN period_start SET NOT NULL;
+ALTER TABLE monthly_category_reports ALTER COLUMN period_start SET NOT NULL;
+ALTER TABLE yearly_category_reports ALTER COLUMN period_start SET NOT NULL;
+
+-- Every row has its parent now, nothing looks for unlinked ones; and the reports
+-- are no longer read by created_date
+DROP INDEX IF EXISTS daily_category_reports_unlinked_idx;
+DROP INDEX IF EXISTS monthly_category_reports_unlinked_idx;
+DROP INDEX IF EXISTS daily_reports_user_type_created_idx;
+DROP INDEX IF EXISTS yearly_category_reports_user_created_idx;
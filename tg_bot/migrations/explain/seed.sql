@@ -0,0 +1,159 @@
+-- Synthetic data for the EXPLAIN report in this directory (report.md), loaded on a
+-- database with only the tables.txt schema (0001_initial_schema.sql) and no
+-- schema_migrations table, like the databases the migrations were written for:
+-- 20,000 users, 8 categories each, 1,000,000 entries over the last year, and the
+-- daily, monthly and yearly reports of the old 23:45 rollups for every day before
+-- today, some periods with a second row.
+--
+--     psql -d <database> -f migrations/0001_initial_schema.sql -f migrations/explain/seed.sql
+--     python -m app.data.migrations --explain-report migrations/explain/report.md
+SELECT setseed(0.42);
+
+-- Offsets from -12 to +14 hours, typed times were whole hours
+INSERT INTO users (tg_user_id, user_name, time_utc, created_date)
+SELECT
+    1000000000 + i,
+    'user' || i,
+    make_interval(hours => i % 27 - 12),
+    (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') - INTERVAL '400 days'
+FROM generate_series(1, 20000) i;
+
+-- With a color, so assign_unique_color does not scan categories for every row
+INSERT INTO categories (title, is_ex, is_active, user_id, color_id)
+SELECT t.title, t.is_ex, NOT (t.n = 6 AND u.id % 4 = 0), u.id, t.n
+FROM users u
+CROSS JOIN (VALUES
+    (1, 'Food', TRUE), (2, 'Transport', TRUE), (3, 'Home', TRUE), (4, 'Health', TRUE),
+    (5, 'Fun', TRUE), (6, 'Other', TRUE), (7, 'Salary', FALSE), (8, 'Gifts', FALSE)
+) t (n, title, is_ex)
+ORDER BY u.id, t.n;
+
+CREATE TEMP TABLE seed_categories AS
+SELECT id, user_id, row_number() OVER (PARTITION BY user_id ORDER BY id) AS n
+FROM categories;
+CREATE INDEX ON seed_categories (user_id, n);
+
+-- A few heavy users (low ids), a long tail of light ones. created_date is local time.
+INSERT INTO dengies (amount, comment_text, created_date, category_id, user_id)
+SELECT
+    CASE WHEN s.n <= 6 THEN 1 + floor(random() * 200) ELSE 500 + floor(random() * 2000) END,
+    CASE WHEN random() < 0.2 THEN 'note' END,
+    date_trunc('second', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc - random() * INTERVAL '365 days'),
+    c.id,
+    u.id
+FROM (
+    SELECT
+        1 + floor(20000 * power(random(), 3))::int AS user_id,
+        CASE WHEN random() < 0.9 THEN 1 + floor(random() * 6)::int ELSE 7 + floor(random() * 2)::int END AS n
+    FROM generate_series(1, 1000000)
+) s
+JOIN users u ON u.id = s.user_id
+JOIN seed_categories c ON c.user_id = s.user_id AND c.n = s.n;
+
+-- The user the report's queries run for (the newest one): a year of entries and some today
+INSERT INTO dengies (amount, created_date, category_id, user_id)
+SELECT
+    1 + floor(random() * 200),
+    date_trunc('second', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc - random() * INTERVAL '365 days'),
+    c.id,
+    u.id
+FROM users u
+CROSS JOIN generate_series(1, 3000) i
+JOIN seed_categories c ON c.user_id = u.id AND c.n = 1 + i % 6
+WHERE u.id = 20000;
+
+INSERT INTO dengies (amount, created_date, category_id, user_id)
+SELECT
+    1 + floor(random() * 200),
+    date_trunc('day', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc)
+        + LEAST(random() * INTERVAL '24 hours', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc
+            - date_trunc('day', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc)),
+    c.id,
+    u.id
+FROM users u
+CROSS JOIN generate_series(1, 12) i
+JOIN seed_categories c ON c.user_id = u.id AND c.n = 1 + i % 6
+WHERE u.id = 20000;
+
+-- The old rollups: one row per day, month and year, linked to their parents
+CREATE TEMP TABLE seed_days AS
+SELECT d.user_id, d.category_id, c.is_ex, d.created_date::date AS day, SUM(d.amount)::bigint AS total
+FROM dengies d
+JOIN categories c ON c.id = d.category_id
+JOIN users u ON u.id = d.user_id
+WHERE d.created_date < date_trunc('day', (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') + u.time_utc)
+GROUP BY 1, 2, 3, 4;
+
+INSERT INTO yearly_category_reports (user_id, category_id, total_amount, created_date)
+SELECT user_id, category_id, SUM(total), MAX(day) + TIME '23:45'
+FROM seed_days
+GROUP BY user_id, category_id, date_trunc('year', day);
+
+INSERT INTO monthly_category_reports (user_id, category_id, year_id, total_amount, created_date)
+SELECT m.user_id, m.category_id, y.id, m.total, m.created_date
+FROM (
+    SELECT user_id, category_id, date_trunc('month', day) AS month, SUM(total) AS total, MAX(day) + TIME '23:45' AS created_date
+    FROM seed_days
+    GROUP BY user_id, category_id, date_trunc('month', day)
+) m
+JOIN yearly_category_reports y
+    ON y.user_id = m.user_id
+    AND y.category_id = m.category_id
+    AND date_trunc('year', y.created_date) = date_trunc('year', m.month);
+
+INSERT INTO daily_category_reports (user_id, category_id, month_id, total_amount, created_date)
+SELECT d.user_id, d.category_id, m.id, d.total, d.day + TIME '23:45'
+FROM seed_days d
+JOIN monthly_category_reports m
+    ON m.user_id = d.user_id
+    AND m.category_id = d.category_id
+    AND date_trunc('month', m.created_date) = date_trunc('month', d.day);
+
+INSERT INTO daily_reports (user_id, total_amount, is_ex, created_date)
+SELECT user_id, SUM(total), is_ex, day + TIME '23:45'
+FROM seed_days
+GROUP BY user_id, is_ex, day;
+
+-- Imports and re-runs of the old rollups left a second row for some periods, with
+-- part of the period's total: some days of every 20th user, months of every 50th
+-- and years of every 100th
+INSERT INTO daily_reports (user_id, total_amount, is_ex, created_date)
+SELECT user_id, total_amount / 2, is_ex, created_date::date + TIME '23:59:59'
+FROM daily_reports
+WHERE user_id % 20 = 0 AND extract(day FROM created_date)::int % 10 = 0;
+
+UPDATE daily_reports
+SET total_amount = total_amount - total_amount / 2
+WHERE user_id % 20 = 0 AND extract(day FROM created_date)::int % 10 = 0 AND created_date::time = TIME '23:45';
+
+INSERT INTO daily_category_reports (user_id, category_id, month_id, total_amount, created_date)
+SELECT user_id, category_id, month_id, total_amount / 2, created_date::date + TIME '23:59:59'
+FROM daily_category_reports
+WHERE user_id % 20 = 0 AND extract(day FROM created_date)::int % 10 = 0;
+
+UPDATE daily_category_reports
+SET total_amount = total_amount - total_amount / 2
+WHERE user_id % 20 = 0 AND extract(day FROM created_date)::int % 10 = 0 AND created_date::time = TIME '23:45';
+
+INSERT INTO monthly_category_reports (user_id, category_id, year_id, total_amount, created_date)
+SELECT user_id, category_id, year_id, total_amount / 2, date_trunc('month', created_date) + INTERVAL '1 month 5 minutes'
+FROM monthly_category_reports
+WHERE user_id % 50 = 0;
+
+UPDATE monthly_category_reports
+SET total_amount = total_amount - total_amount / 2
+WHERE user_id % 50 = 0 AND created_date::time = TIME '23:45';
+
+INSERT INTO yearly_category_reports (user_id, category_id, total_amount, created_date)
+SELECT user_id, category_id, total_amount / 2, date_trunc('year', created_date) + INTERVAL '1 year 5 minutes'
+FROM yearly_category_reports
+WHERE user_id % 100 = 0;
+
+UPDATE yearly_category_reports
+SET total_amount = total_amount - total_amount / 2
+WHERE user_id % 100 = 0 AND created_date::time = TIME '23:45';
+
+DROP TABLE seed_days;
+DROP TABLE seed_categories;
+
+ANALYZE;
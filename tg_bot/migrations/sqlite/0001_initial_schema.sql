@@ -0,0 +1,177 @@
+-- Schema of the SQLite storage backend (app/data/sqliteContext.py), the same tables
+-- as migrations/0001-0004 for Postgres with these differences:
+--   * money (balans, amount, total_amount) is stored as INTEGER cents;
+--   * timestamps are 'YYYY-MM-DD HH:MM:SS' text, local_day is 'YYYY-MM-DD';
+--   * users.time_utc is the UTC offset in seconds;
+--   * booleans are 0/1;
+--   * dengies is not partitioned.
+
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    tg_user_id INTEGER UNIQUE NOT NULL,
+    first_name TEXT,
+    user_name TEXT NOT NULL,
+    currency_is TEXT NOT NULL DEFAULT 'USD',
+    balans INTEGER NOT NULL DEFAULT 0,
+    language_is TEXT NOT NULL DEFAULT 'en',
+    created_date TEXT NOT NULL DEFAULT (datetime('now')),
+    time_utc INTEGER NOT NULL DEFAULT 0,
+    is_premium INTEGER NOT NULL DEFAULT 1,
+    premium_date TEXT NOT NULL DEFAULT (datetime('now'))
+);
+
+-- New users get a 3-day trial (UTC time)
+CREATE TRIGGER IF NOT EXISTS trg_set_initial_premium_date
+AFTER INSERT ON users
+FOR EACH ROW WHEN NEW.is_premium
+BEGIN
+    UPDATE users SET premium_date = datetime(NEW.created_date, '+3 days') WHERE id = NEW.id;
+END;
+
+-- Only act if is_premium changes from false -> true
+CREATE TRIGGER IF NOT EXISTS trg_set_premium_date
+AFTER UPDATE OF is_premium ON users
+FOR EACH ROW WHEN NOT OLD.is_premium AND NEW.is_premium
+BEGIN
+    UPDATE users SET premium_date = datetime('now', '+30 days') WHERE id = NEW.id;
+END;
+
+
+CREATE TABLE IF NOT EXISTS colors (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+INSERT INTO colors (name) VALUES
+('Red'),
+('Blue'),
+('Green'),
+('Yellow'),
+('Orange'),
+('Purple'),
+('Pink'),
+('Cyan'),
+('Magenta'),
+('Lime'),
+('Teal'),
+('Brown'),
+('Gray'),
+('Black'),
+('White'),
+('Violet'),
+('Indigo'),
+('Turquoise'),
+('Gold'),
+('Silver')
+ON CONFLICT (name) DO NOTHING;
+
+
+CREATE TABLE IF NOT EXISTS categories (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL CHECK (length(title) <= 15),
+    created_date TEXT NOT NULL DEFAULT (datetime('now')),
+    is_active INTEGER NOT NULL DEFAULT 1,
+    is_ex INTEGER NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    color_id INTEGER REFERENCES colors(id)
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_assign_unique_color
+AFTER INSERT ON categories
+FOR EACH ROW WHEN NEW.color_id IS NULL
+BEGIN
+    UPDATE categories
+    SET color_id = (
+        SELECT c.id
+        FROM colors c
+        WHERE c.id NOT IN (
+            SELECT color_id FROM categories WHERE user_id = NEW.user_id AND color_id IS NOT NULL
+        )
+        ORDER BY random()
+        LIMIT 1
+    )
+    WHERE id = NEW.id;
+END;
+
+
+CREATE TABLE IF NOT EXISTS dengies (
+    id INTEGER PRIMARY KEY,
+    amount INTEGER NOT NULL,
+    comment_text TEXT DEFAULT NULL CHECK (length(comment_text) <= 30),
+    created_date TEXT NOT NULL DEFAULT (datetime('now')),
+    category_id INTEGER REFERENCES categories(id),
+    user_id INTEGER REFERENCES users(id)
+);
+
+
+CREATE TABLE IF NOT EXISTS user_day_totals (
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    local_day TEXT NOT NULL,
+    is_ex INTEGER NOT NULL,
+    entries_count INTEGER NOT NULL DEFAULT 0,
+    total_amount INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, local_day, is_ex)
+) WITHOUT ROWID;
+
+
+CREATE TABLE IF NOT EXISTS daily_reports (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    total_amount INTEGER NOT NULL DEFAULT 0,
+    is_ex INTEGER NOT NULL DEFAULT 1,
+    created_date TEXT NOT NULL DEFAULT (datetime('now'))
+);
+
+CREATE TABLE IF NOT EXISTS yearly_category_reports (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    category_id INTEGER NOT NULL REFERENCES categories(id),
+    total_amount INTEGER NOT NULL DEFAULT 0,
+    created_date TEXT NOT NULL DEFAULT (datetime('now'))
+);
+
+CREATE TABLE IF NOT EXISTS monthly_category_reports (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    category_id INTEGER NOT NULL REFERENCES categories(id),
+    year_id INTEGER REFERENCES yearly_category_reports(id),
+    total_amount INTEGER NOT NULL DEFAULT 0,
+    created_date TEXT NOT NULL DEFAULT (datetime('now'))
+);
+
+CREATE TABLE IF NOT EXISTS daily_category_reports (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    category_id INTEGER NOT NULL REFERENCES categories(id),
+    month_id INTEGER REFERENCES monthly_category_reports(id),
+    total_amount INTEGER NOT NULL DEFAULT 0,
+    created_date TEXT NOT NULL DEFAULT (datetime('now'))
+);
+
+
+CREATE INDEX IF NOT EXISTS dengies_user_created_idx
+    ON dengies (user_id, created_date);
+
+CREATE INDEX IF NOT EXISTS dengies_user_category_created_idx
+    ON dengies (user_id, category_id, created_date);
+
+CREATE INDEX IF NOT EXISTS categories_user_type_active_idx
+    ON categories (user_id, is_ex)
+    WHERE is_active;
+
+CREATE INDEX IF NOT EXISTS users_time_utc_idx
+    ON users (time_utc);
+
+CREATE INDEX IF NOT EXISTS daily_reports_user_type_created_idx
+    ON daily_reports (user_id, is_ex, created_date);
+
+CREATE INDEX IF NOT EXISTS daily_category_reports_unlinked_idx
+    ON daily_category_reports (user_id, created_date)
+    WHERE month_id IS NULL;
+
+CREATE INDEX IF NOT EXISTS monthly_category_reports_unlinked_idx
+    ON monthly_category_reports (user_id, created_date)
+    WHERE year_id IS NULL;
+
+CREATE INDEX IF NOT EXISTS yearly_category_reports_user_created_idx
+    ON yearly_category_reports (user_id, created_date);
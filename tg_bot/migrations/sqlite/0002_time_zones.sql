@@ -0,0 +1,30 @@
+-- IANA time zones, see migrations/0005_time_zones.sql. utc_offset is in seconds.
+ALTER TABLE users ADD COLUMN time_zone TEXT NOT NULL DEFAULT 'Etc/UTC';
+
+UPDATE users
+SET time_zone = 'Etc/GMT'
+    || CASE WHEN time_utc < 0 THEN '+' ELSE '-' END
+    || abs(time_utc / 3600)
+WHERE time_zone = 'Etc/UTC'
+  AND time_utc <> 0
+  AND time_utc % 3600 = 0
+  AND time_utc BETWEEN -12 * 3600 AND 14 * 3600;
+
+CREATE TABLE IF NOT EXISTS zone_offsets (
+    time_zone TEXT PRIMARY KEY,
+    utc_offset INTEGER NOT NULL,
+    refreshed_at TEXT NOT NULL DEFAULT (datetime('now'))
+);
+
+CREATE INDEX IF NOT EXISTS zone_offsets_offset_idx
+    ON zone_offsets (utc_offset, time_zone);
+
+INSERT OR IGNORE INTO zone_offsets (time_zone, utc_offset)
+SELECT time_zone, MIN(time_utc)
+FROM users
+GROUP BY time_zone;
+
+CREATE INDEX IF NOT EXISTS users_time_zone_idx
+    ON users (time_zone);
+
+DROP INDEX IF EXISTS users_time_utc_idx;
@@ -0,0 +1,23 @@
+-- Outbound messages, see migrations/0006_outbox.sql. texts is a JSON array.
+-- The single writer connection serializes claims, so no row locking is needed.
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    dedup_key TEXT NOT NULL UNIQUE,
+    chat_id INTEGER NOT NULL,
+    texts TEXT NOT NULL,
+    sent_parts INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'sent', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    available_at TEXT NOT NULL DEFAULT (datetime('now')),
+    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    finished_at TEXT
+);
+
+CREATE INDEX IF NOT EXISTS outbox_pending_idx
+    ON outbox (available_at, id)
+    WHERE status = 'pending';
+
+CREATE INDEX IF NOT EXISTS outbox_finished_idx
+    ON outbox (finished_at)
+    WHERE status <> 'pending';
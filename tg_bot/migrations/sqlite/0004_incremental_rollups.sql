@@ -0,0 +1,394 @@
+-- Incremental rollups, see migrations/0007_incremental_rollups.sql; the same steps
+-- for SQLite. Amounts are already whole cents here. Existing report rows are kept:
+-- they get their period_start, the rows the previous rollups left out are added to
+-- them, the periods still open get their monthly and yearly rows, a period's rows
+-- are merged into one, and the watermarks start after what is in the reports.
+CREATE TABLE IF NOT EXISTS rollup_watermarks (
+    user_id INTEGER PRIMARY KEY REFERENCES users(id),
+    last_dengies_id INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT NOT NULL DEFAULT (datetime('now'))
+);
+
+CREATE INDEX IF NOT EXISTS dengies_user_id_idx
+    ON dengies (user_id, id);
+
+ALTER TABLE daily_reports ADD COLUMN period_start TEXT;
+ALTER TABLE daily_category_reports ADD COLUMN period_start TEXT;
+ALTER TABLE monthly_category_reports ADD COLUMN period_start TEXT;
+ALTER TABLE yearly_category_reports ADD COLUMN period_start TEXT;
+
+UPDATE daily_reports SET period_start = date(created_date);
+UPDATE daily_category_reports SET period_start = date(created_date);
+UPDATE monthly_category_reports SET period_start = date(created_date, '-1 day', 'start of month');
+UPDATE yearly_category_reports SET period_start = date(created_date, '-1 day', 'start of year');
+UPDATE monthly_category_reports
+SET period_start = l.period_start
+FROM (
+    SELECT month_id, strftime('%Y-%m-01', MIN(period_start)) AS period_start
+    FROM daily_category_reports
+    WHERE month_id IS NOT NULL
+    GROUP BY month_id
+) l
+WHERE monthly_category_reports.id = l.month_id
+    AND monthly_category_reports.period_start <> l.period_start;
+UPDATE yearly_category_reports
+SET period_start = l.period_start
+FROM (
+    SELECT year_id, strftime('%Y-01-01', MIN(period_start)) AS period_start
+    FROM monthly_category_reports
+    WHERE year_id IS NOT NULL
+    GROUP BY year_id
+) l
+WHERE yearly_category_reports.id = l.year_id
+    AND yearly_category_reports.period_start <> l.period_start;
+
+-- A period's rows, for the steps below. Not unique yet, they are merged at the end
+CREATE INDEX IF NOT EXISTS daily_reports_period_idx
+    ON daily_reports (user_id, period_start, is_ex);
+
+CREATE INDEX IF NOT EXISTS daily_category_reports_period_idx
+    ON daily_category_reports (user_id, period_start, category_id);
+
+CREATE INDEX IF NOT EXISTS monthly_category_reports_period_idx
+    ON monthly_category_reports (user_id, period_start, category_id);
+
+CREATE INDEX IF NOT EXISTS yearly_category_reports_period_idx
+    ON yearly_category_reports (user_id, period_start, category_id);
+
+-- A row is in the reports if its day has a daily report written at or after it
+CREATE TEMP TABLE rollup_backlog AS
+SELECT
+    d.id,
+    d.user_id,
+    d.category_id,
+    c.is_ex,
+    d.amount,
+    date(d.created_date) AS day,
+    COALESCE(d.created_date <= r.last_run, 0) AS reported
+FROM dengies d
+JOIN categories c ON c.id = d.category_id
+LEFT JOIN (
+    SELECT user_id, period_start, is_ex, MAX(created_date) AS last_run
+    FROM daily_reports
+    GROUP BY user_id, period_start, is_ex
+) r
+    ON r.user_id = d.user_id
+    AND r.period_start = date(d.created_date)
+    AND r.is_ex = c.is_ex
+WHERE d.user_id IS NOT NULL;
+
+INSERT OR IGNORE INTO rollup_watermarks (user_id, last_dengies_id)
+SELECT user_id, MAX(id)
+FROM rollup_backlog
+WHERE reported
+GROUP BY user_id;
+
+DELETE FROM rollup_backlog
+WHERE reported
+    OR id > COALESCE((SELECT w.last_dengies_id FROM rollup_watermarks w WHERE w.user_id = rollup_backlog.user_id), 0);
+
+CREATE TEMP TABLE rollup_links (
+    user_id INTEGER NOT NULL,
+    category_id INTEGER NOT NULL,
+    period_start TEXT NOT NULL,
+    total_amount INTEGER NOT NULL,
+    parent_id INTEGER
+);
+
+-- Rows left out below the watermark, with the newest row of their period (report_id)
+CREATE TEMP TABLE rollup_leftover AS
+SELECT
+    l.*,
+    (
+        SELECT MAX(x.id)
+        FROM daily_reports x
+        WHERE x.user_id = l.user_id AND x.period_start = l.day AND x.is_ex = l.is_ex
+    ) AS report_id
+FROM (
+    SELECT user_id, is_ex, day, SUM(amount) AS total_amount
+    FROM rollup_backlog
+    GROUP BY user_id, is_ex, day
+) l;
+
+UPDATE daily_reports
+SET total_amount = daily_reports.total_amount + l.total_amount
+FROM rollup_leftover l
+WHERE daily_reports.id = l.report_id;
+
+INSERT INTO daily_reports (user_id, is_ex, period_start, total_amount, created_date)
+SELECT l.user_id, l.is_ex, l.day, l.total_amount, datetime('now', u.time_utc || ' seconds')
+FROM rollup_leftover l
+JOIN users u ON u.id = l.user_id
+WHERE l.report_id IS NULL;
+
+INSERT INTO rollup_links (user_id, category_id, period_start, total_amount)
+SELECT user_id, category_id, day, SUM(amount)
+FROM rollup_backlog
+GROUP BY user_id, category_id, day;
+
+UPDATE rollup_links
+SET parent_id = (
+    SELECT MAX(d.id)
+    FROM daily_category_reports d
+    WHERE d.user_id = rollup_links.user_id
+        AND d.category_id = rollup_links.category_id
+        AND d.period_start = rollup_links.period_start
+);
+
+UPDATE daily_category_reports
+SET total_amount = daily_category_reports.total_amount + l.total_amount
+FROM rollup_links l
+WHERE daily_category_reports.id = l.parent_id;
+
+UPDATE monthly_category_reports
+SET total_amount = monthly_category_reports.total_amount + l.total_amount
+FROM (
+    SELECT d.month_id, SUM(l.total_amount) AS total_amount
+    FROM rollup_links l
+    JOIN daily_category_reports d ON d.id = l.parent_id
+    GROUP BY d.month_id
+) l
+WHERE monthly_category_reports.id = l.month_id;
+
+UPDATE yearly_category_reports
+SET total_amount = yearly_category_reports.total_amount + l.total_amount
+FROM (
+    SELECT m.year_id, SUM(l.total_amount) AS total_amount
+    FROM rollup_links l
+    JOIN daily_category_reports d ON d.id = l.parent_id
+    JOIN monthly_category_reports m ON m.id = d.month_id
+    GROUP BY m.year_id
+) l
+WHERE yearly_category_reports.id = l.year_id;
+
+INSERT INTO daily_category_reports (user_id, category_id, period_start, total_amount, created_date)
+SELECT l.user_id, l.category_id, l.period_start, l.total_amount, datetime('now', u.time_utc || ' seconds')
+FROM rollup_links l
+JOIN users u ON u.id = l.user_id
+WHERE l.parent_id IS NULL;
+
+-- Daily category rows without a month, then monthly rows without a year
+DELETE FROM rollup_links;
+
+INSERT INTO rollup_links (user_id, category_id, period_start, total_amount)
+SELECT user_id, category_id, strftime('%Y-%m-01', period_start), SUM(total_amount)
+FROM daily_category_reports
+WHERE month_id IS NULL
+GROUP BY user_id, category_id, strftime('%Y-%m-01', period_start);
+
+UPDATE rollup_links
+SET parent_id = (
+    SELECT MAX(m.id)
+    FROM monthly_category_reports m
+    WHERE m.user_id = rollup_links.user_id
+        AND m.category_id = rollup_links.category_id
+        AND m.period_start = rollup_links.period_start
+);
+
+UPDATE monthly_category_reports
+SET total_amount = monthly_category_reports.total_amount + l.total_amount
+FROM rollup_links l
+WHERE monthly_category_reports.id = l.parent_id;
+
+UPDATE yearly_category_reports
+SET total_amount = yearly_category_reports.total_amount + l.total_amount
+FROM (
+    SELECT m.year_id, SUM(l.total_amount) AS total_amount
+    FROM rollup_links l
+    JOIN monthly_category_reports m ON m.id = l.parent_id
+    GROUP BY m.year_id
+) l
+WHERE yearly_category_reports.id = l.year_id;
+
+INSERT INTO monthly_category_reports (user_id, category_id, period_start, total_amount, created_date)
+SELECT l.user_id, l.category_id, l.period_start, l.total_amount, datetime('now', u.time_utc || ' seconds')
+FROM rollup_links l
+JOIN users u ON u.id = l.user_id
+WHERE l.parent_id IS NULL;
+
+UPDATE daily_category_reports
+SET month_id = (
+    SELECT MAX(m.id)
+    FROM monthly_category_reports m
+    WHERE m.user_id = daily_category_reports.user_id
+        AND m.category_id = daily_category_reports.category_id
+        AND m.period_start = strftime('%Y-%m-01', daily_category_reports.period_start)
+)
+WHERE month_id IS NULL;
+
+DELETE FROM rollup_links;
+
+INSERT INTO rollup_links (user_id, category_id, period_start, total_amount)
+SELECT user_id, category_id, strftime('%Y-01-01', period_start), SUM(total_amount)
+FROM monthly_category_reports
+WHERE year_id IS NULL
+GROUP BY user_id, category_id, strftime('%Y-01-01', period_start);
+
+UPDATE rollup_links
+SET parent_id = (
+    SELECT MAX(y.id)
+    FROM yearly_category_reports y
+    WHERE y.user_id = rollup_links.user_id
+        AND y.category_id = rollup_links.category_id
+        AND y.period_start = rollup_links.period_start
+);
+
+UPDATE yearly_category_reports
+SET total_amount = yearly_category_reports.total_amount + l.total_amount
+FROM rollup_links l
+WHERE yearly_category_reports.id = l.parent_id;
+
+INSERT INTO yearly_category_reports (user_id, category_id, period_start, total_amount, created_date)
+SELECT l.user_id, l.category_id, l.period_start, l.total_amount, datetime('now', u.time_utc || ' seconds')
+FROM rollup_links l
+JOIN users u ON u.id = l.user_id
+WHERE l.parent_id IS NULL;
+
+UPDATE monthly_category_reports
+SET year_id = (
+    SELECT MAX(y.id)
+    FROM yearly_category_reports y
+    WHERE y.user_id = monthly_category_reports.user_id
+        AND y.category_id = monthly_category_reports.category_id
+        AND y.period_start = strftime('%Y-01-01', monthly_category_reports.period_start)
+)
+WHERE year_id IS NULL;
+
+DROP TABLE rollup_backlog;
+DROP TABLE rollup_links;
+DROP TABLE rollup_leftover;
+
+-- Imports and re-runs of the previous rollups could write more than one row for a
+-- period: they are merged into the newest one, summing the totals and moving the
+-- rows linked to the others over to it. Then the rollups upsert on the period.
+CREATE TEMP TABLE rollup_duplicates (
+    id INTEGER PRIMARY KEY,
+    keep_id INTEGER NOT NULL
+);
+
+INSERT INTO rollup_duplicates (id, keep_id)
+SELECT id, keep_id
+FROM (
+    SELECT id, MAX(id) OVER (PARTITION BY user_id, category_id, period_start) AS keep_id
+    FROM yearly_category_reports
+)
+WHERE id <> keep_id;
+
+UPDATE yearly_category_reports
+SET total_amount = yearly_category_reports.total_amount + s.total_amount
+FROM (
+    SELECT d.keep_id, SUM(r.total_amount) AS total_amount
+    FROM rollup_duplicates d
+    JOIN yearly_category_reports r ON r.id = d.id
+    GROUP BY d.keep_id
+) s
+WHERE yearly_category_reports.id = s.keep_id;
+
+UPDATE monthly_category_reports
+SET year_id = d.keep_id
+FROM rollup_duplicates d
+WHERE monthly_category_reports.year_id = d.id;
+
+DELETE FROM yearly_category_reports
+WHERE id IN (SELECT id FROM rollup_duplicates);
+
+DELETE FROM rollup_duplicates;
+
+INSERT INTO rollup_duplicates (id, keep_id)
+SELECT id, keep_id
+FROM (
+    SELECT id, MAX(id) OVER (PARTITION BY user_id, category_id, period_start) AS keep_id
+    FROM monthly_category_reports
+)
+WHERE id <> keep_id;
+
+UPDATE monthly_category_reports
+SET total_amount = monthly_category_reports.total_amount + s.total_amount
+FROM (
+    SELECT d.keep_id, SUM(r.total_amount) AS total_amount
+    FROM rollup_duplicates d
+    JOIN monthly_category_reports r ON r.id = d.id
+    GROUP BY d.keep_id
+) s
+WHERE monthly_category_reports.id = s.keep_id;
+
+UPDATE daily_category_reports
+SET month_id = d.keep_id
+FROM rollup_duplicates d
+WHERE daily_category_reports.month_id = d.id;
+
+DELETE FROM monthly_category_reports
+WHERE id IN (SELECT id FROM rollup_duplicates);
+
+DELETE FROM rollup_duplicates;
+
+INSERT INTO rollup_duplicates (id, keep_id)
+SELECT id, keep_id
+FROM (
+    SELECT id, MAX(id) OVER (PARTITION BY user_id, category_id, period_start) AS keep_id
+    FROM daily_category_reports
+)
+WHERE id <> keep_id;
+
+UPDATE daily_category_reports
+SET total_amount = daily_category_reports.total_amount + s.total_amount
+FROM (
+    SELECT d.keep_id, SUM(r.total_amount) AS total_amount
+    FROM rollup_duplicates d
+    JOIN daily_category_reports r ON r.id = d.id
+    GROUP BY d.keep_id
+) s
+WHERE daily_category_reports.id = s.keep_id;
+
+DELETE FROM daily_category_reports
+WHERE id IN (SELECT id FROM rollup_duplicates);
+
+DELETE FROM rollup_duplicates;
+
+INSERT INTO rollup_duplicates (id, keep_id)
+SELECT id, keep_id
+FROM (
+    SELECT id, MAX(id) OVER (PARTITION BY user_id, is_ex, period_start) AS keep_id
+    FROM daily_reports
+)
+WHERE id <> keep_id;
+
+UPDATE daily_reports
+SET total_amount = daily_reports.total_amount + s.total_amount
+FROM (
+    SELECT d.keep_id, SUM(r.total_amount) AS total_amount
+    FROM rollup_duplicates d
+    JOIN daily_reports r ON r.id = d.id
+    GROUP BY d.keep_id
+) s
+WHERE daily_reports.id = s.keep_id;
+
+DELETE FROM daily_reports
+WHERE id IN (SELECT id FROM rollup_duplicates);
+
+DELETE FROM rollup_duplicates;
+
+DROP TABLE rollup_duplicates;
+
+DROP INDEX IF EXISTS daily_reports_period_idx;
+DROP INDEX IF EXISTS daily_category_reports_period_idx;
+DROP INDEX IF EXISTS monthly_category_reports_period_idx;
+DROP INDEX IF EXISTS yearly_category_reports_period_idx;
+
+-- Also the digest's lookups by user and day
+CREATE UNIQUE INDEX daily_reports_period_key
+    ON daily_reports (user_id, period_start, is_ex);
+
+CREATE UNIQUE INDEX daily_category_reports_period_key
+    ON daily_category_reports (user_id, period_start, category_id);
+
+CREATE UNIQUE INDEX monthly_category_reports_period_key
+    ON monthly_category_reports (user_id, period_start, category_id);
+
+CREATE UNIQUE INDEX yearly_category_reports_period_key
+    ON yearly_category_reports (user_id, period_start, category_id);
+
+DROP INDEX IF EXISTS daily_category_reports_unlinked_idx;
+DROP INDEX IF EXISTS monthly_category_reports_unlinked_idx;
+DROP INDEX IF EXISTS daily_reports_user_type_created_idx;
+DROP INDEX IF EXISTS yearly_category_reports_user_created_idx;
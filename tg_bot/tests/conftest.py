@@ -0,0 +1,31 @@
+import os
+import asyncio
+
+import pytest
+
+# app.data.storage picks its backend on import; the tests run on SQLite files
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+
+import app.data.sqliteContext as sqlite_db  # noqa: E402
+
+
+@pytest.fixture
+def run_sqlite(tmp_path, monkeypatch):
+    """run_sqlite(scenario) runs the coroutine function on a new, migrated database file."""
+    monkeypatch.setattr(sqlite_db, "SQLITE_PATH", str(tmp_path / "test.sqlite3"))
+    # The locks belong to the event loop of the previous test
+    monkeypatch.setattr(sqlite_db, "_open_lock", None)
+    monkeypatch.setattr(sqlite_db, "_write_lock", None)
+
+    def run(scenario):
+        async def main():
+            await sqlite_db.open_pools()
+            try:
+                await sqlite_db.run_migrations()
+                return await scenario()
+            finally:
+                await sqlite_db.close_pools()
+
+        return asyncio.run(main())
+
+    return run
@@ -0,0 +1,95 @@
+import time
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from app.auto import fanout
+from app.auto.fanout import Delivery, deliver_all
+
+
+class FakeBot:
+    """Records (chat_id, text, monotonic time); flood_waits maps a chat to the retry_after of its first send."""
+
+    def __init__(self, flood_waits: dict[int, int] | None = None):
+        self.flood_waits = dict(flood_waits or {})
+        self.sent = []
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        retry_after = self.flood_waits.pop(chat_id, None)
+        if retry_after is not None:
+            raise TelegramRetryAfter(SendMessage(chat_id=chat_id, text=text), "Flood control exceeded", retry_after)
+        self.sent.append((chat_id, text, time.monotonic()))
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(fanout, "FANOUT_CONCURRENCY", 10)
+    monkeypatch.setattr(fanout, "FANOUT_RATE", 50)
+    monkeypatch.setattr(fanout, "FANOUT_BURST", 5)
+    monkeypatch.setattr(fanout, "FANOUT_CHAT_INTERVAL", 0)
+
+
+def test_sends_are_held_to_the_rate():
+    bot = FakeBot()
+    deliveries = [Delivery(chat_id, texts=["hi"]) for chat_id in range(25)]
+    report = asyncio.run(deliver_all("test", bot, deliveries))
+
+    assert (report.delivered, report.messages) == (25, 25)
+    assert {delivery.outcome for delivery in deliveries} == {"delivered"}
+    # 5 at once, the other 20 at 50 per second
+    elapsed = bot.sent[-1][2] - bot.sent[0][2]
+    assert elapsed >= 20 / 50 * 0.9
+
+
+def test_messages_to_one_chat_are_spaced_and_in_order(monkeypatch):
+    monkeypatch.setattr(fanout, "FANOUT_CHAT_INTERVAL", 0.1)
+    bot = FakeBot()
+    asyncio.run(deliver_all("test", bot, [Delivery(1, texts=["a", "b", "c"])]))
+
+    assert [text for _, text, _ in bot.sent] == ["a", "b", "c"]
+    times = [sent_at for _, _, sent_at in bot.sent]
+    assert all(later - earlier >= 0.09 for earlier, later in zip(times, times[1:]))
+
+
+def test_a_flood_wait_does_not_hold_up_other_chats(monkeypatch):
+    monkeypatch.setattr(fanout, "FANOUT_CONCURRENCY", 1)
+    bot = FakeBot(flood_waits={1: 1})
+    deliveries = [Delivery(1, texts=["a", "b"]), Delivery(2, texts=["c"])]
+    report = asyncio.run(deliver_all("test", bot, deliveries))
+
+    assert [(chat_id, text) for chat_id, text, _ in bot.sent] == [(2, "c"), (1, "a"), (1, "b")]
+    assert (report.delivered, report.flood_waits) == (2, 1)
+    assert bot.sent[1][2] - bot.sent[0][2] >= 0.9
+
+
+def test_a_long_flood_wait_gives_up_the_chat(monkeypatch):
+    monkeypatch.setattr(fanout, "FANOUT_MAX_WAIT", 10)
+    delivery = Delivery(1, texts=["a"])
+    report = asyncio.run(deliver_all("test", FakeBot(flood_waits={1: 30}), [delivery]))
+
+    assert (delivery.outcome, delivery.error) == ("failed", "flood wait of 30s")
+    assert report.failed == 1
+
+
+def test_deferred_flood_waits_are_left_to_the_caller():
+    delivery = Delivery(1, texts=["a", "b"], sent=1)
+    asyncio.run(deliver_all("test", FakeBot(flood_waits={1: 30}), [delivery], defer_flood_waits=True))
+
+    assert (delivery.outcome, delivery.retry_after, delivery.sent) == ("deferred", 30, 1)
+
+
+def test_rendered_deliveries():
+    async def render(chat_id: int, lang_code: str):
+        if chat_id == 3:
+            raise ValueError("no text")
+        return [f"{lang_code}:{chat_id}"] if chat_id == 1 else None
+
+    bot = FakeBot()
+    deliveries = [Delivery(chat_id, lang_code="en") for chat_id in (1, 2, 3)]
+    report = asyncio.run(deliver_all("test", bot, deliveries, render=render))
+
+    assert [(chat_id, text) for chat_id, text, _ in bot.sent] == [(1, "en:1")]
+    assert [delivery.outcome for delivery in deliveries] == ["delivered", "skipped", "failed"]
+    assert (report.delivered, report.skipped, report.failed) == (1, 1, 1)
@@ -0,0 +1,103 @@
+import io
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+from app.data import ledger_csv
+from app.data.ledger_csv import ImportAborted, export_writer, parse_row, read_rows
+
+
+NOW = datetime(2026, 3, 1, 12, 0)
+COLUMNS = {"date": 0, "category": 1, "amount": 2, "type": 3, "comment": 4}
+
+
+def read(content: str, **encode) -> tuple[list[tuple], dict]:
+    result = {"imported": 0, "skipped": 0, "errors": []}
+    raw = io.BytesIO(content.encode(**encode))
+    rows = list(read_rows(raw, NOW, result))
+    # The file is handed back open
+    assert not raw.closed
+    return rows, result
+
+
+def test_parse_row_with_type_and_comment():
+    assert parse_row(["2026-02-28 09:30", " Food ", "12,5", "Expense", "lunch"], COLUMNS, NOW) == (
+        datetime(2026, 2, 28, 9, 30), True, "Food", Decimal("12.50"), "lunch"
+    )
+    assert parse_row(["01.02.2026", "Salary", "1 000", "+", ""], COLUMNS, NOW) == (
+        datetime(2026, 2, 1), False, "Salary", Decimal("1000.00"), None
+    )
+
+
+def test_parse_row_sign_sets_the_type_without_one():
+    columns = {"date": 0, "category": 1, "amount": 2}
+    assert parse_row(["2026-02-28", "Food", "-7"], columns, NOW)[1:4] == (True, "Food", Decimal("7.00"))
+    assert parse_row(["2026-02-28", "Gift", "7"], columns, NOW)[1:4] == (False, "Gift", Decimal("7.00"))
+
+
+@pytest.mark.parametrize("row, reason", [
+    (["2026-13-01", "Food", "5", "", ""], "bad date"),
+    (["2026-03-02", "Food", "5", "", ""], "in the future"),
+    (["1999-12-31", "Food", "5", "", ""], "before 2000"),
+    (["2026-02-28", "Food", "five", "", ""], "bad amount"),
+    (["2026-02-28", "Food", "0.5", "", ""], "between 1 and"),
+    (["2026-02-28", "Food", "5", "maybe", ""], "bad type"),
+    (["2026-02-28", "", "5", "", ""], "bad category"),
+    (["2026-02-28", "Food;drinks", "5", "", ""], "bad category"),
+    (["2026-02-28", "Food", "5", "", "a" * 31], "bad comment"),
+])
+def test_parse_row_rejects(row, reason):
+    with pytest.raises(ValueError, match=reason):
+        parse_row(row, COLUMNS, NOW)
+
+
+def test_read_rows_with_semicolons_and_a_bom():
+    rows, result = read(
+        "Date;Amount;Category;Comment\r\n"
+        "2026-02-27;-10,25;Food;\r\n"
+        "\r\n"
+        "2026-02-28;abc;Food;\r\n"
+        "2026-02-28;500;Salary;march\r\n",
+        encoding="utf-8-sig",
+    )
+    assert rows == [
+        (2, datetime(2026, 2, 27), True, "Food", Decimal("10.25"), None),
+        (5, datetime(2026, 2, 28), False, "Salary", Decimal("500.00"), "march"),
+    ]
+    assert result == {"imported": 2, "skipped": 1, "errors": ["4: bad amount 'abc'"]}
+
+
+def test_read_rows_reports_the_first_errors_only():
+    content = "date,category,amount\n" + "not a date,Food,1\n" * (ledger_csv.IMPORT_MAX_ERRORS + 3)
+    rows, result = read(content)
+    assert rows == []
+    assert result["skipped"] == ledger_csv.IMPORT_MAX_ERRORS + 3
+    assert len(result["errors"]) == ledger_csv.IMPORT_MAX_ERRORS
+
+
+def test_read_rows_needs_the_required_columns():
+    with pytest.raises(ImportAborted) as aborted:
+        read("date,category,comment\n2026-02-28,Food,x\n")
+    assert aborted.value.status == "bad_header"
+
+
+def test_read_rows_row_limit(monkeypatch):
+    monkeypatch.setattr(ledger_csv, "IMPORT_MAX_ROWS", 1)
+    with pytest.raises(ImportAborted) as aborted:
+        read("date,category,amount\n2026-02-27,Food,-1\n2026-02-28,Food,-2\n")
+    assert aborted.value.status == "too_many_rows"
+
+
+def test_export_can_be_imported_again():
+    exported = io.BytesIO()
+    with export_writer(exported) as writer:
+        writer.writerow(("2026-02-27 08:15:00", "Food", Decimal("10.25"), "expense", "bread"))
+        writer.writerow(("2026-02-28 18:00:00", "Salary", Decimal("500.00"), "income", ""))
+
+    rows, result = read(exported.getvalue().decode())
+    assert rows == [
+        (2, datetime(2026, 2, 27, 8, 15), True, "Food", Decimal("10.25"), "bread"),
+        (3, datetime(2026, 2, 28, 18, 0), False, "Salary", Decimal("500.00"), None),
+    ]
+    assert result["skipped"] == 0
@@ -0,0 +1,123 @@
+from datetime import datetime
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import app.data.sqliteContext as sqlite_db
+from app.auto import fanout, outbox
+
+
+RUN = datetime(2026, 3, 1, 0, 15)
+
+
+async def expire_leases():
+    async with sqlite_db._transaction() as conn:
+        await conn.execute("UPDATE outbox SET available_at = datetime('now', '-1 seconds') WHERE status = 'pending';")
+
+
+async def outbox_rows() -> dict[int, tuple]:
+    rows = await sqlite_db._fetchall(
+        await sqlite_db._reader(),
+        "SELECT chat_id, status, attempts, sent_parts, last_error FROM outbox ORDER BY id;"
+    )
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+
+def test_enqueue_ignores_a_run_already_queued(run_sqlite):
+    async def scenario():
+        messages = [(1, ["a"]), (2, ["b", "c"]), (3, [])]
+        return await outbox.enqueue("digest", RUN, messages), await outbox.enqueue("digest", RUN, messages)
+
+    assert run_sqlite(scenario) == (2, 0)
+
+
+def test_claims_are_leased_until_they_expire(run_sqlite):
+    async def scenario():
+        await outbox.enqueue("digest", RUN, [(1, ["a"]), (2, ["b", "c"])])
+        first = await sqlite_db.claim_outbox(10, 300)
+        leased = await sqlite_db.claim_outbox(10, 300)
+        await expire_leases()
+        again = await sqlite_db.claim_outbox(10, 300)
+        return first, leased, again, await outbox_rows()
+
+    first, leased, again, rows = run_sqlite(scenario)
+    assert [(chat_id, texts, sent) for _, chat_id, texts, sent in first] == [(1, ["a"], 0), (2, ["b", "c"], 0)]
+    assert leased == []
+    assert again == first
+    assert rows == {1: ("pending", 2, 0, None), 2: ("pending", 2, 0, None)}
+
+
+def test_finished_messages_are_not_claimed_again(run_sqlite):
+    async def scenario():
+        await outbox.enqueue("digest", RUN, [(1, ["a"]), (2, ["b"])])
+        (id1, *_), (id2, *_) = await sqlite_db.claim_outbox(10, 300)
+        await sqlite_db.finish_outbox([(id1, "sent", 1, None, None), (id2, "failed", 0, "unreachable", None)])
+        await expire_leases()
+        return await sqlite_db.claim_outbox(10, 300), await outbox_rows()
+
+    claimed, rows = run_sqlite(scenario)
+    assert claimed == []
+    assert rows == {1: ("sent", 1, 1, None), 2: ("failed", 1, 0, "unreachable")}
+
+
+def test_retry_after_resumes_from_the_sent_parts(run_sqlite):
+    async def scenario():
+        await outbox.enqueue("digest", RUN, [(1, ["a", "b"])])
+        (message_id, *_), = await sqlite_db.claim_outbox(10, 300)
+        await sqlite_db.finish_outbox([(message_id, "pending", 1, "flood wait of 60s", 60.0)])
+        waiting = await sqlite_db.claim_outbox(10, 300)
+        await expire_leases()
+        return waiting, await sqlite_db.claim_outbox(10, 300)
+
+    waiting, claimed = run_sqlite(scenario)
+    assert waiting == []
+    assert [(chat_id, texts, sent) for _, chat_id, texts, sent in claimed] == [(1, ["a", "b"], 1)]
+
+
+def test_messages_fail_after_max_attempts(run_sqlite, monkeypatch):
+    monkeypatch.setattr(sqlite_db, "OUTBOX_MAX_ATTEMPTS", 2)
+
+    async def scenario():
+        await outbox.enqueue("digest", RUN, [(1, ["a"])])
+        claims = []
+        for _ in range(3):
+            claims.append(len(await sqlite_db.claim_outbox(10, 300)))
+            await expire_leases()
+        return claims, await outbox_rows()
+
+    claims, rows = run_sqlite(scenario)
+    assert claims == [1, 1, 0]
+    assert rows == {1: ("failed", 2, 0, "lease expired")}
+
+
+class FakeBot:
+    """Chat 2 is flood-waited on its second message, chat 3 has blocked the bot."""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        method = SendMessage(chat_id=chat_id, text=text)
+        if chat_id == 2 and text == "c":
+            raise TelegramRetryAfter(method, "Flood control exceeded", 30)
+        if chat_id == 3:
+            raise TelegramForbiddenError(method, "bot was blocked by the user")
+        self.sent.append((chat_id, text))
+
+
+def test_send_batch_records_every_outcome(run_sqlite, monkeypatch):
+    monkeypatch.setattr(fanout, "FANOUT_CHAT_INTERVAL", 0)
+    bot = FakeBot()
+
+    async def scenario():
+        await outbox.enqueue("digest", RUN, [(1, ["a"]), (2, ["b", "c"]), (3, ["d"])])
+        await outbox._send_batch(bot, await sqlite_db.claim_outbox(10, 300))
+        return await outbox_rows()
+
+    rows = run_sqlite(scenario)
+    assert sorted(bot.sent) == [(1, "a"), (2, "b")]
+    assert rows == {
+        1: ("sent", 1, 1, None),
+        2: ("pending", 1, 1, "flood wait of 30s"),
+        3: ("failed", 1, 0, "unreachable"),
+    }
@@ -0,0 +1,94 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from app.cmn import quota
+from app.cmn.quota import TokenBucket
+
+
+def test_bucket_allows_a_burst_then_refills():
+    bucket = TokenBucket(3, 2)
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+
+    # Half a second at 2 tokens per second is one more request
+    bucket.updated -= 0.5
+    assert bucket.take()
+    assert not bucket.take()
+
+
+def test_bucket_does_not_refill_past_capacity():
+    bucket = TokenBucket(2, 1)
+    bucket.take()
+    bucket.updated -= 3600
+    assert [bucket.take() for _ in range(3)] == [True, True, False]
+
+
+def test_allow_burst_is_per_user(monkeypatch):
+    monkeypatch.setattr(quota, "QUOTA_BURST", 2)
+    quota._buckets.clear()
+    assert [quota.allow_burst(1) for _ in range(3)] == [True, True, False]
+    assert quota.allow_burst(2)
+
+
+class FakeStorage:
+    def __init__(self, count: int, time_utc: timedelta | None = timedelta(hours=5)):
+        self.count = count
+        self.time_utc = time_utc
+        self.calls = 0
+
+    async def get_user_identity(self, tg_user_id: int):
+        return None if self.time_utc is None else {"time_utc": self.time_utc}
+
+    async def get_todays_expense_count(self, tg_user_id: int) -> int:
+        self.calls += 1
+        return self.count
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    quota._day_counts.clear()
+    fake = FakeStorage(count=3)
+    monkeypatch.setattr(quota, "db", fake)
+    return fake
+
+
+def test_counter_is_seeded_once_then_counted_in_memory(storage):
+    assert asyncio.run(quota.entries_today(1)) == 3
+    quota.record_entry(1)
+    quota.record_entry(1)
+    assert asyncio.run(quota.entries_today(1)) == 5
+    assert storage.calls == 1
+
+
+def test_counter_is_seeded_again_on_a_new_local_day(storage):
+    asyncio.run(quota.entries_today(1))
+    quota._day_counts.peek(1)[0] -= timedelta(days=1)
+
+    # Yesterday's counter is not incremented, today's is read again
+    quota.record_entry(1)
+    storage.count = 0
+    assert asyncio.run(quota.entries_today(1)) == 0
+    assert storage.calls == 2
+
+
+def test_forget_drops_the_counter(storage):
+    asyncio.run(quota.entries_today(1))
+    quota.forget(1)
+    storage.count = 7
+    assert asyncio.run(quota.entries_today(1)) == 7
+
+
+def test_limit(storage, monkeypatch):
+    monkeypatch.setattr(quota, "DAILY_ENTRY_LIMIT", 4)
+    count = asyncio.run(quota.entries_today(1))
+    assert not quota.is_over_limit(count)
+    quota.record_entry(1)
+    assert quota.is_over_limit(asyncio.run(quota.entries_today(1)))
+
+
+def test_unregistered_users_are_not_limited(storage):
+    storage.time_utc = None
+    assert asyncio.run(quota.entries_today(1)) is None
+    assert not quota.is_over_limit(None)
+    assert storage.calls == 0
@@ -0,0 +1,47 @@
+import inspect
+
+import pytest
+
+import app.data.storage as storage
+import app.data.sqliteContext as sqlite_db
+
+
+def test_sqlite_backend_implements_the_interface():
+    functions = storage._load(storage.SQLITE)
+    assert set(functions) == set(storage.INTERFACE)
+    assert functions["claim_outbox"] is sqlite_db.claim_outbox
+
+
+def test_postgres_backend_implements_the_interface():
+    functions = storage._load(storage.POSTGRES)
+    assert set(functions) == set(storage.INTERFACE)
+    # import/export come from transfer.py, the migrations from migrations.py
+    assert functions["import_csv"].__module__ == "app.data.transfer"
+    assert functions["run_migrations"].__module__ == "app.data.migrations"
+
+
+def test_backends_take_the_same_parameters():
+    def parameters(function):
+        return [(p.name, p.kind, p.default) for p in inspect.signature(function).parameters.values()]
+
+    postgres, sqlite = storage._load(storage.POSTGRES), storage._load(storage.SQLITE)
+    mismatched = [name for name in storage.INTERFACE if parameters(postgres[name]) != parameters(sqlite[name])]
+    assert mismatched == []
+
+
+def test_module_attributes_come_from_the_selected_backend():
+    assert storage.BACKEND == storage.SQLITE
+    assert storage.get_daily_digests is sqlite_db.get_daily_digests
+    with pytest.raises(AttributeError):
+        storage.no_such_function
+
+
+def test_unknown_backend():
+    with pytest.raises(RuntimeError, match="Unknown STORAGE_BACKEND"):
+        storage._load("mysql")
+
+
+def test_incomplete_backend(monkeypatch):
+    monkeypatch.setitem(storage.BACKENDS, "partial", ("app.data.ledger_csv",))
+    with pytest.raises(RuntimeError, match="does not implement: open_pools"):
+        storage._load("partial")
@@ -0,0 +1,72 @@
+from decimal import Decimal
+
+from app.data.suggestions import AmountStats, RecentValues, RECENT, FREQUENT, HOURLY, normalize_amount
+
+
+def amounts(*values) -> list[Decimal]:
+    return [normalize_amount(value) for value in values]
+
+
+def test_normalize_amount_matches_numeric_keys():
+    assert normalize_amount(10) == normalize_amount("10.00") == normalize_amount(10.0) == Decimal("10.00")
+
+
+def test_recent_ranks_latest_first():
+    stats = AmountStats(max_tracked=20, max_recent=5)
+    for value in (1, 2, 3, 2, 4):
+        stats.add(value, hour=9)
+    assert stats.top(3, RECENT) == amounts(4, 2, 3)
+
+
+def test_recent_keeps_new_amounts_when_full():
+    stats = AmountStats(max_tracked=20, max_recent=5)
+    for value in range(1, 21):
+        stats.add(value, hour=9)
+        stats.add(value, hour=9)
+    for value in range(101, 106):
+        stats.add(value, hour=9)
+
+    assert stats.top(5, RECENT) == amounts(105, 104, 103, 102, 101)
+    assert len(stats.entries) == 20
+
+
+def test_frequent_ranks_most_used_first_and_evicts_least_used():
+    stats = AmountStats(max_tracked=4, max_recent=1)
+    for value, uses in ((10, 5), (20, 3), (30, 2), (40, 1)):
+        for _ in range(uses):
+            stats.add(value, hour=12)
+    stats.add(50, hour=12)
+
+    # 40 is the most recent amount and kept, 30 is the least used of the others
+    assert sorted(stats.entries) == amounts(10, 20, 40, 50)
+    assert stats.top(3, FREQUENT) == amounts(10, 20, 50)
+
+
+def test_frequent_breaks_ties_by_last_use():
+    stats = AmountStats()
+    for value in (5, 6, 5, 6):
+        stats.add(value, hour=0)
+    assert stats.top(2, FREQUENT) == amounts(6, 5)
+
+
+def test_hourly_prefers_amounts_used_at_that_hour():
+    stats = AmountStats()
+    for _ in range(3):
+        stats.add(100, hour=8)
+    stats.add(25, hour=20)
+    stats.add(25, hour=20)
+
+    assert stats.top(2, HOURLY, hour=20) == amounts(25, 100)
+    assert stats.top(2, HOURLY, hour=8) == amounts(100, 25)
+    # Without an hour the hourly ranking falls back to recent
+    assert stats.top(2, HOURLY) == amounts(25, 100)
+
+
+def test_recent_values_keeps_distinct_newest_first():
+    recent = RecentValues(size=3)
+    for value in ("UZS", "USD", "UZS", "EUR", "RUB"):
+        recent.add(value)
+    assert recent.values == ["RUB", "EUR", "UZS"]
+
+    recent.replace(["A", "B", "A", "C"])
+    assert recent.values == ["A", "B", "C"]
@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+
+from app.cmn import zones
+
+
+def test_whole_hours_map_to_fixed_zones():
+    # POSIX sign convention: Etc/GMT-5 is UTC+5
+    assert zones.zone_for_offset(timedelta(hours=5)) == "Etc/GMT-5"
+    assert zones.zone_for_offset(timedelta(hours=-3)) == "Etc/GMT+3"
+    assert zones.zone_for_offset(timedelta(0)) == "Etc/UTC"
+    assert zones.current_offset("Etc/GMT-5") == timedelta(hours=5)
+    assert zones.is_fixed_offset("Etc/GMT-5")
+    assert not zones.is_fixed_offset("Asia/Tashkent")
+
+
+def test_fractional_offsets_map_to_real_zones():
+    assert zones.zone_for_offset(timedelta(hours=5, minutes=30)) == "Asia/Kolkata"
+    assert zones.zone_for_offset(timedelta(hours=5, minutes=45)) == "Asia/Kathmandu"
+    # Adelaide only has +10:30 in the southern summer; Darwin has +9:30 all year
+    january = datetime(2026, 1, 15, 12, 0)
+    assert zones.zone_for_offset(timedelta(hours=10, minutes=30), january) == "Australia/Adelaide"
+    assert zones.zone_for_offset(timedelta(hours=9, minutes=30), january) == "Australia/Darwin"
+
+
+def test_offsets_without_a_zone():
+    assert zones.zone_for_offset(timedelta(hours=1, minutes=15)) is None
+    assert zones.zone_for_offset(timedelta(hours=15)) is None
+    assert zones.zone_for_offset(timedelta(hours=-13)) is None
+
+
+def test_resolve_zone_ignores_case_and_spaces():
+    assert zones.resolve_zone(" asia/tashkent ") == "Asia/Tashkent"
+    assert zones.resolve_zone("America/New York") == "America/New_York"
+    assert zones.resolve_zone("Mars/Olympus") is None
+
+
+def test_current_offset_follows_dst():
+    assert zones.current_offset("Europe/Berlin", datetime(2026, 1, 15, 12, 0)) == timedelta(hours=1)
+    assert zones.current_offset("Europe/Berlin", datetime(2026, 7, 15, 12, 0)) == timedelta(hours=2)
+    assert zones.current_offset("No/Such_Zone") == timedelta(0)
+
+
+def test_round_offset_to_quarter_hours():
+    # A typed clock is a few seconds to minutes off the exact offset
+    assert zones.round_offset(timedelta(hours=5, minutes=1, seconds=20)) == timedelta(hours=5)
+    assert zones.round_offset(timedelta(hours=5, minutes=29)) == timedelta(hours=5, minutes=30)
+    assert zones.round_offset(timedelta(hours=-3, minutes=-52)) == timedelta(hours=-3, minutes=-45)
+
+
+def test_quarter_tick():
+    assert zones.quarter_tick(datetime(2026, 3, 1, 10, 44, 59)) == datetime(2026, 3, 1, 10, 30)
+    assert zones.quarter_tick(datetime(2026, 3, 1, 10, 45)) == datetime(2026, 3, 1, 10, 45)
+
+
+def test_due_offsets():
+    # 21:00 local at 16:00 UTC is UTC+5
+    assert zones.due_offsets(21, 0, datetime(2026, 3, 1, 16, 7)) == [timedelta(hours=5)]
+    # 21:00 local at 19:30 UTC is UTC+1:30, no zone has it but the offset is still due
+    assert zones.due_offsets(21, 0, datetime(2026, 3, 1, 19, 30)) == [timedelta(hours=1, minutes=30)]
+    # Near the date line: 0:15 local at 11:15 UTC is UTC+13 and UTC-11
+    assert zones.due_offsets(0, 15, datetime(2026, 3, 1, 11, 15)) == [timedelta(hours=-11), timedelta(hours=13)]